@@ -1,15 +1,28 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Request, Response, request, jsonify, send_file
 from flask_cors import CORS
 import librosa
 import soundfile as sf
+import soxr
 import numpy as np
 import os
+import queue
+import struct
 import tempfile
 from werkzeug.utils import secure_filename
+import functools
+import hashlib
+import json
 import logging
-from scipy import signal
-from scipy.ndimage import median_filter
-from sklearn.decomposition import FastICA
+import math
+import multiprocessing
+import threading
+import time
+import uuid
+import zipfile
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 app = Flask(__name__)
 CORS(app)
@@ -26,162 +39,1527 @@ os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size
+app.config['SEPARATION_WORKERS'] = os.cpu_count() or 1  # One separation process per core
+app.config['MAX_QUEUED_JOBS'] = 16  # Jobs waiting for a free worker before submissions are rejected
+app.config['ADMISSION_CPU_SECONDS'] = app.config['SEPARATION_WORKERS'] * 900  # Predicted worker time of unfinished jobs before new work is rejected
+app.config['ADMISSION_MEMORY_FRACTION'] = 0.75  # Share of physical memory the predicted peaks of running jobs may use
+app.config['JOB_MEMORY_CEILING'] = None  # Predicted peak bytes above which a full separation runs windowed instead; None shares the memory budget evenly between the workers
+app.config['JOB_RETENTION_SECONDS'] = 3600  # How long finished job records are kept for polling
+app.config['FFT_WORKERS'] = None  # Threads each job's STFTs use; None sizes them per job from the cores the other running and queued jobs leave free
+app.config['MEDIAN_WORKERS'] = None  # Threads each job's median filters and HPSS tile across; None follows the FFT threads
+app.config['WINDOW_SECONDS'] = 30  # Segment length for windowed (bounded-memory) separation
+app.config['WINDOW_OVERLAP_SECONDS'] = 2  # Crossfade between consecutive segments
+app.config['RESULT_CACHE_MAX_BYTES'] = 2 * 1024 * 1024 * 1024  # Disk budget for cached stems (LRU eviction)
+app.config['DOWNLOAD_MAX_AGE'] = 24 * 3600  # Cache-Control max-age for stems; their names are content hashes
+app.config['PRESET_CALIBRATION_SECONDS'] = 10  # Synthetic clip length used to measure each preset's speed
+app.config['WARM_UP_SECONDS'] = 1  # Synthetic clip every preset separates at startup; 0 skips the warm-up
+app.config['BATCH_MAX_ITEMS'] = 100  # Tracks accepted by one /batches call
+app.config['BATCH_MAX_CONTENT_LENGTH'] = 1024 * 1024 * 1024  # 1GB body limit for /batches uploads
+app.config['BATCH_PROGRESS_SECONDS'] = 15  # Idle interval between progress lines on a batch stream
 
-def professional_source_separation(audio_file, sr=22050):
+PIPELINE_VERSION = '4.6.0'  # Part of every result cache key; bump when the DSP output changes
+ICA_TRIALS = 3  # Independent FastICA restarts in the vocal source search
+ICA_FIT_SAMPLES = 131072  # Stereo samples drawn at random to fit each unmixing matrix
+
+AUDIO_DTYPE = np.float32  # Every signal, mask and gain in the pipeline
+SPECTRUM_DTYPE = np.complex64  # Every STFT in the pipeline
+
+TRACK_NAMES = ('vocals', 'accompaniment', 'bass', 'drums', 'other')
+SEPARATION_PRESETS = {
+    'fast': {
+        'description': 'Quick preview at 16 kHz: 1024-point spectra, one approximate HPSS pass, no ICA, no pitch tracking or morphological cleanup',
+        'stereo_n_fft': 1024,
+        'hpss_n_fft': 1024,
+        'multi_scale_hpss': False,
+        'hpss_decimation': 2,
+        'ica_trials': 0,
+        'pitch_tracking': False,
+        'morphology': False,
+        'sample_rate': 16000,
+        'resampler': 'soxr_mq',
+        'realtime_factor': 0.03,
+        'memory_per_second': 2.5e6
+    },
+    'balanced': {
+        'description': '2048-point spectra shared by HPSS and the vocal mask, single-trial ICA',
+        'stereo_n_fft': 2048,
+        'hpss_n_fft': 2048,
+        'multi_scale_hpss': True,
+        'hpss_decimation': 1,
+        'ica_trials': 1,
+        'pitch_tracking': True,
+        'morphology': True,
+        'sample_rate': 22050,
+        'resampler': 'soxr_hq',
+        'realtime_factor': 0.08,
+        'memory_per_second': 4e6
+    },
+    'max': {
+        'description': 'Full pipeline: 4096-point vocal spectra, multi-scale HPSS, multi-trial ICA, full cleanup',
+        'stereo_n_fft': 4096,
+        'hpss_n_fft': 2048,
+        'multi_scale_hpss': True,
+        'hpss_decimation': 1,
+        'ica_trials': ICA_TRIALS,
+        'pitch_tracking': True,
+        'morphology': True,
+        'sample_rate': 22050,
+        'resampler': 'soxr_vhq',
+        'realtime_factor': 0.12,
+        'memory_per_second': 7e6
+    }
+}
+# Admission cost model. A preset's realtime_factor (worker seconds per audio second, replaced by the
+# host calibration once it has run) and memory_per_second (peak bytes per second of stereo audio)
+# come from warmed-up benchmark.py runs at the preset's sample_rate; mono input skips the stereo and ICA stages, the
+# chords mode runs only the coarse HPSS and chroma. resampler is the librosa/soxr quality used to reach
+# the internal rate and, for output_rate=native, to resynthesize the stems at the upload's rate.
+JOB_MEMORY_BASE = 300e6  # Peak memory of a job over its audio, mostly the imported DSP stack
+MONO_CPU_FACTOR = 0.55
+MONO_MEMORY_FACTOR = 0.5
+CHORDS_CPU_FACTOR = 0.2
+CHORDS_MEMORY_FACTOR = 0.3
+DEFAULT_PRESET = 'max'
+PROCESSING_RATES = (16000, 22050, 32000, 44100, 48000)  # Internal rates a request may ask for besides 'native'
+OUTPUT_RATES = ('processing', 'native')  # Stems at the internal rate, or resynthesized at the upload's rate
+POST_PROCESSING_THREADS = len(TRACK_NAMES)  # Stems finished concurrently; sosfilt releases the GIL
+SEPARATION_MODES = ('full', 'windowed', 'chords')  # 'chords' analyses the harmony without writing stems
+OUTPUT_CONTAINERS = {
+    'wav': {'extension': '.wav', 'format': 'WAV'},
+    'flac': {'extension': '.flac', 'format': 'FLAC'}
+}
+OUTPUT_SUBTYPES = ('PCM_16', 'PCM_24', 'FLOAT')
+PEAKS_EXTENSION = '.peaks'
+PEAKS_SAMPLES_PER_PEAK = 256  # Finest zoom level: one min/max/RMS triple per 256 samples (~12 ms at 22.05 kHz)
+PEAKS_ZOOM_FACTOR = 4  # Each coarser level merges this many peaks of the level below
+PEAKS_LEVELS = 6  # 256 to 262144 samples per peak
+# Peaks file: magic, version, levels, zoom factor, sample rate, samples per peak of the first level,
+# stem frames, index of the first peak; then one uint32 peak count per level, then each level's
+# (min, max, rms) triples as int16 at full scale 32767
+PEAKS_HEADER = struct.Struct('<4sHHHIIQQ')
+PEAKS_MAGIC = b'PEAK'
+PEAKS_VERSION = 1
+PITCH_CLASSES = ('C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B')
+CHORD_QUALITIES = {  # Quality names as the app's ChordAnalyzer uses them: (name suffix, semitones above the root)
+    'major': ('', (0, 4, 7)),
+    'minor': ('m', (0, 3, 7)),
+    '7th': ('7', (0, 4, 7, 10)),
+    'maj7': ('maj7', (0, 4, 7, 11)),
+    'min7': ('m7', (0, 3, 7, 10)),
+    'diminished': ('dim', (0, 3, 6))
+}
+CHORD_SELF_TRANSITION = 0.9  # Per-frame probability of holding a chord in the Viterbi smoothing
+CHORD_SHARPNESS = 20  # Softmax scale from template similarity to per-frame chord probability
+CHORD_SILENCE = 1e-3  # Frames with less harmonic energy than this fraction of the loudest are no-chord
+CHROMA_HOP = 512  # Hop of the harmonic spectrogram the chroma is computed from
+CHORDS_EXTENSION = '.chords'
+# Krumhansl-Kessler key profiles, tonic first
+MAJOR_KEY_PROFILE = (6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88)
+MINOR_KEY_PROFILE = (6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17)
+DOWNLOAD_FORMATS = {
+    'wav': {'extension': '.wav', 'mimetype': 'audio/wav', 'format': 'WAV', 'subtype': 'PCM_16'},
+    'flac': {'extension': '.flac', 'mimetype': 'audio/flac', 'format': 'FLAC', 'subtype': 'PCM_16'},
+    'opus': {'extension': '.opus', 'mimetype': 'audio/ogg', 'format': 'OGG', 'subtype': 'OPUS'}
+}
+OPUS_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)  # The only rates libopus encodes
+DECODE_BLOCK_FRAMES = 1 << 16  # Frames converted per step when decoding into the PCM buffer
+
+def dtype_policy_violations(value):
+    """Dtypes of the float arrays in value (an array or a tuple of them) other than AUDIO_DTYPE/SPECTRUM_DTYPE"""
+    return [
+        array.dtype for array in (value if isinstance(value, (tuple, list)) else (value,))
+        if isinstance(array, np.ndarray) and array.dtype.kind in 'fc'
+        and array.dtype not in (AUDIO_DTYPE, SPECTRUM_DTYPE)
+    ]
+
+def check_dtype_policy(where, value):
+    """
+    Warn when a stage hands on float data other than float32/complex64: an upcast doubles its
+    memory but not its output quality, so it is logged rather than failing the job
+    (tests/test_dtype_policy.py holds the pipeline to the policy strictly)
+    """
+    for dtype in dtype_policy_violations(value):
+        logger.warning(f"{where} produced {dtype} data; the pipeline runs in float32/complex64")
+
+FFT_BLOCK_BYTES = 16 * 1024 * 1024  # Windowed frames handed to one scipy.fft call
+
+class FFTEngine:
+    """
+    STFT/ISTFT on scipy.fft with a configurable worker count, equal to librosa.stft/istft
+    (centered, zero padded). Signals may carry leading channel axes, and stft_many transforms
+    several equally long signals in one call into separately owned spectra. Windows and the
+    ISTFT window-sum envelopes are built once per geometry. workers=None follows app.config['FFT_WORKERS'],
+    or job_workers (set by run_separation_job for the job being run) when that is None as well.
+    """
+
+    def __init__(self, workers=None):
+        self._workers = workers
+        self.job_workers = 1
+
+    @property
+    def workers(self):
+        return self._workers or app.config['FFT_WORKERS'] or self.job_workers
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def window(window, n_fft):
+        return librosa.filters.get_window(window, n_fft, fftbins=True).astype(AUDIO_DTYPE)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=32)
+    def window_sum(window, n_fft, hop_length, n_frames):
+        """Overlap-added squared window, inverted where it is non-zero"""
+        envelope = librosa.filters.window_sumsquare(
+            window=window, n_frames=n_frames, n_fft=n_fft, hop_length=hop_length, dtype=AUDIO_DTYPE
+        )
+        nonzero = envelope > librosa.util.tiny(envelope)
+        envelope[nonzero] = 1 / envelope[nonzero]
+        return envelope
+
+    def _blocks(self, n_frames, frame_bytes):
+        step = max(1, FFT_BLOCK_BYTES // frame_bytes)
+        return (slice(start, min(start + step, n_frames)) for start in range(0, n_frames, step))
+
+    def stft(self, y, n_fft=2048, hop_length=None, window='hann'):
+        hop_length = hop_length or n_fft // 4
+        spectrum = np.empty(y.shape[:-1] + (n_fft // 2 + 1, 1 + y.shape[-1] // hop_length), dtype=SPECTRUM_DTYPE)
+        self._stft(y, n_fft, hop_length, window, [spectrum])
+        return spectrum
+
+    def stft_many(self, signals, n_fft=2048, hop_length=None, window='hann'):
+        """STFTs of equally long 1-D signals, batched through one multi-channel transform"""
+        hop_length = hop_length or n_fft // 4
+        spectra = [
+            np.empty((n_fft // 2 + 1, 1 + len(signals[0]) // hop_length), dtype=SPECTRUM_DTYPE) for _ in signals
+        ]
+        self._stft(np.stack(signals), n_fft, hop_length, window, spectra)
+        return spectra
+
+    def _stft(self, y, n_fft, hop_length, window, outputs):
+        # outputs holds one array for the whole of y, or one per row of a 2-D y
+        from scipy import fft
+        padding = [(0, 0)] * (y.ndim - 1) + [(n_fft // 2, n_fft // 2)]
+        frames = librosa.util.frame(np.pad(y, padding), frame_length=n_fft, hop_length=hop_length)
+        fft_window = self.window(window, n_fft)[:, np.newaxis]
+        
+        channels = int(np.prod(y.shape[:-1]))
+        for block in self._blocks(frames.shape[-1], channels * n_fft * frames.itemsize):
+            spectrum = fft.rfft(fft_window * frames[..., block], axis=-2, workers=self.workers)
+            if len(outputs) == 1:
+                outputs[0][..., block] = spectrum
+            else:
+                for output, channel in zip(outputs, spectrum):
+                    output[:, block] = channel
+
+    def istft(self, stft_matrix, hop_length=None, length=None, window='hann'):
+        from scipy import fft
+        n_fft = 2 * (stft_matrix.shape[-2] - 1)
+        hop_length = hop_length or n_fft // 4
+        n_frames = stft_matrix.shape[-1]
+        if length:
+            n_frames = min(n_frames, int(np.ceil((length + 2 * (n_fft // 2)) / hop_length)))
+        ifft_window = self.window(window, n_fft)[:, np.newaxis]
+        
+        # Overlap-add into the padded signal; frames stride-apart by whole windows never overlap,
+        # so each residue class of frames is added with one vectorized slice
+        padded = np.zeros(stft_matrix.shape[:-2] + (n_fft + hop_length * (n_frames - 1),), dtype=AUDIO_DTYPE)
+        channels = int(np.prod(stft_matrix.shape[:-2]))
+        stride = n_fft // hop_length if n_fft % hop_length == 0 else None
+        for block in self._blocks(n_frames, channels * n_fft * 4):
+            frames = ifft_window * fft.irfft(stft_matrix[..., block], n=n_fft, axis=-2, workers=self.workers)
+            first = block.start
+            if stride is None:
+                for index in range(frames.shape[-1]):
+                    start = (first + index) * hop_length
+                    padded[..., start:start + n_fft] += frames[..., index]
+                continue
+            for residue in range(min(stride, frames.shape[-1])):
+                run = frames[..., residue::stride]
+                start = (first + residue) * hop_length
+                padded[..., start:start + run.shape[-1] * n_fft] += np.swapaxes(run, -1, -2).reshape(
+                    run.shape[:-2] + (-1,)
+                )
+        padded *= self.window_sum(window, n_fft, hop_length, n_frames)
+        
+        y = padded[..., n_fft // 2:]
+        if length is None:
+            return y[..., :padded.shape[-1] - 2 * (n_fft // 2)]
+        return librosa.util.fix_length(y, size=length)
+
+fft_engine = FFTEngine()
+
+def sliding_median(padded, rows, cols, out, row_start, row_stop):
+    """Plain-Python source of the MedianEngine kernel; call the compiled sliding_median_kernel()"""
+    # out[i, j] = median of padded[i:i + rows, j:j + cols]; a sorted copy of the window is
+    # updated in place as it slides along the row, one outgoing/incoming pair per kernel row
+    size = rows * cols
+    rank = size // 2
+    window = np.empty(size, dtype=padded.dtype)
+    for i in range(row_start, row_stop):
+        for r in range(rows):
+            window[r * cols:(r + 1) * cols] = padded[i + r, :cols]
+        window.sort()
+        out[i, 0] = window[rank]
+        for j in range(1, out.shape[1]):
+            for r in range(rows):
+                old = padded[i + r, j - 1]
+                new = padded[i + r, j + cols - 1]
+                if old == new:
+                    continue
+                p = np.searchsorted(window, old)
+                if new > old:
+                    while p + 1 < size and window[p + 1] < new:
+                        window[p] = window[p + 1]
+                        p += 1
+                else:
+                    while p > 0 and window[p - 1] > new:
+                        window[p] = window[p - 1]
+                        p -= 1
+                window[p] = new
+            out[i, j] = window[rank]
+
+@functools.lru_cache(maxsize=1)
+def sliding_median_kernel():
+    """
+    sliding_median compiled on first use, so numba stays out of the import path. It is not cached
+    on disk: numba's cache records the name the module was imported under, which differs between
+    `python app-professional.py` and benchmark.py's loader, and a mismatched entry fails to load.
+    """
+    import numba
+    return numba.njit(nogil=True)(sliding_median)
+
+class MedianEngine:
+    """
+    2-D median filters and HPSS for spectrogram-sized arrays, equal to scipy.ndimage.median_filter
+    (mode='reflect') and librosa.decompose.hpss. A sorted window slides along each row, so a
+    (rows, cols) kernel costs O(rows * cols) per output instead of a fresh selection, and row tiles
+    run on workers threads (the compiled kernel releases the GIL). Kernels taller than they are
+    wide slide down columns instead. workers=None follows app.config['MEDIAN_WORKERS'], or the FFT
+    engine's worker count when that is None as well.
+    """
+
+    def __init__(self, workers=None):
+        self._workers = workers
+
+    @property
+    def workers(self):
+        return self._workers or app.config['MEDIAN_WORKERS'] or fft_engine.workers
+
+    def median_filter(self, x, size):
+        rows, cols = size
+        if rows > cols:
+            return np.ascontiguousarray(self.median_filter(np.ascontiguousarray(x.T), (cols, rows)).T)
+        
+        if rows // 2 >= x.shape[0] or cols // 2 >= x.shape[1]:
+            # Kernels longer than the array reflect more than once, which only scipy reproduces
+            from scipy.ndimage import median_filter
+            return median_filter(x, size=size, mode='reflect')
+        
+        # scipy's 'reflect' repeats the edge sample, which is numpy's 'symmetric'
+        padded = np.pad(
+            x, ((rows // 2, rows - 1 - rows // 2), (cols // 2, cols - 1 - cols // 2)), mode='symmetric'
+        )
+        out = np.empty(x.shape, dtype=x.dtype)
+        if x.size == 0:
+            return out
+        kernel = sliding_median_kernel()
+        tile = max(1, math.ceil(x.shape[0] / (4 * self.workers)))
+        bounds = [(start, min(start + tile, x.shape[0])) for start in range(0, x.shape[0], tile)]
+        if self.workers == 1 or len(bounds) == 1:
+            kernel(padded, rows, cols, out, 0, x.shape[0])
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                list(executor.map(lambda bound: kernel(padded, rows, cols, out, *bound), bounds))
+        return out
+
+    def hpss(self, stft_matrix, kernel_size, magnitude=None, decimation=1, components=('harmonic', 'percussive')):
+        """
+        Harmonic/percussive spectra as librosa.decompose.hpss(stft_matrix, kernel_size) computes them.
+        Pass the magnitude when several decompositions share one spectrogram. decimation > 1
+        approximates the longer medians on every decimation-th frame (harmonic) or bin (percussive)
+        with a kernel shortened to match, then holds each result over the skipped samples; kernels
+        too short to keep their shape after shortening stay exact.
+        """
+        if magnitude is None:
+            magnitude = np.abs(stft_matrix)
+        win_harm, win_perc = kernel_size
+        harm = self._decimated_median(magnitude, (1, win_harm), decimation)
+        perc = self._decimated_median(magnitude, (win_perc, 1), decimation)
+        
+        # librosa.util.softmask with power 2 and split zeros
+        scale = np.maximum(harm, perc)
+        silent = scale < np.finfo(scale.dtype).tiny
+        scale[silent] = 1
+        harm /= scale
+        perc /= scale
+        np.square(harm, out=harm)
+        np.square(perc, out=perc)
+        total = harm + perc
+        total[silent] = 1
+        masks = {'harmonic': harm, 'percussive': perc}
+        spectra = []
+        for component in components:
+            mask = masks[component]
+            mask /= total
+            mask[silent] = 0.5
+            spectra.append(stft_matrix * mask)
+        return tuple(spectra)
+
+    def _decimated_median(self, x, size, decimation):
+        axis = 1 if size[1] > 1 else 0
+        if decimation == 1 or size[axis] < 4 * decimation:
+            return self.median_filter(x, size)
+        step = [slice(None), slice(None)]
+        step[axis] = slice(None, None, decimation)
+        short = list(size)
+        short[axis] = max(1, round(size[axis] / decimation)) | 1
+        coarse = self.median_filter(np.ascontiguousarray(x[tuple(step)]), tuple(short))
+        return np.repeat(coarse, decimation, axis=axis)[:x.shape[0], :x.shape[1]]
+
+median_engine = MedianEngine()
+
+class SpectralCache:
+    """
+    Per-job STFT cache keyed by (signal, n_fft, hop_length, window).
+    Signals are registered under a name the first time they are transformed;
+    every stage of one separation shares the same instance, and release() drops
+    a signal's spectra at one resolution once no stage will read them again.
+    """
+
+    def __init__(self):
+        self._signals = {}
+        self._spectra = {}
+        self._magnitudes = {}
+        self.hits = 0
+        self.misses = 0
+        self.released = 0
+        self.peak_bytes = 0
+
+    def _register(self, name, y):
+        if y is not None:
+            check_dtype_policy(f"Signal '{name}'", y)
+            registered = self._signals.setdefault(name, y)
+            if registered is not y:
+                raise ValueError(f"Spectral cache signal '{name}' is already bound to a different array")
+        elif name not in self._signals:
+            raise KeyError(f"Spectral cache has no signal named '{name}'")
+
+    def stft(self, name, y=None, n_fft=2048, hop_length=512, window='hann'):
+        """Return the complex STFT of the named signal, computing it at most once"""
+        return self.stft_many({name: y}, n_fft, hop_length, window)[0]
+
+    def stft_many(self, signals, n_fft=2048, hop_length=512, window='hann'):
+        """
+        STFTs of several named signals ({name: array or None}), in order. Equally long
+        signals that are not cached yet are transformed together in one multi-channel call.
+        """
+        for name, y in signals.items():
+            self._register(name, y)
+        keys = [(name, n_fft, hop_length, window) for name in signals]
+        missing = [key for key in keys if key not in self._spectra]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        
+        by_length = {}
+        for key in missing:
+            by_length.setdefault(len(self._signals[key[0]]), []).append(key)
+        for group in by_length.values():
+            if len(group) == 1:
+                self._spectra[group[0]] = fft_engine.stft(self._signals[group[0][0]], n_fft, hop_length, window)
+            else:
+                spectra = fft_engine.stft_many([self._signals[key[0]] for key in group], n_fft, hop_length, window)
+                self._spectra.update(zip(group, spectra))
+        if missing:
+            self._track_peak()
+        return [self._spectra[key] for key in keys]
+
+    def magnitude(self, name, y=None, n_fft=2048, hop_length=512, window='hann'):
+        """Magnitude of a cached STFT, computed once for every stage that filters it"""
+        spectrum = self.stft(name, y, n_fft, hop_length, window)
+        key = ('magnitude', name, n_fft, hop_length, window)
+        if key not in self._magnitudes:
+            self._magnitudes[key] = np.abs(spectrum)
+            self._track_peak()
+        return self._magnitudes[key]
+
+    def release(self, name, n_fft):
+        """Drop the spectra and magnitudes of a signal at one resolution, and the signal once none are left"""
+        for key in [key for key in self._spectra if key[:2] == (name, n_fft)]:
+            del self._spectra[key]
+            self.released += 1
+        for key in [key for key in self._magnitudes if key[1:3] == (name, n_fft)]:
+            del self._magnitudes[key]
+        if not any(key[0] == name for key in self._spectra):
+            self._signals.pop(name, None)
+
+    def cached_bytes(self):
+        return sum(a.nbytes for a in self._spectra.values()) + sum(a.nbytes for a in self._magnitudes.values())
+
+    def _track_peak(self):
+        self.peak_bytes = max(self.peak_bytes, self.cached_bytes())
+
+    def report(self):
+        """Hit/miss summary for the job log"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'signals': len(self._signals),
+            'spectra': len(self._spectra),
+            'released': self.released,
+            'cached_mb': round(self.cached_bytes() / 1e6, 1),
+            'peak_mb': round(self.peak_bytes / 1e6, 1)
+        }
+
+def hpss_from_spectrogram(stft_matrix, kernel_size, length, hop_length=512, components=('harmonic', 'percussive'),
+                          magnitude=None, decimation=1):
+    """
+    Harmonic-percussive separation of a precomputed STFT, inverting only the requested components.
+    magnitude and decimation are passed to MedianEngine.hpss.
+    """
+    spectra = median_engine.hpss(stft_matrix, kernel_size, magnitude, decimation, components)
+    return tuple(fft_engine.istft(spectrum, hop_length=hop_length, length=length) for spectrum in spectra)
+
+def compute_vocal_confidence_mask(center_mag, sides_mag, left_mag, right_mag, vocal_low_bin, vocal_high_bin,
+                                  running_stats=None):
+    """Voice-preserving vocal confidence mask computed over all bins at once"""
+    freq_bins = center_mag.shape[0]
+    vocal_mask = np.zeros_like(center_mag)
+    high_bin = min(vocal_high_bin, freq_bins)
+    if high_bin <= vocal_low_bin:
+        return vocal_mask
+
+    band = slice(vocal_low_bin, high_bin)
+    energy_center = center_mag[band]
+    energy_sides = sides_mag[band]
+    energy_left = left_mag[band]
+    energy_right = right_mag[band]
+
+    # 1. Center dominance, smoothed along time only (one 2D filter instead of one per bin)
+    center_dominance = median_engine.median_filter(energy_center / (energy_sides + 1e-8), (1, 7))
+
+    # 2. Stereo correlation (vocals have high L-R correlation)
+    stereo_correlation = (energy_left * energy_right) / (energy_left + energy_right + 1e-8)
+
+    # 3. Temporal consistency per bin, broadcast over time
+    if running_stats is not None:
+        center_mean, center_std = running_stats.mean_std('center_consistency', energy_center)
+    else:
+        center_mean = np.mean(energy_center, axis=1, keepdims=True)
+        center_std = np.std(energy_center, axis=1, keepdims=True)
+    center_consistency = 1 - center_std / (center_mean + 1e-8)
+    center_consistency = np.clip(center_consistency, 0, 1)
+
+    # 4. Spectral continuity against neighbouring bins (first bin of the band has no lower neighbour)
+    spectral_smoothness = np.ones_like(energy_center)
+    inner_end = min(high_bin, freq_bins - 1)
+    if inner_end > vocal_low_bin + 1:
+        inner = energy_center[1:inner_end - vocal_low_bin]
+        neighbours = (center_mag[vocal_low_bin:inner_end - 1] + center_mag[vocal_low_bin + 2:inner_end + 1]) / 2
+        spectral_smoothness[1:inner_end - vocal_low_bin] = np.clip(
+            1 - abs(inner - neighbours) / (inner + 1e-8), 0, 1
+        )
+
+    vocal_confidence = (
+        np.clip((center_dominance - 1.8) / 3.5, 0, 1) * 0.35 +
+        np.clip(stereo_correlation - 0.2, 0, 1) * 0.25 +
+        center_consistency * 0.25 +
+        spectral_smoothness * 0.15
+    )
+    vocal_mask[band] = np.clip(vocal_confidence - 0.3, 0, 1)
+    return vocal_mask
+
+def formant_boost_gains(freq_bins, nyquist, formant_freqs=(900, 1300, 2500), boost_range=12):
+    """Per-bin Gaussian formant boost factors (1.0 outside the boosted regions)"""
+    gains = np.ones(freq_bins, dtype=AUDIO_DTYPE)
+    bins = np.arange(freq_bins)
+    for formant in formant_freqs:
+        if formant < nyquist * 0.7:
+            formant_bin = int(formant * freq_bins / nyquist)
+            if formant_bin < freq_bins:
+                start_bin = max(0, formant_bin - boost_range)
+                end_bin = min(freq_bins, formant_bin + boost_range)
+                b = bins[start_bin:end_bin]
+                gains[start_bin:end_bin] *= 1.0 + 0.3 * np.exp(-((b - formant_bin) / 6) ** 2)
+    return gains
+
+def apply_pitch_harmonics(vocal_mask, f0, nyquist, n_harmonics=3, floor=0.5):
+    """Scatter-max a floor value into the mask at the first harmonics of each voiced frame"""
+    freq_bins, n_frames = vocal_mask.shape
+    frames = np.arange(len(f0))
+    voiced = ~np.isnan(f0) & (f0 > 0) & (frames < n_frames)
+    if not np.any(voiced):
+        return vocal_mask
+    harm_freqs = f0[voiced, None] * np.arange(1, n_harmonics + 1)
+    harm_frames = np.broadcast_to(frames[voiced, None], harm_freqs.shape)
+    in_range = harm_freqs < nyquist * 0.7
+    harm_bins = (harm_freqs[in_range] * freq_bins / nyquist).astype(int)
+    harm_frames = harm_frames[in_range]
+    keep = harm_bins < freq_bins
+    np.maximum.at(vocal_mask, (harm_bins[keep], harm_frames[keep]), floor)
+    return vocal_mask
+
+def spectral_subtraction_gains(vocals_mag, instrumental_mag, nyquist):
+    """Frequency-dependent suppression gains for the vocal magnitude spectrogram"""
+    freq_bins = vocals_mag.shape[0]
+    freq_hz = np.arange(freq_bins) * nyquist / freq_bins
+    gains = np.ones_like(vocals_mag)
+
+    # Within vocal range - preserve vocals, gentle music suppression where instrumental dominates
+    vocal_rows = (freq_hz >= 120) & (freq_hz <= 6000)
+    vocal_energy = vocals_mag[vocal_rows]
+    instrumental_energy = instrumental_mag[vocal_rows]
+    subtraction_factor = np.minimum(
+        0.4,
+        instrumental_energy / (vocal_energy + instrumental_energy + 1e-8)
+    )
+    strong_instrumental = instrumental_energy > vocal_energy * 2
+    gains[vocal_rows] = 1 - subtraction_factor * 0.3 * strong_instrumental
+
+    # Below vocal range - moderate removal; above - gentle suppression
+    gains[freq_hz < 120] = 0.3
+    gains[freq_hz > 6000] = 0.6
+    return gains
+
+class RunningSpectralStats:
+    """
+    Per-bin spectrogram statistics accumulated over the windows of one track, so that
+    windowed separation uses whole-track estimates instead of per-window ones.
+    """
+
+    def __init__(self):
+        self._moments = {}
+        self._percentiles = {}
+
+    def mean_std(self, key, mag):
+        """Running per-bin mean and standard deviation over every frame seen so far"""
+        frames = mag.shape[1]
+        total, total_sq, count = self._moments.get(key, (0.0, 0.0, 0))
+        total = total + np.sum(mag, axis=1, keepdims=True, dtype=np.float64)
+        total_sq = total_sq + np.sum(np.square(mag, dtype=np.float64), axis=1, keepdims=True)
+        count += frames
+        self._moments[key] = (total, total_sq, count)
+        mean = total / count
+        std = np.sqrt(np.maximum(total_sq / count - mean ** 2, 0))
+        return mean.astype(mag.dtype), std.astype(mag.dtype)
+
+    def percentile(self, key, mag, q):
+        """Frame-weighted running average of per-window, per-bin percentiles"""
+        current = np.percentile(mag, q, axis=1, keepdims=True).astype(mag.dtype)
+        frames = mag.shape[1]
+        estimate, count = self._percentiles.get(key, (current, 0))
+        estimate = (estimate * count + current * frames) / (count + frames)
+        self._percentiles[key] = (estimate, count + frames)
+        return estimate
+
+def spike_suppression_mask(vocals_mag, size=5, threshold=4.0):
+    """True where a bin is not an obvious spike above its temporal median"""
+    median_energy = median_engine.median_filter(vocals_mag, (1, size))
+    return vocals_mag < median_energy * threshold
+
+def ica_vocal_source_search(stereo_data, sr, vocal_low_bin, vocal_high_bin, f0_max, spectral_cache,
+                            trials=ICA_TRIALS, fit_samples=ICA_FIT_SAMPLES):
+    """
+    Multi-trial ICA search for the most vocal-like source of a (high-passed) stereo pair.
+    Each trial fits its unmixing matrix on a random subset of samples and the trials run in
+    parallel. Every ICA source is a linear combination of the two channels, so candidate
+    spectra, frame energies and the half-rate signals used for pitch tracking are combined
+    from per-channel features computed once instead of being recomputed per source.
+    Returns (best_source, best_score); best_source is None when no trial succeeded.
+    """
+    from scipy import signal
+    from sklearn.decomposition import FastICA
+    n_samples = stereo_data.shape[1]
+    nyquist = sr / 2
+    
+    def fit_trial(trial):
+        ica = FastICA(
+            n_components=2,
+            random_state=42 + trial,
+            max_iter=2000,
+            tol=1e-4,
+            fun='logcosh',  # Better for audio
+            whiten='unit-variance'
+        )
+        samples = stereo_data.T
+        if n_samples > fit_samples:
+            rng = np.random.default_rng(42 + trial)
+            samples = samples[np.sort(rng.choice(n_samples, fit_samples, replace=False))]
+        ica.fit(samples)
+        # source = components . (x - mean) = components . x - offset
+        return ica.components_, ica.components_ @ ica.mean_
+    
+    # Shared per-channel representation ('ones' carries the constant offset term)
+    ones = np.ones(n_samples, dtype=stereo_data.dtype)
+    channels = {'ica_left': stereo_data[0], 'ica_right': stereo_data[1], 'ica_ones': ones}
+    spectra = spectral_cache.stft_many(channels, n_fft=2048)
+    
+    # Frame energies framed like librosa.feature.rms (centered, zero padded)
+    padded = [np.pad(y, 1024, mode='constant') for y in channels.values()]
+    cross_power = {
+        (i, j): np.mean(librosa.util.frame(padded[i] * padded[j], frame_length=2048, hop_length=512), axis=0)
+        for i in range(3) for j in range(i, 3)
+    }
+    del padded
+    
+    # Pitch only needs the band below f0_max, so it is tracked at half rate when possible
+    pitch_factor = 2 if f0_max * 4 < nyquist else 1
+    pitch_sr = sr / pitch_factor
+    half_rate = [
+        signal.resample_poly(y, 1, pitch_factor) if pitch_factor > 1 else y
+        for y in channels.values()
+    ]
+    
+    def score_source(weights):
+        # Spectral analysis (summed in place: the trials run in parallel and each spectrum is large)
+        source_stft = weights[0] * spectra[0]
+        for w, S in zip(weights[1:], spectra[1:]):
+            source_stft += w * S
+        source_mag = np.abs(source_stft)
+        del source_stft
+        
+        # 1. Vocal frequency range energy (key indicator)
+        vocal_energy = np.mean(source_mag[vocal_low_bin:vocal_high_bin, :])
+        
+        # 2. Spectral centroid in vocal range (vocal brightness)
+        vocal_centroid = np.mean(librosa.feature.spectral_centroid(
+            S=source_mag[vocal_low_bin:vocal_high_bin, :], sr=sr
+        ))
+        
+        # 3. Temporal stability (vocals are more consistent)
+        power = sum(
+            weights[i] * weights[j] * (1 if i == j else 2) * cross_power[(i, j)]
+            for i, j in cross_power
+        )
+        rms_energy = np.sqrt(np.maximum(power, 0))
+        temporal_stability = 1 - (np.std(rms_energy) / (np.mean(rms_energy) + 1e-8))
+        
+        # 4. Pitch consistency (vocals have more consistent pitch)
+        try:
+            source_low = sum(w * y for w, y in zip(weights, half_rate))
+            f0_source = librosa.yin(
+                source_low, fmin=120, fmax=f0_max, sr=pitch_sr, threshold=0.2,
+                frame_length=2048 // pitch_factor
+            )
+            valid_f0 = f0_source[~np.isnan(f0_source)]
+            if len(valid_f0) > 0:
+                pitch_consistency = 1 - (np.std(valid_f0) / (np.mean(valid_f0) + 1e-8))
+            else:
+                pitch_consistency = 0
+        except:
+            pitch_consistency = 0
+        
+        # 5. Formant presence (check for vocal formants)
+        formant_score = 0
+        for formant in [900, 1300, 2500]:
+            if formant < nyquist * 0.7:
+                formant_bin = int(formant * source_mag.shape[0] / (sr/2))
+                if formant_bin < source_mag.shape[0]:
+                    formant_energy = np.mean(source_mag[formant_bin-2:formant_bin+3, :])
+                    surrounding_energy = np.mean(source_mag[max(0, formant_bin-10):formant_bin-5, :])
+                    if surrounding_energy > 0:
+                        formant_score += formant_energy / surrounding_energy
+        
+        # Composite vocal score with strict weighting
+        return (
+            vocal_energy * 0.35 +
+            (vocal_centroid / 3000) * 0.20 +  # Normalize centroid
+            temporal_stability * 0.20 +
+            pitch_consistency * 0.15 +
+            min(formant_score / 3, 1.0) * 0.10
+        )
+    
+    def run_trial(trial):
+        components, offsets = fit_trial(trial)
+        candidates = []
+        for idx in range(components.shape[0]):
+            weights = (components[idx, 0], components[idx, 1], -offsets[idx])
+            candidates.append((score_source(weights), weights))
+        return candidates
+    
+    with ThreadPoolExecutor(max_workers=trials) as executor:
+        results = list(executor.map(run_trial, range(trials)))
+    
+    # Same order and strict comparison as a sequential search, so ties resolve identically
+    best_vocal_score = -1
+    best_weights = None
+    for candidates in results:
+        for vocal_score, weights in candidates:
+            if vocal_score > best_vocal_score:
+                best_vocal_score = vocal_score
+                best_weights = weights
+    
+    if best_weights is None:
+        return None, best_vocal_score
+    best_vocal_source = (
+        best_weights[0] * stereo_data[0] + best_weights[1] * stereo_data[1] + best_weights[2]
+    ).astype(stereo_data.dtype)
+    return best_vocal_source, best_vocal_score
+
+def wiener_filter(x, size):
+    """
+    scipy.signal.wiener for 1-D signals without its float64 upcast: local mean and
+    variance over a size-sample window, noise power estimated as the mean local variance
+    """
+    from scipy.ndimage import uniform_filter1d
+    local_mean = uniform_filter1d(x, size, mode='constant')
+    local_var = uniform_filter1d(x * x, size, mode='constant') - local_mean ** 2
+    noise = np.mean(local_var)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        filtered = (x - local_mean) * (1 - noise / local_var) + local_mean
+    return np.where(local_var < noise, local_mean, filtered)
+
+class StatefulSOSFilter:
+    """
+    sosfilt wrapper that optionally keeps per-call filter state in a dict.
+    Calls are keyed by their order, so a fixed filter chain applied block by block
+    produces the same output as one pass over the whole signal.
+    """
+
+    def __init__(self, state=None):
+        self.state = state
+        self.step = 0
+
+    def __call__(self, sos, x):
+        from scipy import signal
+        if self.state is None:
+            return signal.sosfilt(sos, x)
+        key = self.step
+        self.step += 1
+        zi = self.state.get(key)
+        if zi is None:
+            zi = np.zeros((sos.shape[0], 2))
+        y, self.state[key] = signal.sosfilt(sos, x, zi=zi)
+        return y
+
+def design_professional_eq(sr, track_type):
+    """
+    Professional EQ curve for each track type as an ordered list of filter stages:
+    ('series', sos) replaces the signal with its filtered version,
+    ('parallel', sos, gain) adds gain times the filtered signal back onto it.
+    """
+    from scipy import signal
+    stages = []
+    if track_type == 'vocals':
+        # Ultra-aggressive Vocal EQ: Maximum isolation and presence
+        nyquist = sr / 2
+        
+        # 1. Aggressive high-pass filter to remove all low-frequency music bleed
+        hp_freq = min(150, nyquist * 0.9)  # Higher cutoff to remove bass/drums
+        sos1 = signal.butter(6, hp_freq, btype='high', fs=sr, output='sos')  # Steeper filter
+        stages.append(('series', sos1))
+        
+        # 2. Ultra-aggressive de-ess and harsh frequency removal
+        if nyquist > 6000:
+            # Remove harsh frequencies that are often instrumental
+            harsh_low = min(4000, nyquist * 0.6)
+            harsh_high = min(6000, nyquist * 0.8)
+            sos_harsh = signal.butter(4, [harsh_low, harsh_high], btype='band', fs=sr, output='sos')
+            stages.append(('parallel', sos_harsh, -0.6))  # Remove 60% of harsh content
+        
+        if nyquist > 8000:
+            # De-ess filter (reduce sibilants and cymbal bleed)
+            deess_low = min(6000, nyquist * 0.7)
+            deess_high = min(8000, nyquist * 0.85)
+            sos_deess = signal.butter(3, [deess_low, deess_high], btype='band', fs=sr, output='sos')
+            stages.append(('parallel', sos_deess, -0.5))  # Aggressive sibilant reduction
+        
+        # 3. Ultra-focused vocal presence boost (very narrow bands)
+        # Primary vocal clarity: 1.2-2.5kHz (speech intelligibility)
+        pres_low_start = min(1200, nyquist * 0.35)
+        pres_low_end = min(2500, nyquist * 0.55)
+        if pres_low_end > pres_low_start:
+            sos2 = signal.butter(3, [pres_low_start, pres_low_end], btype='band', fs=sr, output='sos')
+            stages.append(('parallel', sos2, 0.4))  # Strong boost
+        
+        # Secondary presence: 2.5-4kHz (vocal brightness)
+        if nyquist > 4000:
+            pres_high_start = min(2500, nyquist * 0.5)
+            pres_high_end = min(4000, nyquist * 0.7)
+            if pres_high_end > pres_high_start:
+                sos3 = signal.butter(2, [pres_high_start, pres_high_end], btype='band', fs=sr, output='sos')
+                stages.append(('parallel', sos3, 0.3))
+        
+        # 4. Conservative warmth (avoid muddy instruments)
+        warmth_start = min(300, nyquist * 0.15)  # Higher than before
+        warmth_end = min(600, nyquist * 0.3)     # Narrower range
+        if warmth_end > warmth_start:
+            sos4 = signal.butter(1, [warmth_start, warmth_end], btype='band', fs=sr, output='sos')
+            stages.append(('parallel', sos4, 0.15))  # Moderate boost to avoid muddiness
+        
+        # 5. Minimal air (to avoid cymbal bleed)
+        if nyquist > 10000:
+            air_start = min(9000, nyquist * 0.75)   # Higher start frequency
+            air_end = min(12000, nyquist * 0.9)
+            if air_end > air_start:
+                sos5 = signal.butter(1, [air_start, air_end], btype='band', fs=sr, output='sos')
+                stages.append(('parallel', sos5, 0.05))  # Very conservative air
+        
+        # 6. Conservative notch filters for only the most problematic frequencies
+        # Remove only major guitar/piano fundamentals that clearly interfere
+        problem_freqs = [220, 440, 880]  # Just the most common problematic frequencies
+        for freq in problem_freqs:
+            if freq < nyquist * 0.8 and freq > 200:  # Narrower range
+                Q = 20  # Lower Q for gentler notching
+                try:
+                    sos_notch = signal.iirnotch(freq, Q, fs=sr, output='sos')
+                    stages.append(('series', sos_notch))
+                except:
+                    pass
+        
+        # 7. Gentle low-mid adjustment (preserve vocal body)
+        low_mid_start = min(250, nyquist * 0.1)  # Higher start to preserve vocal body
+        low_mid_end = min(350, nyquist * 0.2)    # Narrower range
+        if low_mid_end > low_mid_start:
+            sos_low_mid = signal.butter(1, [low_mid_start, low_mid_end], btype='band', fs=sr, output='sos')
+            stages.append(('parallel', sos_low_mid, -0.15))  # Much gentler cut
+        
+        # 8. Gentle final high-pass to remove only very low frequencies
+        hp_final = min(100, nyquist * 0.8)  # Lower frequency to preserve vocal fundamentals
+        sos_final = signal.butter(2, hp_final, btype='high', fs=sr, output='sos')  # Gentler slope
+        stages.append(('series', sos_final))
+    
+    elif track_type == 'bass':
+        # Professional Bass EQ: Deep, tight, and punchy (sample rate adaptive)
+        nyquist = sr / 2
+        
+        # 1. Remove sub-sonic rumble
+        hp_freq = min(25, nyquist * 0.05)
+        sos1 = signal.butter(4, hp_freq, btype='high', fs=sr, output='sos')
+        stages.append(('series', sos1))
+        
+        # 2. Bass fundamental boost (40-120Hz)
+        bass_low = min(40, nyquist * 0.1)
+        bass_high = min(120, nyquist * 0.3)
+        if bass_high > bass_low:
+            sos2 = signal.butter(2, [bass_low, bass_high], btype='band', fs=sr, output='sos')
+            stages.append(('parallel', sos2, 0.3))
+        
+        # 3. Bass presence (120-300Hz)
+        if nyquist > 300:
+            pres_low = min(120, nyquist * 0.2)
+            pres_high = min(300, nyquist * 0.4)
+            sos3 = signal.butter(2, [pres_low, pres_high], btype='band', fs=sr, output='sos')
+            stages.append(('parallel', sos3, 0.2))
+        
+        # 4. Low-pass to remove high frequency bleed
+        lp_freq = min(400, nyquist * 0.6)
+        sos4 = signal.butter(6, lp_freq, btype='low', fs=sr, output='sos')
+        stages.append(('series', sos4))
+    
+    elif track_type == 'drums':
+        # Professional Drum EQ: Punch, attack, and clarity (sample rate adaptive)
+        nyquist = sr / 2
+        
+        # 1. Clean up sub-bass
+        hp_freq = min(50, nyquist * 0.1)
+        sos1 = signal.butter(4, hp_freq, btype='high', fs=sr, output='sos')
+        stages.append(('series', sos1))
+        
+        # 2. Kick drum punch (60-120Hz)
+        kick_low = min(60, nyquist * 0.15)
+        kick_high = min(120, nyquist * 0.25)
+        if kick_high > kick_low:
+            sos2 = signal.butter(2, [kick_low, kick_high], btype='band', fs=sr, output='sos')
+            stages.append(('parallel', sos2, 0.25))
+        
+        # 3. Snare body (150-400Hz)
+        if nyquist > 400:
+            snare_low = min(150, nyquist * 0.3)
+            snare_high = min(400, nyquist * 0.5)
+            sos3 = signal.butter(2, [snare_low, snare_high], btype='band', fs=sr, output='sos')
+            stages.append(('parallel', sos3, 0.15))
+        
+        # 4. Snare crack (2-6kHz)
+        if nyquist > 6000:
+            crack_low = min(2000, nyquist * 0.4)
+            crack_high = min(6000, nyquist * 0.7)
+            sos4 = signal.butter(2, [crack_low, crack_high], btype='band', fs=sr, output='sos')
+            stages.append(('parallel', sos4, 0.2))
+        
+        # 5. Cymbals and hi-hats (8kHz+)
+        if nyquist > 8000:
+            cymbal_freq = min(8000, nyquist * 0.8)
+            sos5 = signal.butter(2, cymbal_freq, btype='high', fs=sr, output='sos')
+            stages.append(('parallel', sos5, 0.1))
+    
+    elif track_type == 'accompaniment':
+        # Professional Accompaniment EQ: Balanced, warm, and clear (sample rate adaptive)
+        nyquist = sr / 2
+        
+        # 1. Clean low end
+        hp_freq = min(60, nyquist * 0.1)
+        sos1 = signal.butter(2, hp_freq, btype='high', fs=sr, output='sos')
+        stages.append(('series', sos1))
+        
+        # 2. Warmth enhancement (200-600Hz)
+        if nyquist > 600:
+            warm_low = min(200, nyquist * 0.2)
+            warm_high = min(600, nyquist * 0.4)
+            sos2 = signal.butter(2, [warm_low, warm_high], btype='band', fs=sr, output='sos')
+            stages.append(('parallel', sos2, 0.15))
+        
+        # 3. Instrument clarity (1-4kHz)
+        if nyquist > 4000:
+            clarity_low = min(1000, nyquist * 0.3)
+            clarity_high = min(4000, nyquist * 0.6)
+            sos3 = signal.butter(2, [clarity_low, clarity_high], btype='band', fs=sr, output='sos')
+            stages.append(('parallel', sos3, 0.12))
+        
+        # 4. Sparkle (6-10kHz)
+        if nyquist > 10000:
+            sparkle_low = min(6000, nyquist * 0.6)
+            sparkle_high = min(10000, nyquist * 0.8)
+            sos4 = signal.butter(1, [sparkle_low, sparkle_high], btype='band', fs=sr, output='sos')
+            stages.append(('parallel', sos4, 0.08))
+    
+    elif track_type == 'other':
+        # Professional Other/Ambient EQ: Atmospheric and spacious
+        nyquist = sr / 2
+        
+        # 1. Gentle high-pass
+        hp_freq = min(40, nyquist * 0.08)
+        sos1 = signal.butter(2, hp_freq, btype='high', fs=sr, output='sos')
+        stages.append(('series', sos1))
+        
+        # 2. Ambient enhancement (500Hz-2kHz)
+        if nyquist > 2000:
+            amb_low = min(500, nyquist * 0.3)
+            amb_high = min(2000, nyquist * 0.5)
+            sos2 = signal.butter(1, [amb_low, amb_high], btype='band', fs=sr, output='sos')
+            stages.append(('parallel', sos2, 0.1))
+        
+        # 3. High-frequency detail (4kHz+)
+        if nyquist > 4000:
+            detail_freq = min(4000, nyquist * 0.7)
+            sos3 = signal.butter(1, detail_freq, btype='high', fs=sr, output='sos')
+            stages.append(('parallel', sos3, 0.06))
+    
+    return stages
+
+def fold_parallel_stage(sos, gain, tolerance=1e-6):
+    """
+    Single SOS cascade equivalent to x + gain * sosfilt(sos, x), or None when the folded
+    zeros cannot be placed accurately enough.
+    1 + gain * b/a = (a + gain * b) / a keeps the band's poles, so only the zeros are recomputed.
+    """
+    from scipy import signal
+    b, a = signal.sos2tf(sos)
+    _, poles, _ = signal.sos2zpk(sos)
+    numerator = a + gain * b
+    folded = signal.zpk2sos(np.roots(numerator), poles, numerator[0] / a[0])
+    
+    # Check the folded response against the parallel structure it replaces
+    _, expected = signal.sosfreqz(sos, worN=4096)
+    _, actual = signal.sosfreqz(folded, worN=4096)
+    expected = 1 + gain * expected
+    if np.max(np.abs(actual - expected)) > tolerance * np.max(np.abs(expected)):
+        return None
+    return folded
+
+@functools.lru_cache(maxsize=None)
+def eq_filter_bank(sr, track_type):
+    """
+    Precompiled EQ for (sr, track_type): the stages from design_professional_eq with every
+    parallel band folded into its own cascade and consecutive cascades stacked, so a stem is
+    normally equalized by a single sosfilt pass.
+    Returns a tuple of ('series', sos) / ('parallel', sos, gain) passes.
+    """
+    passes = []
+    for stage in design_professional_eq(sr, track_type):
+        if stage[0] == 'parallel':
+            folded = fold_parallel_stage(stage[1], stage[2])
+            if folded is None:
+                passes.append(stage)
+                continue
+            stage = ('series', folded)
+        if passes and passes[-1][0] == 'series':
+            passes[-1] = ('series', np.vstack([passes[-1][1], stage[1]]))
+        else:
+            passes.append(stage)
+    return tuple(passes)
+
+def apply_professional_eq(audio, sr, track_type, state=None):
+    """
+    Apply professional EQ curves for each track type.
+    Pass the same state dict for consecutive blocks of one stream to carry filter memory across them.
+    The cascade runs in float64 (the low shelves put poles too close to the unit circle for
+    float32 coefficients) and the result is cast back to the input dtype.
+    """
+    sosfilt = StatefulSOSFilter(state)
+    equalized = audio.astype(np.float64)
+    for stage in eq_filter_bank(sr, track_type):
+        if stage[0] == 'series':
+            equalized = sosfilt(stage[1], equalized)
+        else:
+            equalized = equalized + sosfilt(stage[1], equalized) * stage[2]
+    return equalized.astype(audio.dtype)
+
+def apply_dynamics(audio, track_type):
+    """Apply gentle dynamics processing"""
+    if track_type in ['vocals', 'drums']:
+        # Gentle compression
+        threshold = 0.7
+        ratio = 3.0
+        makeup = 1.1
+        
+        abs_audio = np.abs(audio)
+        compressed = np.where(
+            abs_audio > threshold,
+            threshold + (abs_audio - threshold) / ratio,
+            abs_audio
+        )
+        audio = np.sign(audio) * compressed * makeup
+    
+    return audio
+
+def normalization_gain(rms, peak):
+    """Gain that brings a track to the target RMS without its peak exceeding 0.95"""
+    gain = 1.0
+    if rms > 0:
+        # Target RMS for -18 LUFS (approximately)
+        target_rms = 0.1
+        gain = target_rms / rms
+        
+    # Peak limiting to prevent clipping
+    if peak * gain > 0.95:
+        gain *= 0.95 / (peak * gain)
+        
+    return gain
+
+def normalize_professional(audio, target_lufs=-18):
+    """Professional normalization with proper headroom"""
+    rms = np.sqrt(np.mean(audio**2))
+    peak = np.max(np.abs(audio))
+    return audio * normalization_gain(rms, peak)
+
+def finish_track(audio, sr, track_type, timings=None):
+    """EQ, dynamics and normalization for one separated stem"""
+    with stage_timer(timings, 'eq', concurrent=True):
+        audio = apply_professional_eq(audio, sr, track_type)
+    with stage_timer(timings, 'dynamics', concurrent=True):
+        audio = apply_dynamics(audio, track_type)
+    with stage_timer(timings, 'normalize', concurrent=True):
+        audio = normalize_professional(audio)
+    check_dtype_policy(f"Post-processing of {track_type}", audio)
+    return audio
+
+def pcm_layout(path):
+    """
+    Where and how the samples of an uncompressed WAV or AIFF file are stored:
+    {'offset', 'dtype', 'width', 'frames', 'channels', 'samplerate'}, or None for anything that
+    can't be memory-mapped (compressed, AIFC, extensible formats other than PCM/float...).
+    """
+    with open(path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12:
+            return None
+        if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+            endian, size_format, layout = '<', '<I', {}
+        elif header[:4] == b'FORM' and header[8:12] == b'AIFF':
+            endian, size_format, layout = '>', '>I', {}
+        else:
+            return None
+        file_size = os.fstat(f.fileno()).st_size
+        
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return None
+            chunk_id, chunk_size = chunk[:4], struct.unpack(size_format, chunk[4:])[0]
+            chunk_start = f.tell()
+            if chunk_id == b'fmt ':
+                fmt = f.read(min(chunk_size, 40))
+                tag, channels, samplerate = struct.unpack('<HHI', fmt[:8])
+                bits = struct.unpack('<H', fmt[14:16])[0]
+                if tag == 0xFFFE and len(fmt) >= 26:
+                    tag = struct.unpack('<H', fmt[24:26])[0]  # Sub-format GUID of WAVE_FORMAT_EXTENSIBLE
+                if tag == 1 and bits in (8, 16, 24, 32):
+                    layout['kind'] = 'u' if bits == 8 else 'i'  # 8-bit WAV is unsigned
+                elif tag == 3 and bits in (32, 64):
+                    layout['kind'] = 'f'
+                else:
+                    return None
+                layout.update(channels=channels, samplerate=samplerate, width=bits // 8)
+            elif chunk_id == b'COMM':
+                channels, frames, bits = struct.unpack('>hIh', f.read(8))
+                exponent, mantissa = struct.unpack('>HQ', f.read(10))  # 80-bit extended float
+                if bits not in (8, 16, 24, 32):
+                    return None
+                layout.update(
+                    kind='i', channels=channels, frames=frames, width=bits // 8,
+                    samplerate=round(mantissa * 2.0 ** ((exponent & 0x7FFF) - 16383 - 63))
+                )
+            elif chunk_id in (b'data', b'SSND'):
+                if 'kind' not in layout:
+                    return None
+                offset = chunk_start
+                if chunk_id == b'SSND':
+                    offset += 8 + struct.unpack('>I', f.read(4))[0]
+                    chunk_size -= 8
+                # Streamed WAVs may leave the data size at 0 or 0xFFFFFFFF
+                data_size = min(chunk_size or file_size, file_size - offset)
+                frame_bytes = layout['width'] * layout['channels']
+                frames = data_size // frame_bytes
+                if 'frames' in layout:
+                    frames = min(frames, layout['frames'])
+                if layout['channels'] < 1 or frames < 0:
+                    return None
+                dtype = endian + layout['kind'] + str(layout['width']) if layout['width'] != 3 else 'u1'
+                return {
+                    'offset': offset, 'dtype': dtype, 'width': layout['width'], 'frames': frames,
+                    'channels': layout['channels'], 'samplerate': layout['samplerate'],
+                    'big_endian': endian == '>'
+                }
+            f.seek(chunk_start + chunk_size + (chunk_size & 1))  # Chunks are padded to even sizes
+
+def pcm_to_float(block, layout):
+    """Scale raw PCM frames to float32 exactly as libsndfile does"""
+    width = layout['width']
+    if width == 3:
+        # Packed 24-bit: assemble the three bytes of each sample into an int32
+        raw = block.reshape(block.shape[0], -1, 3).astype(np.int32)
+        lo, mid, hi = (raw[..., 2], raw[..., 1], raw[..., 0]) if layout['big_endian'] else \
+            (raw[..., 0], raw[..., 1], raw[..., 2])
+        samples = lo | (mid << 8) | (hi << 16)
+        samples = (samples ^ 0x800000) - 0x800000  # Sign-extend
+        return samples.astype(np.float32) * np.float32(2.0 ** -23)
+    if block.dtype.kind == 'f':
+        return block.astype(np.float32)
+    if block.dtype.kind == 'u':
+        return (block.astype(np.float32) - 128) * np.float32(2.0 ** -7)
+    return block.astype(np.float32) * np.float32(2.0 ** (1 - 8 * width))
+
+def decode_audio(path, start=0, frames=None):
+    """
+    Decode audio (optionally frames native-rate frames from start) to float32 at its native rate,
+    shaped like librosa.load(mono=False): (channels, samples), or 1-D for mono. Returns (y, native sr).
+    Uncompressed WAV/AIFF are memory-mapped and converted block by block into a preallocated
+    buffer; other formats libsndfile reads are decoded straight into one; anything else
+    (e.g. AAC) goes through librosa/audioread, which needs the file on disk anyway.
+    """
+    layout = pcm_layout(path)
+    if layout is not None:
+        native_sr = layout['samplerate']
+        stop = layout['frames'] if frames is None else min(layout['frames'], start + frames)
+        start = min(start, stop)
+        raw = np.memmap(
+            path, dtype=layout['dtype'], mode='r', offset=layout['offset'],
+            shape=(layout['frames'], layout['channels'] * (3 if layout['width'] == 3 else 1))
+        ) if layout['frames'] else np.zeros((0, layout['channels']), dtype=np.uint8)
+        y = np.empty((layout['channels'], stop - start), dtype=AUDIO_DTYPE)
+        for block_start in range(start, stop, DECODE_BLOCK_FRAMES):
+            block_stop = min(stop, block_start + DECODE_BLOCK_FRAMES)
+            y[:, block_start - start:block_stop - start] = pcm_to_float(raw[block_start:block_stop], layout).T
+        del raw
+    else:
+        try:
+            with sf.SoundFile(path) as f:
+                native_sr = f.samplerate
+                f.seek(min(start, f.frames))
+                count = f.frames - f.tell() if frames is None else min(frames, f.frames - f.tell())
+                buffer = np.empty((count, f.channels), dtype=AUDIO_DTYPE)
+                f.read(out=buffer)
+            y = buffer.T
+        except sf.SoundFileRuntimeError:
+            native_sr = librosa.get_samplerate(path)
+            y, _ = librosa.load(
+                path, sr=None, mono=False, offset=start / native_sr,
+                duration=frames / native_sr if frames is not None else None
+            )
+            return y, native_sr
+    if y.shape[0] == 1:
+        y = y[0]
+    return y, native_sr
+
+def resample_audio(y, orig_sr, target_sr, res_type='soxr_hq', timings=None):
+    """y resampled along its last axis, measured as the 'resample' stage; returned as is when the rates match"""
+    if orig_sr == target_sr:
+        return y
+    with stage_timer(timings, 'resample'):
+        return librosa.resample(y, orig_sr=orig_sr, target_sr=target_sr, res_type=res_type).astype(AUDIO_DTYPE)
+
+def processing_rate(preset, native_sr, sr=None):
+    """Internal rate for a job: sr (a rate or 'native'), else the preset's"""
+    sr = sr or SEPARATION_PRESETS[preset]['sample_rate']
+    return native_sr if sr == 'native' else sr
+
+def professional_source_separation(audio_file, sr=None, spectral_cache=None, stems=TRACK_NAMES, timings=None,
+                                   preset=DEFAULT_PRESET, chroma=None, output_rate='processing'):
     """
     Professional-grade source separation using advanced signal processing:
     - Independent Component Analysis (ICA)
     - Multi-scale spectral analysis
     - Adaptive filtering
     - Professional audio processing techniques
+    Only the requested stems are computed with the named preset; stage measurements are added to timings.
+    The audio is processed at sr (a rate or 'native'; the preset's rate by default) with the preset's
+    resampler, and the stems are returned at that rate or, for output_rate='native', resynthesized
+    at the upload's rate. Returns (stems, their sample rate).
+    When chroma is a list, a (frame times, harmonic chroma) pair for chord analysis is appended to it
+    if separate_stems computed the chroma.
     """
     logger.info(f"Loading audio file: {audio_file}")
     
-    # Load audio with higher quality
-    y, sr = librosa.load(audio_file, sr=sr, mono=False)
+    with stage_timer(timings, 'load'):
+        y, native_sr = decode_audio(audio_file)
+    res_type = SEPARATION_PRESETS[preset]['resampler']
+    sr = processing_rate(preset, native_sr, sr)
+    y = resample_audio(y, native_sr, sr, res_type, timings)
     
-    # Handle stereo/mono
-    if len(y.shape) > 1:
-        y_left = y[0]
-        y_right = y[1]
-        y_mono = librosa.to_mono(y)
-        is_stereo = True
+    track_chroma = [] if chroma is not None else None
+    stems = separate_stems(y, sr, spectral_cache, stems=stems, timings=timings, preset=preset, chroma=track_chroma)
+    if track_chroma:
+        chroma.append((np.arange(track_chroma[0].shape[1]) * CHROMA_HOP / sr, track_chroma[0]))
+    
+    # 6. Professional post-processing
+    logger.info("Applying professional post-processing...")
+    with stage_timer(timings, 'post_processing'), \
+            ThreadPoolExecutor(max_workers=POST_PROCESSING_THREADS) as executor:
+        futures = {
+            track_name: executor.submit(finish_track, audio, sr, track_name, timings)
+            for track_name, audio in stems.items()
+        }
+        tracks = {track_name: future.result() for track_name, future in futures.items()}
+    
+    if output_rate == 'native' and native_sr != sr:
+        tracks = {
+            track_name: resample_audio(audio, sr, native_sr, res_type, timings)
+            for track_name, audio in tracks.items()
+        }
+        sr = native_sr
+    
+    logger.info("Professional AI separation completed!")
+    return tracks, sr
+
+def ensure_length(audio, target_len):
+    """Trim or zero-pad audio to target_len samples"""
+    if len(audio) < target_len:
+        return np.pad(audio, (0, target_len - len(audio)), mode='constant')
     else:
-        y_mono = y
-        y_left = y_right = y_mono
-        is_stereo = False
+        return audio[:target_len]
+
+def vocal_band(freq_bins, sr):
+    """Vocal bin range and pitch ceiling shared by the stereo mask and the ICA search"""
+    nyquist = sr / 2
+    vocal_low_bin = int(120 * freq_bins / nyquist)    # 120Hz (tighter low cut)
+    vocal_high_bin = int(min(6000, nyquist * 0.7) * freq_bins / nyquist) # 6kHz max (tighter high cut)
+    f0_max = min(350, nyquist * 0.6)
+    return vocal_low_bin, vocal_high_bin, f0_max
+
+def current_rss_bytes():
+    """Resident set size of this process, or None where /proc is unavailable"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def peak_rss_bytes():
+    """Peak resident set size since the last reset_peak_rss(), or None"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+peak_rss_before_reset = 0  # Highest peak RSS wiped by reset_peak_rss()
+
+def reset_peak_rss():
+    """Restart the kernel's peak RSS tracking from the current RSS; False where unsupported"""
+    global peak_rss_before_reset
+    peak = peak_rss_bytes()
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    peak_rss_before_reset = max(peak_rss_before_reset, peak or 0)
+    return True
+
+def process_peak_rss_bytes():
+    """Peak resident set size over the life of the process, across stage resets, or None"""
+    peak = max(peak_rss_before_reset, peak_rss_bytes() or 0)
+    return peak or None
+
+stage_timings_lock = threading.Lock()
+
+@contextmanager
+def stage_timer(timings, name, concurrent=False):
+    """
+    Add the wall time, CPU time and peak memory growth of the block to timings[name]
+    (no-op when timings is None). Repeated stages accumulate time and keep the largest peak.
+    concurrent=True marks blocks that run in several threads at once: CPU time is then the
+    calling thread's own and memory is left to the enclosing stage.
+    """
+    if timings is None:
+        yield
+        return
+    clock = time.thread_time if concurrent else time.process_time
+    start_rss = current_rss_bytes() if not concurrent and reset_peak_rss() else None
+    start_wall, start_cpu = time.perf_counter(), clock()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start_wall
+        cpu = clock() - start_cpu
+        peak = peak_rss_bytes() if start_rss is not None else None
+        with stage_timings_lock:
+            entry = timings.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'peak_memory_bytes': None})
+            entry['wall_seconds'] += wall
+            entry['cpu_seconds'] += cpu
+            if peak is not None:
+                entry['peak_memory_bytes'] = max(entry['peak_memory_bytes'] or 0, peak - start_rss)
+
+def stage_report(timings):
+    """Rounded, JSON-friendly copy of stage timings"""
+    return {
+        name: {
+            'wall_seconds': round(entry['wall_seconds'], 3),
+            'cpu_seconds': round(entry['cpu_seconds'], 3),
+            'peak_memory_mb': round(entry['peak_memory_bytes'] / 1e6, 1)
+            if entry['peak_memory_bytes'] is not None else None
+        }
+        for name, entry in timings.items()
+    }
+
+class StageGraph:
+    """
+    Named pipeline stages with explicit dependencies. get() evaluates a stage after its
+    dependencies and at most once, so only the stages behind the requested outputs run.
+    Each stage is measured into timings with stage_timer, in execution order.
+    Once plan() has counted the consumers of each result and of each spectral cache entry,
+    both are released as soon as their last consumer has run instead of living until the end.
+    """
+
+    def __init__(self, timings=None, cache=None):
+        self.stages = {}
+        self.results = {}
+        self.timings = timings if timings is not None else {}
+        self.cache = cache
+        self.consumers = {}
+        self.readers = {}
+
+    def add(self, name, dependencies, function, reads=()):
+        """
+        Register function(*dependency_results) as stage name. reads lists the (signal, n_fft)
+        spectral cache entries the stage transforms.
+        """
+        self.stages[name] = (tuple(dependencies), function, tuple(reads))
+
+    def needed(self, outputs):
+        """Names of the stages that evaluating outputs runs, outputs included"""
+        needed = set()
+        
+        def visit(name):
+            if name not in needed:
+                needed.add(name)
+                for dependency in self.stages[name][0]:
+                    visit(dependency)
+        
+        for name in outputs:
+            visit(name)
+        return needed
+
+    def plan(self, outputs):
+        """Count the consumers behind outputs; each output is consumed once more by take()"""
+        needed = self.needed(outputs)
+        self.consumers = {}
+        self.readers = {}
+        for name in outputs:
+            self.consumers[name] = self.consumers.get(name, 0) + 1
+        for name in needed:
+            dependencies, _, reads = self.stages[name]
+            for dependency in dependencies:
+                self.consumers[dependency] = self.consumers.get(dependency, 0) + 1
+            for entry in reads:
+                self.readers[entry] = self.readers.get(entry, 0) + 1
+
+    def get(self, name):
+        if name not in self.results:
+            dependencies, function, reads = self.stages[name]
+            args = [self.get(dependency) for dependency in dependencies]
+            with stage_timer(self.timings, name):
+                self.results[name] = function(*args)
+            check_dtype_policy(f"Stage '{name}'", self.results[name])
+            del args
+            for dependency in dependencies:
+                self._consumed(dependency)
+            for entry in reads:
+                if entry in self.readers:
+                    self.readers[entry] -= 1
+                    if self.readers[entry] == 0 and self.cache is not None:
+                        self.cache.release(*entry)
+        return self.results[name]
+
+    def take(self, name):
+        """get() for the final consumer of an output planned with plan()"""
+        result = self.get(name)
+        self._consumed(name)
+        return result
+
+    def _consumed(self, name):
+        if name in self.consumers:
+            self.consumers[name] -= 1
+            if self.consumers[name] == 0:
+                del self.results[name]
+
+def stereo_spectra(y_mono, y_left, y_right, cache, n_fft=4096):
+    """High-resolution center, sides, left and right spectrograms"""
+    # Method 1: Enhanced center channel extraction
+    # (L + R) / 2 is exactly the mono downmix, so the center shares its cached spectra
+    center = y_mono
+    sides = (y_left - y_right) / 2
     
-    logger.info("Performing professional-grade AI separation...")
+    # Method 2: Ultra-aggressive spectral subtraction on the center and sides, plus
+    # left/right for stereo analysis, all at the higher resolution in one batched transform
+    return tuple(cache.stft_many({'mono': center, 'sides': sides, 'left': y_left, 'right': y_right}, n_fft=n_fft))
+
+def stereo_vocal_estimate(spectra, center, sr, running_stats=None, pitch_tracking=True, morphology=True):
+    """Vocals reconstructed through the stereo vocal confidence mask"""
+    center_stft, sides_stft, left_stft, right_stft = spectra
+    center_mag = np.abs(center_stft)
+    sides_mag = np.abs(sides_stft)
+    left_mag = np.abs(left_stft)
+    right_mag = np.abs(right_stft)
     
-    # 1. Multi-scale harmonic-percussive separation
-    y_harmonic_coarse, y_percussive_coarse = librosa.effects.hpss(y_mono, kernel_size=(31, 5))
-    y_harmonic_fine, y_percussive_fine = librosa.effects.hpss(y_mono, kernel_size=(17, 17))
-    y_harmonic_ultra, y_percussive_ultra = librosa.effects.hpss(y_mono, kernel_size=(7, 31))
+    # Enhanced vocal frequency range (tighter focus on human voice)
+    freq_bins = center_mag.shape[0]
+    nyquist = sr / 2
+    vocal_low_bin, vocal_high_bin, f0_max = vocal_band(freq_bins, sr)
     
-    # 2. Ultra-aggressive vocal extraction with maximum music suppression
-    logger.info("Extracting ultra-clean vocals with maximum music suppression...")
+    # Ultra-selective vocal detection (center dominance, stereo correlation,
+    # temporal consistency and spectral continuity)
+    vocal_mask = compute_vocal_confidence_mask(
+        center_mag, sides_mag, left_mag, right_mag, vocal_low_bin, vocal_high_bin,
+        running_stats=running_stats
+    )
+    del center_mag, sides_mag, left_mag, right_mag  # Only the mask and the center spectrum are used from here
     
-    if is_stereo:
-        # Ensure both channels have the same length
-        min_length = min(len(y_left), len(y_right))
-        y_left = y_left[:min_length]
-        y_right = y_right[:min_length]
-        
-        # Method 1: Enhanced center channel extraction
-        center = (y_left + y_right) / 2
-        sides = (y_left - y_right) / 2
-        
-        # Method 2: Ultra-aggressive spectral subtraction
-        center_stft = librosa.stft(center, n_fft=4096, hop_length=512)  # Higher resolution
-        sides_stft = librosa.stft(sides, n_fft=4096, hop_length=512)
-        
-        # Additional stereo analysis for better separation
-        left_stft = librosa.stft(y_left, n_fft=4096, hop_length=512)
-        right_stft = librosa.stft(y_right, n_fft=4096, hop_length=512)
-        
-        center_mag = np.abs(center_stft)
-        center_phase = np.angle(center_stft)
-        sides_mag = np.abs(sides_stft)
-        left_mag = np.abs(left_stft)
-        right_mag = np.abs(right_stft)
-        
-        # Enhanced vocal frequency range (tighter focus on human voice)
-        freq_bins = center_mag.shape[0]
-        nyquist = sr / 2
-        vocal_low_bin = int(120 * freq_bins / nyquist)    # 120Hz (tighter low cut)
-        vocal_high_bin = int(min(6000, nyquist * 0.7) * freq_bins / nyquist) # 6kHz max (tighter high cut)
-        
-        # Initialize ultra-aggressive vocal mask
-        vocal_mask = np.zeros_like(center_mag)
-        
-        # Ultra-selective vocal detection
-        for freq_bin in range(vocal_low_bin, min(vocal_high_bin, freq_bins)):
-            energy_center = center_mag[freq_bin, :]
-            energy_sides = sides_mag[freq_bin, :]
-            energy_left = left_mag[freq_bin, :]
-            energy_right = right_mag[freq_bin, :]
-            
-            # Multiple criteria for vocal presence
-            # 1. Center dominance (vocals are typically centered)
-            center_dominance = energy_center / (energy_sides + 1e-8)
-            
-            # 2. Stereo correlation (vocals have high L-R correlation)
-            stereo_correlation = (energy_left * energy_right) / (energy_left + energy_right + 1e-8)
-            
-            # 3. Temporal consistency (vocals have consistent energy patterns)
-            center_consistency = 1 - np.std(energy_center) / (np.mean(energy_center) + 1e-8)
-            center_consistency = np.clip(center_consistency, 0, 1)
-            
-            # 4. Spectral continuity (vocals have smooth spectral evolution)
-            if freq_bin > vocal_low_bin and freq_bin < freq_bins - 1:
-                spectral_smoothness = 1 - abs(
-                    energy_center - (center_mag[freq_bin-1, :] + center_mag[freq_bin+1, :]) / 2
-                ) / (energy_center + 1e-8)
-                spectral_smoothness = np.clip(spectral_smoothness, 0, 1)
-            else:
-                spectral_smoothness = np.ones_like(energy_center)
-            
-            # Combine criteria with VOICE-PRESERVING thresholds
-            center_dominance = median_filter(center_dominance, size=7)
-            
-            # More lenient thresholding - preserve vocal content better
-            vocal_confidence = (
-                np.clip((center_dominance - 1.8) / 3.5, 0, 1) * 0.35 +  # Lower threshold
-                np.clip(stereo_correlation - 0.2, 0, 1) * 0.25 +        # More lenient
-                center_consistency * 0.25 +                              # Higher weight
-                spectral_smoothness * 0.15
-            )
-            
-            # Apply more permissive mask - err on side of keeping vocals
-            mask_values = np.clip(vocal_confidence - 0.3, 0, 1)  # Much lower threshold
-            vocal_mask[freq_bin, :] = mask_values
-        
-        # Conservative formant enhancement (preserve vocal character)
-        formant_freqs = [900, 1300, 2500]  # Core formant frequencies
-        for formant in formant_freqs:
-            if formant < nyquist * 0.7:
-                formant_bin = int(formant * freq_bins / nyquist)
-                if formant_bin < freq_bins:
-                    # More conservative boost to preserve natural vocal character
-                    existing_mask = vocal_mask[formant_bin, :]
-                    boost_range = 12  # Slightly wider boost
-                    start_bin = max(0, formant_bin - boost_range)
-                    end_bin = min(freq_bins, formant_bin + boost_range)
-                    
-                    # Gentle boost that works with existing detections
-                    for b in range(start_bin, end_bin):
-                        if b < freq_bins:
-                            # Enhance existing vocal content, don't create new
-                            boost_factor = 1.0 + 0.3 * np.exp(-((b - formant_bin) / 6) ** 2)
-                            vocal_mask[b, :] = vocal_mask[b, :] * boost_factor
-        
-        # Voice-preserving pitch-guided vocal isolation
-        f0_max = min(350, nyquist * 0.6)
+    # Conservative formant enhancement (preserve vocal character)
+    vocal_mask *= formant_boost_gains(freq_bins, nyquist)[:, np.newaxis]
+    
+    # Voice-preserving pitch-guided vocal isolation
+    if pitch_tracking:
         try:
             # More sensitive pitch detection to catch all vocal content
             f0 = librosa.yin(center, fmin=120, fmax=f0_max, sr=sr, threshold=0.25)  # Higher threshold = more sensitive
             
-            # Use pitch to preserve vocal harmonics
-            for t, pitch in enumerate(f0):
-                if not np.isnan(pitch) and pitch > 0:
-                    # Preserve harmonics more conservatively
-                    for harmonic in range(1, 4):  # First 3 harmonics
-                        harm_freq = pitch * harmonic
-                        if harm_freq < nyquist * 0.7:
-                            harm_bin = int(harm_freq * freq_bins / nyquist)
-                            if harm_bin < freq_bins and t < vocal_mask.shape[1]:
-                                # Ensure we don't lose vocal harmonics
-                                vocal_mask[harm_bin, t] = max(vocal_mask[harm_bin, t], 0.5)
+            # Use pitch to preserve the first 3 vocal harmonics
+            vocal_mask = apply_pitch_harmonics(vocal_mask, f0, nyquist)
         except:
             pass
-        
-        # Gentle noise reduction and cleanup - preserve vocals
-        vocal_mask = median_filter(vocal_mask, size=(3, 7))  # Less aggressive smoothing
-        
-        # More permissive thresholding to preserve vocal content
-        vocal_mask = np.where(vocal_mask > 0.25, vocal_mask, vocal_mask * 0.3)  # Keep more content
-        
-        # Less aggressive morphological operations
+    
+    # Gentle noise reduction and cleanup - preserve vocals
+    vocal_mask = median_engine.median_filter(vocal_mask, (3, 7))  # Less aggressive smoothing
+    
+    # More permissive thresholding to preserve vocal content
+    vocal_mask = np.where(vocal_mask > 0.25, vocal_mask, vocal_mask * 0.3)  # Keep more content
+    
+    # Less aggressive morphological operations
+    if morphology:
         from scipy.ndimage import binary_opening, binary_closing
         binary_mask = vocal_mask > 0.2  # Lower threshold
         binary_mask = binary_opening(binary_mask, structure=np.ones((2, 3)))  # Smaller kernel
@@ -189,173 +1567,85 @@ def professional_source_separation(audio_file, sr=22050):
         
         # Apply binary mask with softer edges - preserve vocal nuances
         vocal_mask = np.where(binary_mask, vocal_mask, vocal_mask * 0.2)  # Keep more content
-        vocal_mask = np.clip(vocal_mask, 0, 1)
-        
-        # Reconstruct vocals with ultra-clean separation
-        vocals_stft = center_stft * vocal_mask
-        vocals = librosa.istft(vocals_stft, hop_length=512)
-        
-        # Method 3: Ultra-selective ICA with advanced vocal source identification
-        try:
-            # Prepare stereo data with preprocessing
-            stereo_data = np.array([y_left, y_right])
-            
-            # Apply light preprocessing to improve ICA
-            for i in range(2):
-                # High-pass filter to remove low-frequency noise
-                sos_hp = signal.butter(4, 100, btype='high', fs=sr, output='sos')
-                stereo_data[i] = signal.sosfilt(sos_hp, stereo_data[i])
-            
-            # Enhanced ICA with multiple trials for best result
-            best_vocal_source = None
-            best_vocal_score = -1
-            
-            for trial in range(3):  # Try multiple ICA runs
-                ica = FastICA(
-                    n_components=2, 
-                    random_state=42 + trial,
-                    max_iter=2000,
-                    tol=1e-4,
-                    fun='logcosh',  # Better for audio
-                    alpha=1.0
-                )
-                sources = ica.fit_transform(stereo_data.T).T
-                
-                # Comprehensive vocal source evaluation
-                for idx, source in enumerate(sources):
-                    # Spectral analysis
-                    source_stft = librosa.stft(source, n_fft=2048)
-                    source_mag = np.abs(source_stft)
-                    
-                    # 1. Vocal frequency range energy (key indicator)
-                    vocal_energy = np.mean(source_mag[vocal_low_bin:vocal_high_bin, :])
-                    
-                    # 2. Spectral centroid in vocal range (vocal brightness)
-                    vocal_centroid = np.mean(librosa.feature.spectral_centroid(
-                        S=source_mag[vocal_low_bin:vocal_high_bin, :], sr=sr
-                    ))
-                    
-                    # 3. Temporal stability (vocals are more consistent)
-                    rms_energy = librosa.feature.rms(y=source)[0]
-                    temporal_stability = 1 - (np.std(rms_energy) / (np.mean(rms_energy) + 1e-8))
-                    
-                    # 4. Pitch consistency (vocals have more consistent pitch)
-                    try:
-                        f0_source = librosa.yin(source, fmin=120, fmax=f0_max, sr=sr, threshold=0.2)
-                        valid_f0 = f0_source[~np.isnan(f0_source)]
-                        if len(valid_f0) > 0:
-                            pitch_consistency = 1 - (np.std(valid_f0) / (np.mean(valid_f0) + 1e-8))
-                        else:
-                            pitch_consistency = 0
-                    except:
-                        pitch_consistency = 0
-                    
-                    # 5. Formant presence (check for vocal formants)
-                    formant_score = 0
-                    for formant in [900, 1300, 2500]:
-                        if formant < nyquist * 0.7:
-                            formant_bin = int(formant * source_mag.shape[0] / (sr/2))
-                            if formant_bin < source_mag.shape[0]:
-                                formant_energy = np.mean(source_mag[formant_bin-2:formant_bin+3, :])
-                                surrounding_energy = np.mean(source_mag[max(0, formant_bin-10):formant_bin-5, :])
-                                if surrounding_energy > 0:
-                                    formant_score += formant_energy / surrounding_energy
-                    
-                    # Composite vocal score with strict weighting
-                    vocal_score = (
-                        vocal_energy * 0.35 +
-                        (vocal_centroid / 3000) * 0.20 +  # Normalize centroid
-                        temporal_stability * 0.20 +
-                        pitch_consistency * 0.15 +
-                        min(formant_score / 3, 1.0) * 0.10
-                    )
-                    
-                    if vocal_score > best_vocal_score:
-                        best_vocal_score = vocal_score
-                        best_vocal_source = source.copy()
-            
-            # Use the best vocal source if it's significantly better than spectral method
-            if best_vocal_source is not None and best_vocal_score > 0.3:
-                # Blend ICA result with spectral subtraction result (less blending for purer vocals)
-                if len(best_vocal_source) == len(vocals):
-                    vocals = vocals * 0.6 + best_vocal_source * 0.4  # Favor spectral method slightly
-                logger.info(f"Enhanced vocals using ICA (score: {best_vocal_score:.3f})")
-            else:
-                logger.info("ICA enhancement skipped - spectral method preferred")
-            
-        except Exception as e:
-            logger.warning(f"ICA enhancement failed: {e}, using spectral method only")
-        
-        # Ensure vocals has the same length as mono version
-        target_length = len(y_mono)
-        if len(vocals) != target_length:
-            if len(vocals) < target_length:
-                vocals = np.pad(vocals, (0, target_length - len(vocals)), mode='constant')
-            else:
-                vocals = vocals[:target_length]
-        
-        # Balanced vocal preservation with music suppression
-        logger.info("Applying balanced vocal preservation with selective music suppression...")
-        
-        # Method 4A: Gentle spectral subtraction - preserve vocal content
-        vocals_stft_working = librosa.stft(vocals, n_fft=4096, hop_length=512)
-        vocals_mag = np.abs(vocals_stft_working)
-        vocals_phase = np.angle(vocals_stft_working)
-        
-        # Create reference instrumental estimate from original mix
-        instrumental_stft = librosa.stft(y_mono, n_fft=4096, hop_length=512)
-        instrumental_mag = np.abs(instrumental_stft)
+    vocal_mask = np.clip(vocal_mask, 0, 1)
+    
+    # Reconstruct vocals with ultra-clean separation
+    vocals_stft = center_stft * vocal_mask
+    return fft_engine.istft(vocals_stft, hop_length=512)
+
+def ica_vocal_estimate(y_left, y_right, sr, cache, trials=ICA_TRIALS, n_fft=4096):
+    """Method 3: (best ICA vocal source, score), or None when ICA fails"""
+    from scipy import signal
+    try:
+        # Prepare stereo data with preprocessing
+        stereo_data = np.array([y_left, y_right])
         
-        # Identify and suppress instrumental frequencies
-        freq_bins = vocals_mag.shape[0]
+        # Apply light preprocessing to improve ICA
+        # High-pass filter to remove low-frequency noise
+        sos_hp = signal.butter(4, 100, btype='high', fs=sr, output='sos')
+        stereo_data = signal.sosfilt(sos_hp, stereo_data, axis=-1).astype(stereo_data.dtype)
         
-        # Gentle spectral subtraction - preserve all vocal content
-        for freq_bin in range(freq_bins):
-            freq_hz = freq_bin * nyquist / freq_bins
-            
-            # Define vocal-priority regions (wider to preserve more vocals)
-            if 120 <= freq_hz <= 6000:  # Extended vocal range
-                # Within vocal range - preserve vocals, gentle music suppression
-                vocal_energy = vocals_mag[freq_bin, :]
-                instrumental_energy = instrumental_mag[freq_bin, :]
-                
-                # Conservative subtraction - favor vocal preservation
-                subtraction_factor = np.minimum(
-                    0.4,  # Max 40% subtraction in vocal range
-                    instrumental_energy / (vocal_energy + instrumental_energy + 1e-8)
-                )
-                
-                # Only subtract if instrumental is significantly dominant
-                strong_instrumental = instrumental_energy > vocal_energy * 2
-                vocals_mag[freq_bin, :] *= (1 - subtraction_factor * 0.3 * strong_instrumental)
-                
-            elif freq_hz < 120:  # Below vocal range - moderate removal
-                # Moderate low-frequency suppression (preserve vocal fundamentals)
-                vocals_mag[freq_bin, :] *= 0.3
-                
-            elif freq_hz > 6000:  # Above core vocal range
-                # Gentle high-frequency suppression (preserve vocal harmonics and air)
-                vocals_mag[freq_bin, :] *= 0.6
+        # Enhanced ICA with multiple trials for best result
+        vocal_low_bin, vocal_high_bin, f0_max = vocal_band(1 + n_fft // 2, sr)
+        return ica_vocal_source_search(
+            stereo_data, sr, vocal_low_bin, vocal_high_bin, f0_max, cache, trials=trials
+        )
+    except Exception as e:
+        logger.warning(f"ICA enhancement failed: {e}, using spectral method only")
+        return None
+
+def refine_stereo_vocals(vocals, ica_result, y_mono, sr, cache, running_stats=None, n_fft=4096, morphology=True):
+    """Blend in the ICA source, then gate, whiten and formant-boost the stereo vocal estimate"""
+    nyquist = sr / 2
+    # Ensure vocals has the same length as mono version (and as the ICA source, which
+    # is mixed from the input samples while the ISTFT output is a partial frame shorter)
+    vocals = ensure_length(vocals, len(y_mono))
+    
+    if ica_result is not None:
+        best_vocal_source, best_vocal_score = ica_result
         
-        # Method 4B: Gentle noise gating - preserve quiet vocal parts
-        # Calculate dynamic noise floor per frequency band
+        # Use the best vocal source if it's significantly better than spectral method
+        if best_vocal_source is not None and best_vocal_score > 0.3:
+            # Blend ICA result with spectral subtraction result (less blending for purer vocals)
+            best_vocal_source = ensure_length(best_vocal_source, len(vocals))
+            vocals = vocals * 0.6 + best_vocal_source * 0.4  # Favor spectral method slightly
+            logger.info(f"Enhanced vocals using ICA (score: {best_vocal_score:.3f})")
+        else:
+            logger.info("ICA enhancement skipped - spectral method preferred")
+    
+    # Balanced vocal preservation with music suppression
+    logger.info("Applying balanced vocal preservation with selective music suppression...")
+    
+    # Method 4A: Gentle spectral subtraction - preserve vocal content
+    vocals_stft_working = cache.stft('vocals_blend', vocals, n_fft=n_fft, hop_length=512)
+    vocals_mag = np.abs(vocals_stft_working)
+    vocals_phase = np.angle(vocals_stft_working)
+    
+    # Create reference instrumental estimate from original mix
+    instrumental_stft = cache.stft('mono', y_mono, n_fft=n_fft, hop_length=512)
+    instrumental_mag = np.abs(instrumental_stft)
+    
+    # Identify and suppress instrumental frequencies
+    freq_bins = vocals_mag.shape[0]
+    
+    # Gentle spectral subtraction - preserve all vocal content
+    vocals_mag *= spectral_subtraction_gains(vocals_mag, instrumental_mag, nyquist)
+    del vocals_stft_working, instrumental_stft, instrumental_mag
+    
+    # Method 4B: Gentle noise gating - preserve quiet vocal parts
+    # Calculate dynamic noise floor per frequency band
+    if running_stats is not None:
+        noise_floor = running_stats.percentile('noise_floor', vocals_mag, 25)
+    else:
         noise_floor = np.percentile(vocals_mag, 25, axis=1, keepdims=True)  # Higher percentile
-        signal_threshold = noise_floor * 3.0  # Lower threshold to preserve quiet vocals
-        
-        # Create permissive gate
-        gate_mask = vocals_mag > signal_threshold
-        
-        # Gentle temporal consistency check
-        for freq_bin in range(freq_bins):
-            energy_profile = vocals_mag[freq_bin, :]
-            
-            # Only suppress very obvious spikes (preserve vocal dynamics)
-            median_energy = median_filter(energy_profile, size=5)  # Smaller window
-            spike_threshold = median_energy * 4.0  # Higher threshold
-            
-            # More conservative spike suppression
-            spike_mask = energy_profile < spike_threshold
-            gate_mask[freq_bin, :] = gate_mask[freq_bin, :] & spike_mask
+    signal_threshold = noise_floor * 3.0  # Lower threshold to preserve quiet vocals
+    
+    # Create permissive gate
+    gate_mask = vocals_mag > signal_threshold
+    
+    if morphology:
+        # Gentle temporal consistency check - only suppress very obvious spikes
+        gate_mask &= spike_suppression_mask(vocals_mag)
         
         # Less aggressive morphological operations
         from scipy.ndimage import binary_erosion, binary_dilation
@@ -363,506 +1653,2272 @@ def professional_source_separation(audio_file, sr=22050):
         # Minimal erosion/dilation to preserve vocal details
         gate_mask = binary_erosion(gate_mask, structure=np.ones((2, 3)))
         gate_mask = binary_dilation(gate_mask, structure=np.ones((2, 5)))
-        
-        # Apply gentle gating
-        gate_mask = median_filter(gate_mask.astype(float), size=(3, 5))
-        
-        # Method 4C: Minimal spectral whitening to preserve vocal character
-        # Calculate spectral envelope
-        spectral_envelope = median_filter(vocals_mag, size=(1, 11), mode='reflect')  # Smaller window
-        
-        # Very gentle flattening to preserve vocal formants
-        flattening_factor = 0.1  # Much gentler flattening
-        whitened_mag = vocals_mag * (
-            (spectral_envelope + 1e-8) ** (-flattening_factor)
-        )
-        
-        # Combine all processing with vocal preservation priority
-        final_vocals_mag = whitened_mag * gate_mask
-        
-        # Method 4D: Gentle vocal formant enhancement (preserve natural character)
-        formant_freqs = [800, 1200, 2400]  # Primary formants
-        for formant in formant_freqs:
-            if formant < nyquist * 0.7:
-                formant_bin = int(formant * freq_bins / nyquist)
-                if formant_bin < freq_bins:
-                    # Gentle formant boost to maintain vocal character
-                    boost_range = 6  # Smaller range
-                    start_bin = max(0, formant_bin - boost_range)
-                    end_bin = min(freq_bins, formant_bin + boost_range)
-                    
-                    for b in range(start_bin, end_bin):
-                        if gate_mask[b, :].mean() > 0.1:  # Lower threshold
-                            final_vocals_mag[b, :] *= 1.1  # Gentler boost
-        
-        # Reconstruct voice-preserved vocals
-        final_vocals_stft = final_vocals_mag * np.exp(1j * vocals_phase)
-        vocals = librosa.istft(final_vocals_stft, hop_length=512)
-        
-        # Gentle final noise reduction pass
-        vocals = signal.wiener(vocals, 3)  # Less aggressive noise reduction
-        
-    else:
-        # Mono vocal extraction - use harmonic-percussive separation
-        logger.info("Mono audio detected - using harmonic extraction for vocals")
-        vocals = y_harmonic_fine
     
-    # 3. Professional instrumental separation
-    logger.info("Separating instruments with professional techniques...")
+    # Apply gentle gating
+    gate_mask = median_engine.median_filter(gate_mask.astype(vocals_mag.dtype), (3, 5))
+    
+    # Method 4C: Minimal spectral whitening to preserve vocal character
+    # Calculate spectral envelope
+    spectral_envelope = median_engine.median_filter(vocals_mag, (1, 11))  # Smaller window
+    
+    # Very gentle flattening to preserve vocal formants (in place: the magnitude isn't needed again)
+    flattening_factor = 0.1  # Much gentler flattening
+    spectral_envelope += 1e-8
+    spectral_envelope **= -flattening_factor
+    whitened_mag = vocals_mag
+    whitened_mag *= spectral_envelope
+    del vocals_mag, spectral_envelope
     
-    # Multi-resolution STFT analysis
-    stft_512 = librosa.stft(y_mono, n_fft=512, hop_length=128)
-    stft_1024 = librosa.stft(y_mono, n_fft=1024, hop_length=256)
-    stft_2048 = librosa.stft(y_mono, n_fft=2048, hop_length=512)
-    stft_4096 = librosa.stft(y_mono, n_fft=4096, hop_length=1024)
+    # Combine all processing with vocal preservation priority
+    final_vocals_mag = whitened_mag
+    final_vocals_mag *= gate_mask
     
-    # Bass extraction using multiple techniques
-    S = np.abs(stft_2048)
-    freq_bins = S.shape[0]
+    # Method 4D: Gentle vocal formant enhancement (preserve natural character)
+    formant_freqs = [800, 1200, 2400]  # Primary formants
+    for formant in formant_freqs:
+        if formant < nyquist * 0.7:
+            formant_bin = int(formant * freq_bins / nyquist)
+            if formant_bin < freq_bins:
+                # Gentle formant boost to maintain vocal character
+                boost_range = 6  # Smaller range
+                start_bin = max(0, formant_bin - boost_range)
+                end_bin = min(freq_bins, formant_bin + boost_range)
+                
+                boosted = np.arange(start_bin, end_bin)
+                boosted = boosted[gate_mask[start_bin:end_bin].mean(axis=1) > 0.1]  # Lower threshold
+                final_vocals_mag[boosted] *= 1.1  # Gentler boost
+    
+    # Reconstruct voice-preserved vocals
+    final_vocals_stft = np.exp(1j * vocals_phase)
+    del vocals_phase
+    final_vocals_stft *= final_vocals_mag
+    vocals = fft_engine.istft(final_vocals_stft, hop_length=512)
+    
+    # Gentle final noise reduction pass
+    return wiener_filter(vocals, 3)  # Less aggressive noise reduction
+
+def extract_bass(percussive_coarse, sr, cache):
+    """Bass: comprehensive low-frequency extraction from the coarse percussive layer"""
+    from scipy import signal
+    logger.info("Separating instruments with professional techniques...")
+    bass_stft = cache.stft('percussive_coarse', percussive_coarse)
+    freq_bins = bass_stft.shape[0]
+    band_bins = np.arange(freq_bins)[:, np.newaxis]
     
     # Bass: Comprehensive low-frequency extraction
     bass_cutoff_bins = int(300 * freq_bins / (sr/2))  # 300Hz cutoff
-    bass_mask = np.zeros_like(S)
-    bass_mask[:bass_cutoff_bins, :] = 1.0
+    bass_mask = (band_bins < bass_cutoff_bins).astype(bass_stft.real.dtype)
     
     # Apply bass mask to percussive content
-    bass_stft = librosa.stft(y_percussive_coarse) * bass_mask
-    bass = librosa.istft(bass_stft)
+    bass = fft_engine.istft(bass_stft * bass_mask)
     
     # Apply low-pass filtering
     sos_bass = signal.butter(6, 300, btype='low', fs=sr, output='sos')
-    bass = signal.sosfilt(sos_bass, bass)
+    return signal.sosfilt(sos_bass, bass).astype(bass.dtype, copy=False)
+
+def extract_drums(percussive_ultra, sr, cache):
+    """Drums: advanced percussive isolation from the fine percussive layer"""
+    drums_stft = cache.stft('percussive_ultra', percussive_ultra)
+    freq_bins = drums_stft.shape[0]
+    band_bins = np.arange(freq_bins)[:, np.newaxis]
+    
+    # High-pass filter for drums (remove sub-bass)
+    drums_bins_start = int(60 * freq_bins / (sr/2))
+    drums_mask = (band_bins >= drums_bins_start).astype(drums_stft.real.dtype)
+    
+    drums_stft = drums_stft * drums_mask
+    drums = fft_engine.istft(drums_stft)
+    
+    # Apply dynamic range processing
+    return np.tanh(drums * 2) / 2  # Soft compression
+
+def extract_accompaniment(harmonic_coarse, vocals, cache):
+    """Accompaniment: harmonic content with the vocal estimate subtracted when there is one"""
+    logger.info("Creating high-quality accompaniment...")
+    
+    # Start with harmonic content
+    if vocals is None:
+        return harmonic_coarse
+    
+    # Subtract vocal estimate from harmonic content
+    # Use sophisticated spectral subtraction
+    acc_stft = cache.stft('harmonic_coarse', harmonic_coarse)
+    vocal_stft = cache.stft('vocals', vocals)
+    
+    # Adaptive subtraction based on frequency content
+    vocal_magnitude = np.abs(vocal_stft)
+    acc_magnitude = np.abs(acc_stft)
+    
+    # Create inverse vocal mask
+    subtraction_mask = 1 - (vocal_magnitude / (acc_magnitude + vocal_magnitude + 1e-10)) * 0.6
+    subtraction_mask = np.clip(subtraction_mask, 0.2, 1.0)  # Prevent over-subtraction
+    
+    accompaniment_stft = acc_stft * subtraction_mask
+    return fft_engine.istft(accompaniment_stft)
+
+def extract_other(y_mono, vocals, accompaniment, bass, drums, harmonic_ultra):
+    """Other: residual of the mix after the other four stems, plus some harmonic richness"""
+    logger.info("Creating other/ambient track...")
+    
+    # Ensure all tracks have the same length before calculating residual
+    target_length = len(y_mono)
+    
+    # Calculate residual
+    reconstructed = (
+        ensure_length(vocals, target_length) + ensure_length(accompaniment, target_length)
+        + ensure_length(bass, target_length) + ensure_length(drums, target_length)
+    )
+    other = y_mono - reconstructed
+    
+    # Apply noise reduction
+    other = wiener_filter(other, 7)
+    
+    # Ensure harmonic content matches other track length
+    harmonic_for_other = ensure_length(harmonic_ultra, len(other))
+    
+    # Add some harmonic content for richness
+    return other * 0.8 + harmonic_for_other * 0.2
+
+def harmonic_chroma(harmonic_stft, sr):
+    """12 x frames pitch-class energy of a harmonic spectrogram, unnormalized so silence stays visible"""
+    power = np.abs(harmonic_stft) ** 2
+    chroma = librosa.feature.chroma_stft(
+        S=power, sr=sr, n_fft=2 * (harmonic_stft.shape[0] - 1), hop_length=CHROMA_HOP, norm=None, tuning=0.0
+    )
+    return chroma.astype(AUDIO_DTYPE)
+
+@functools.lru_cache(maxsize=1)
+def chord_templates():
+    """[(root, quality)] and the matching unit-norm binary chroma templates"""
+    labels = []
+    templates = []
+    for quality, (_, intervals) in CHORD_QUALITIES.items():
+        for root in range(12):
+            template = np.zeros(12, dtype=AUDIO_DTYPE)
+            template[[(root + interval) % 12 for interval in intervals]] = 1
+            labels.append((root, quality))
+            templates.append(template / np.linalg.norm(template))
+    return labels, np.array(templates)
+
+def estimate_key(chroma):
+    """(key name, scale, confidence) from the correlation of the mean chroma with the key profiles"""
+    profile = chroma.mean(axis=1)
+    best = (None, None, 0.0)
+    for scale, key_profile in (('major', MAJOR_KEY_PROFILE), ('minor', MINOR_KEY_PROFILE)):
+        for tonic in range(12):
+            correlation = np.corrcoef(profile, np.roll(key_profile, tonic))[0, 1]
+            if np.isfinite(correlation) and correlation > best[2]:
+                best = (f"{PITCH_CLASSES[tonic]} {scale.capitalize()}", scale, float(correlation))
+    return best
+
+def chord_timeline(chroma_parts, duration):
+    """
+    Chord segments from (frame times, harmonic chroma) parts: cosine similarity to triad and
+    seventh templates, smoothed by Viterbi decoding with a no-chord state for near-silent frames.
+    Returned in the ChordProgression shape the app's chord display reads, times in milliseconds.
+    """
+    times = np.concatenate([part[0] for part in chroma_parts]) if chroma_parts else np.zeros(0)
+    chroma = np.concatenate([part[1] for part in chroma_parts], axis=1) if chroma_parts else np.zeros((12, 0))
+    timeline = {'duration': int(round(duration * 1000)), 'key': None, 'scale': None, 'confidence': 0.0, 'chords': []}
+    energy = chroma.sum(axis=0)
+    if not len(times) or not energy.max() > 0:
+        return timeline
+    
+    normalized = chroma / np.maximum(np.linalg.norm(chroma, axis=0), 1e-10)
+    labels, templates = chord_templates()
+    similarity = templates @ normalized
+    silent = energy < CHORD_SILENCE * energy.max()
+    scores = np.vstack([similarity, np.zeros((1, len(times)), dtype=similarity.dtype)])
+    scores[:-1, silent] = 0
+    scores[-1, silent] = 1
+    probabilities = np.exp(CHORD_SHARPNESS * (scores - scores.max(axis=0)))
+    probabilities /= probabilities.sum(axis=0)
+    states = librosa.sequence.viterbi_discriminative(
+        probabilities, librosa.sequence.transition_loop(len(scores), CHORD_SELF_TRANSITION)
+    )
+    
+    # One entry per run of identical states; no-chord runs are left as gaps
+    boundaries = np.flatnonzero(np.diff(states)) + 1
+    for first, last in zip(np.concatenate([[0], boundaries]), np.concatenate([boundaries, [len(states)]])):
+        state = states[first]
+        if state == len(labels):
+            continue
+        root, quality = labels[state]
+        suffix, intervals = CHORD_QUALITIES[quality]
+        start = times[first]
+        end = times[last] if last < len(times) else duration
+        timeline['chords'].append({
+            'time': int(round(start * 1000)),
+            'duration': int(round((end - start) * 1000)),
+            'name': PITCH_CLASSES[root] + suffix,
+            'quality': quality,
+            'confidence': round(float(similarity[state, first:last].mean()), 3),
+            'notes': [PITCH_CLASSES[(root + interval) % 12] for interval in intervals]
+        })
+    
+    key, scale, confidence = estimate_key(chroma[:, ~silent])
+    timeline.update({'key': key, 'scale': scale, 'confidence': round(confidence, 3)})
+    return timeline
+
+def separate_stems(y, sr, spectral_cache=None, running_stats=None, stems=TRACK_NAMES, timings=None,
+                   preset=DEFAULT_PRESET, chroma=None):
+    """
+    Split loaded audio (mono or 2-channel) into raw, length-aligned stems before EQ and normalization.
+    Only the stages the requested stems depend on are evaluated and measured into timings.
+    running_stats replaces the per-track statistics with estimates carried across windows.
+    preset names the SEPARATION_PRESETS entry that sets spectral resolution and which stages run.
+    When chroma is a list, the harmonic chroma of the audio (12 x frames, CHROMA_HOP) is appended to it
+    if the requested stems run the coarse HPSS anyway, or if no stems are requested (the chords mode).
+    """
+    cache = spectral_cache if spectral_cache is not None else SpectralCache()
+    settings = SEPARATION_PRESETS[preset]
+    stereo_n_fft, hpss_n_fft = settings['stereo_n_fft'], settings['hpss_n_fft']
+    
+    # Handle stereo/mono
+    if len(y.shape) > 1:
+        y_mono = librosa.to_mono(y)
+        # Ensure both channels have the same length
+        min_length = min(len(y[0]), len(y[1]))
+        y_left = y[0][:min_length]
+        y_right = y[1][:min_length]
+        is_stereo = True
+    else:
+        y_mono = y
+        y_left = y_right = y_mono
+        is_stereo = False
+    
+    logger.info("Performing professional-grade AI separation...")
+    graph = StageGraph(timings, cache)
+    mono_hpss, mono_stereo = ('mono', hpss_n_fft), ('mono', stereo_n_fft)
+    
+    def hpss(kernel_size, components=('harmonic', 'percussive')):
+        return hpss_from_spectrogram(
+            cache.stft('mono', y_mono, n_fft=hpss_n_fft, hop_length=512), kernel_size, len(y_mono),
+            components=components, magnitude=cache.magnitude('mono', y_mono, n_fft=hpss_n_fft, hop_length=512),
+            decimation=settings['hpss_decimation']
+        )
+    
+    # 1. Multi-scale harmonic-percussive separation, every scale filtering one shared mono magnitude
+    #    (single-scale presets reuse the coarse pass wherever a finer one would run)
+    graph.add('hpss_coarse', (), lambda: hpss((31, 5)), reads=(mono_hpss,))
+    if settings['multi_scale_hpss']:
+        graph.add('hpss_ultra', (), lambda: hpss((7, 31)), reads=(mono_hpss,))
+    else:
+        graph.add('hpss_ultra', ('hpss_coarse',), lambda hpss: hpss)
+    
+    # 2. Ultra-aggressive vocal extraction with maximum music suppression
+    if is_stereo:
+        graph.add(
+            'stereo_spectra', (), lambda: stereo_spectra(y_mono, y_left, y_right, cache, stereo_n_fft),
+            reads=(mono_stereo, ('sides', stereo_n_fft), ('left', stereo_n_fft), ('right', stereo_n_fft))
+        )
+        graph.add('vocal_mask', ('stereo_spectra',), lambda spectra: stereo_vocal_estimate(
+            spectra, y_mono, sr, running_stats, settings['pitch_tracking'], settings['morphology']
+        ))
+        if settings['ica_trials']:
+            graph.add('ica', (), lambda: ica_vocal_estimate(
+                y_left, y_right, sr, cache, settings['ica_trials'], stereo_n_fft
+            ), reads=(('ica_left', 2048), ('ica_right', 2048), ('ica_ones', 2048)))
+        else:
+            graph.add('ica', (), lambda: None)
+        graph.add('vocals', ('vocal_mask', 'ica'), lambda vocals, ica_result: refine_stereo_vocals(
+            vocals, ica_result, y_mono, sr, cache, running_stats, stereo_n_fft, settings['morphology']
+        ), reads=(('vocals_blend', stereo_n_fft), mono_stereo))
+    elif settings['multi_scale_hpss']:
+        # Mono vocal extraction - use harmonic-percussive separation
+        def mono_vocals():
+            logger.info("Mono audio detected - using harmonic extraction for vocals")
+            y_harmonic_fine, = hpss((17, 17), components=('harmonic',))
+            return y_harmonic_fine
+        graph.add('vocals', (), mono_vocals, reads=(mono_hpss,))
+    else:
+        graph.add('vocals', ('hpss_coarse',), lambda hpss: hpss[0])
+    
+    # 3. Professional instrumental separation
+    graph.add('bass', ('hpss_coarse',), lambda hpss: extract_bass(hpss[1], sr, cache),
+              reads=(('percussive_coarse', 2048),))
+    graph.add('drums', ('hpss_ultra',), lambda hpss: extract_drums(hpss[1], sr, cache),
+              reads=(('percussive_ultra', 2048),))
+    
+    # 4. Accompaniment: Advanced harmonic instrument separation (vocal subtraction needs stereo)
+    if is_stereo:
+        graph.add('accompaniment', ('hpss_coarse', 'vocals'), lambda hpss, vocals: extract_accompaniment(
+            hpss[0], vocals, cache
+        ), reads=(('harmonic_coarse', 2048), ('vocals', 2048)))
+    else:
+        graph.add('accompaniment', ('hpss_coarse',), lambda hpss: extract_accompaniment(hpss[0], None, cache))
+    
+    # 5. Other: Residual and ambient content
+    graph.add(
+        'other', ('vocals', 'accompaniment', 'bass', 'drums', 'hpss_ultra'),
+        lambda vocals, accompaniment, bass, drums, hpss: extract_other(
+            y_mono, vocals, accompaniment, bass, drums, hpss[0]
+        )
+    )
+    
+    # Chord analysis: chroma of the coarse harmonic layer, whose spectrum the accompaniment stage caches
+    graph.add('chroma', ('hpss_coarse',), lambda hpss: harmonic_chroma(cache.stft('harmonic_coarse', hpss[0]), sr),
+              reads=(('harmonic_coarse', 2048),))
+    
+    if preset != DEFAULT_PRESET:
+        logger.info(f"Using the '{preset}' preset")
+    if 'vocals' in stems:
+        logger.info("Extracting ultra-clean vocals with maximum music suppression...")
+    if tuple(stems) != TRACK_NAMES:
+        logger.info(f"Separating only: {', '.join(stems)}")
+    
+    # Chords come almost for free with the coarse HPSS, but are not worth running it for
+    outputs = list(stems)
+    if chroma is not None and (not outputs or 'hpss_coarse' in graph.needed(outputs)):
+        outputs.append('chroma')
+    
+    # Every intermediate is released once the last stage (or output) that needs it has run
+    graph.plan(outputs)
+    target_length = len(y_mono)
+    separated = {track_name: ensure_length(graph.take(track_name), target_length) for track_name in stems}
+    if 'chroma' in outputs:
+        chroma.append(graph.take('chroma'))
+    
+    cache_report = cache.report()
+    logger.info(
+        f"Spectral cache: {cache_report['hits']} hits, {cache_report['misses']} misses "
+        f"({cache_report['spectra']} spectra still held, {cache_report['released']} released early, "
+        f"peak {cache_report['peak_mb']} MB)"
+    )
+    return separated
+
+def windowed_source_separation(audio_file, output_paths, sr=None, window_seconds=30, overlap_seconds=2,
+                               timings=None, preset=DEFAULT_PRESET, container='wav', subtype='PCM_16', chroma=None,
+                               output_rate='processing'):
+    """
+    Bounded-memory separation for long recordings. Overlapping windows are loaded and
+    separated one at a time, stitched with a linear crossfade (overlap-add), run through
+    stateful EQ and streamed to output_paths; normalization is a second streaming pass that
+    encodes every stem concurrently into the given container and subtype.
+    Peak memory depends on window_seconds rather than on track length.
+    Only the stems named in output_paths are computed with the named preset;
+    stage measurements are added to timings. Rates work as in professional_source_separation;
+    native-rate output is resynthesized through one streaming resampler per stem, so window
+    boundaries leave no filter edges. When chroma is a list and separate_stems computes the chroma,
+    each window's (frame times, harmonic chroma) up to the start of the next window is appended to it.
+    """
+    logger.info(
+        f"Windowed separation of {audio_file}: {window_seconds}s windows, {overlap_seconds}s crossfade"
+    )
+    
+    # Window boundaries fall on whole samples at both the native and the processing rate,
+    # so independently resampled windows line up exactly
+    native_sr = librosa.get_samplerate(audio_file)
+    res_type = SEPARATION_PRESETS[preset]['resampler']
+    sr = processing_rate(preset, native_sr, sr)
+    out_sr = native_sr if output_rate == 'native' else sr
+    common = math.gcd(native_sr, sr)
+    native_step, step = native_sr // common, sr // common
+    overlap_steps = max(1, round(overlap_seconds * sr / step))
+    window_steps = max(2 * overlap_steps, round(window_seconds * sr / step))
+    overlap = overlap_steps * step
+    window = window_steps * step
+    native_window = window_steps * native_step
+    native_hop = (window_steps - overlap_steps) * native_step
+    
+    fade_in = ((np.arange(overlap) + 0.5) / overlap).astype(AUDIO_DTYPE)
+    fade_out = 1 - fade_in
+    
+    track_names = tuple(output_paths)
+    running_stats = RunningSpectralStats()
+    eq_states = {track_name: {} for track_name in track_names}
+    levels = {track_name: {'sum_sq': 0.0, 'count': 0, 'peak': 0.0} for track_name in track_names}
+    part_paths = {track_name: f"{output_paths[track_name]}.part" for track_name in track_names}
+    writers = {}
+    tails = {}
+    resamplers = {
+        track_name: soxr.ResampleStream(sr, out_sr, 1, dtype='float32', quality=res_type.split('_')[1].upper())
+        for track_name in track_names
+    } if out_sr != sr else {}
+    
+    def write(track_name, audio):
+        level = levels[track_name]
+        level['sum_sq'] += float(np.sum(np.square(audio, dtype=np.float64)))
+        level['count'] += len(audio)
+        if len(audio):
+            level['peak'] = max(level['peak'], float(np.max(np.abs(audio))))
+        writers[track_name].write(audio)
+    
+    def emit(track_name, audio):
+        with stage_timer(timings, 'eq', concurrent=True):
+            audio = apply_professional_eq(audio, sr, track_name, state=eq_states[track_name])
+        with stage_timer(timings, 'dynamics', concurrent=True):
+            audio = apply_dynamics(audio, track_name)
+        if resamplers:
+            with stage_timer(timings, 'resample', concurrent=True):
+                audio = resamplers[track_name].resample_chunk(audio)
+        write(track_name, audio)
+    
+    def emit_all(segments):
+        # Each stem has its own EQ state, levels and writer, so stems can be finished concurrently
+        with stage_timer(timings, 'post_processing'):
+            list(post_processing.map(emit, segments.keys(), segments.values()))
+    
+    window_index = 0
+    post_processing = ThreadPoolExecutor(max_workers=POST_PROCESSING_THREADS)
+    try:
+        for track_name in track_names:
+            writers[track_name] = sf.SoundFile(
+                part_paths[track_name], 'w', samplerate=out_sr, channels=1, format='WAV', subtype='FLOAT'
+            )
+        
+        native_start = 0
+        while True:
+            with stage_timer(timings, 'load'):
+                y, _ = decode_audio(audio_file, start=native_start, frames=native_window)
+            y = resample_audio(y, native_sr, sr, res_type, timings)
+            n = y.shape[-1]
+            if n == 0:
+                break
+            
+            window_index += 1
+            logger.info(f"Separating window {window_index} at {native_start / native_sr:.1f}s")
+            window_chroma = [] if chroma is not None else None
+            stems = separate_stems(
+                y, sr, SpectralCache(), running_stats, stems=track_names, timings=timings, preset=preset,
+                chroma=window_chroma
+            )
+            del y
+            is_last = n < window
+            if window_chroma:
+                # The next window takes over at its own start; the crossfade region is analysed once
+                frame_times = native_start / native_sr + np.arange(window_chroma[0].shape[1]) * CHROMA_HOP / sr
+                keep = slice(None) if is_last else frame_times < (native_start + native_hop) / native_sr
+                chroma.append((frame_times[keep], window_chroma[0][:, keep]))
+            
+            segments = {}
+            for track_name in track_names:
+                audio = stems.pop(track_name)
+                if track_name in tails:
+                    # Overlap-add: fade out the previous window's tail while fading this one in
+                    m = min(overlap, n)
+                    head = tails.pop(track_name)[:m] * fade_out[:m] + audio[:m] * fade_in[:m]
+                    audio = np.concatenate([head, audio[m:]])
+                if is_last:
+                    segments[track_name] = audio
+                else:
+                    tails[track_name] = audio[n - overlap:]
+                    segments[track_name] = audio[:n - overlap]
+            emit_all(segments)
+            del segments
+            
+            if is_last:
+                break
+            native_start += native_hop
+        
+        # A window that ended exactly at the end of the file leaves its tail unwritten
+        emit_all(tails)
+        for track_name, resampler in resamplers.items():
+            with stage_timer(timings, 'resample'):
+                write(track_name, resampler.resample_chunk(np.zeros(0, dtype=AUDIO_DTYPE), last=True))
+        
+        for writer in writers.values():
+            writer.close()
+        
+        # Second pass: whole-track normalization from the running levels
+        def normalize_stem(track_name):
+            level = levels[track_name]
+            rms = np.sqrt(level['sum_sq'] / level['count']) if level['count'] else 0.0
+            gain = normalization_gain(rms, level['peak'])
+            pyramid = PeakPyramid(out_sr)
+            with atomic_output(output_paths[track_name]) as tmp_path, sf.SoundFile(part_paths[track_name]) as src, \
+                    sf.SoundFile(tmp_path, 'w', samplerate=out_sr, channels=1,
+                                 format=OUTPUT_CONTAINERS[container]['format'], subtype=subtype) as dst:
+                for block in src.blocks(blocksize=window, dtype='float32'):
+                    block *= gain
+                    with stage_timer(timings, 'encode', concurrent=True):
+                        dst.write(block)
+                    with stage_timer(timings, 'peaks', concurrent=True):
+                        pyramid.add(block)
+            with stage_timer(timings, 'peaks', concurrent=True):
+                pyramid.write(peaks_path(output_paths[track_name]))
+        
+        with stage_timer(timings, 'normalize'):
+            list(post_processing.map(normalize_stem, track_names))
+    finally:
+        post_processing.shutdown()
+        for writer in writers.values():
+            writer.close()
+        for part_path in part_paths.values():
+            if os.path.exists(part_path):
+                os.remove(part_path)
+    
+    logger.info(f"Windowed separation completed ({window_index} windows)")
+    return sr
+
+@contextmanager
+def atomic_output(path):
+    """Yield a temporary name next to path that replaces path only once the block completes"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+class PeakPyramid:
+    """
+    Min/max/RMS waveform overview of one stem at PEAKS_LEVELS zoom levels, fed block by block
+    while the stem is written so drawing a waveform never needs the audio itself
+    """
+
+    def __init__(self, sr):
+        self.sr = sr
+        self.frames = 0
+        self._carry = np.zeros(0, dtype=AUDIO_DTYPE)
+        self._mins = [np.zeros(0, dtype=AUDIO_DTYPE)]
+        self._maxs = [np.zeros(0, dtype=AUDIO_DTYPE)]
+        self._sums = [np.zeros(0)]
+
+    def add(self, block):
+        block = np.asarray(block, dtype=AUDIO_DTYPE)
+        self.frames += len(block)
+        if len(self._carry):
+            block = np.concatenate([self._carry, block])
+        whole = len(block) - len(block) % PEAKS_SAMPLES_PER_PEAK
+        frames = block[:whole].reshape(-1, PEAKS_SAMPLES_PER_PEAK)
+        self._mins.append(frames.min(axis=1))
+        self._maxs.append(frames.max(axis=1))
+        self._sums.append(np.einsum('ij,ij->i', frames, frames, dtype=np.float64))
+        self._carry = block[whole:].copy()
+
+    def levels(self):
+        """[(mins, maxs, rms)] from the finest level to the coarsest"""
+        mins, maxs, sums = (np.concatenate(parts) for parts in (self._mins, self._maxs, self._sums))
+        counts = np.full(len(mins), PEAKS_SAMPLES_PER_PEAK)
+        if len(self._carry):
+            # The last peak covers the partial block left at the end of the stem
+            mins = np.append(mins, self._carry.min())
+            maxs = np.append(maxs, self._carry.max())
+            sums = np.append(sums, np.dot(self._carry.astype(np.float64), self._carry))
+            counts = np.append(counts, len(self._carry))
+        
+        levels = []
+        for _ in range(PEAKS_LEVELS):
+            levels.append((mins, maxs, np.sqrt(sums / np.maximum(counts, 1))))
+            starts = np.arange(0, len(mins), PEAKS_ZOOM_FACTOR)
+            if len(starts) == 0:
+                continue
+            mins = np.minimum.reduceat(mins, starts)
+            maxs = np.maximum.reduceat(maxs, starts)
+            sums = np.add.reduceat(sums, starts)
+            counts = np.add.reduceat(counts, starts)
+        return levels
+
+    def write(self, path):
+        levels = self.levels()
+        with atomic_output(path) as tmp_path, open(tmp_path, 'wb') as f:
+            f.write(PEAKS_HEADER.pack(
+                PEAKS_MAGIC, PEAKS_VERSION, len(levels), PEAKS_ZOOM_FACTOR,
+                self.sr, PEAKS_SAMPLES_PER_PEAK, self.frames, 0
+            ))
+            f.write(struct.pack(f'<{len(levels)}I', *(len(level[0]) for level in levels)))
+            for level in levels:
+                f.write(encode_peaks(*level))
+
+def encode_peaks(mins, maxs, rms):
+    """Interleaved little-endian int16 (min, max, rms) triples"""
+    triples = np.stack([mins, maxs, rms], axis=1) * 32767
+    return np.clip(np.round(triples), -32768, 32767).astype('<i2').tobytes()
+
+def peaks_path(stem_path):
+    return os.path.splitext(stem_path)[0] + PEAKS_EXTENSION
+
+def read_peaks_header(f):
+    """(header fields dict, per-level peak counts) of an open peaks file"""
+    magic, version, levels, zoom_factor, sr, samples_per_peak, frames, first_peak = PEAKS_HEADER.unpack(
+        f.read(PEAKS_HEADER.size)
+    )
+    if magic != PEAKS_MAGIC or version != PEAKS_VERSION:
+        raise ValueError("Not a peaks file")
+    counts = struct.unpack(f'<{levels}I', f.read(4 * levels))
+    header = {
+        'levels': levels, 'zoom_factor': zoom_factor, 'sample_rate': sr,
+        'samples_per_peak': samples_per_peak, 'frames': frames, 'first_peak': first_peak
+    }
+    return header, counts
+
+def read_peaks(path, zoom, start=0.0, end=None):
+    """
+    Peaks of one zoom level covering [start, end) seconds, read without loading other levels.
+    Returns (header of the slice as a one-level peaks file, int16 triples of shape (n, 3)).
+    """
+    with open(path, 'rb') as f:
+        header, counts = read_peaks_header(f)
+        if not 0 <= zoom < header['levels']:
+            raise ValueError(f"zoom must be between 0 and {header['levels'] - 1}")
+        samples_per_peak = header['samples_per_peak'] * header['zoom_factor'] ** zoom
+        first = min(counts[zoom], max(0, int(start * header['sample_rate'] // samples_per_peak)))
+        last = counts[zoom] if end is None else min(
+            counts[zoom], max(first, math.ceil(end * header['sample_rate'] / samples_per_peak))
+        )
+        f.seek(6 * (sum(counts[:zoom]) + first), os.SEEK_CUR)
+        triples = np.frombuffer(f.read(6 * (last - first)), dtype='<i2').reshape(-1, 3)
+    header.update({'levels': 1, 'samples_per_peak': samples_per_peak, 'first_peak': first})
+    return header, triples
+
+def ensure_peaks(stem_path):
+    """
+    Path of a stem's peaks file. Jobs write it next to the stem; stems cached before peaks
+    existed get theirs built from the stored audio on first request.
+    """
+    target = peaks_path(stem_path)
+    if os.path.exists(target):
+        return target
+    with result_cache.lock(os.path.basename(target)):
+        if not os.path.exists(target):
+            with sf.SoundFile(stem_path) as src:
+                pyramid = PeakPyramid(src.samplerate)
+                for block in src.blocks(blocksize=DECODE_BLOCK_FRAMES, dtype='float32'):
+                    pyramid.add(block)
+            pyramid.write(target)
+    return target
+
+def chords_path(output_key):
+    return os.path.join(OUTPUT_FOLDER, output_key + CHORDS_EXTENSION)
+
+def write_chords(output_key, chroma_parts, duration, timings=None):
+    """Decode and store the chord timeline of a job; returns it"""
+    with stage_timer(timings, 'chords'):
+        timeline = chord_timeline(chroma_parts, duration)
+        with atomic_output(chords_path(output_key)) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump(timeline, f, separators=(',', ':'))
+    return timeline
+
+def write_stems(tracks, output_paths, sr, container='wav', subtype='PCM_16', timings=None):
+    """
+    Encode stems concurrently (libsndfile releases the GIL), each under a temporary name that
+    is renamed into place when complete, so a download never sees a half-written stem.
+    Each stem's peak pyramid is written alongside it.
+    """
+    def write(track_name):
+        with stage_timer(timings, 'encode', concurrent=True), atomic_output(output_paths[track_name]) as tmp_path:
+            sf.write(tmp_path, tracks[track_name], sr, format=OUTPUT_CONTAINERS[container]['format'], subtype=subtype)
+        with stage_timer(timings, 'peaks', concurrent=True):
+            pyramid = PeakPyramid(sr)
+            pyramid.add(tracks[track_name])
+            pyramid.write(peaks_path(output_paths[track_name]))
+        logger.info(f"Saved professional {track_name} track: {os.path.basename(output_paths[track_name])}")
+    
+    with stage_timer(timings, 'write'), ThreadPoolExecutor(max_workers=POST_PROCESSING_THREADS) as executor:
+        list(executor.map(write, tracks))
+
+def run_separation_job(filepath, output_key, options=None, threads=1):
+    """
+    Worker entry point: separate one uploaded file, write its stems to the output folder under
+    the result cache key and publish the cache entry. The chord timeline is written too when the
+    separation ran the harmonic analysis (see separate_stems); the 'chords' mode skips the stems
+    and only runs that analysis. A full separation that still runs out of memory is retried windowed.
+    threads is the FFT and median thread count the job may use unless the config pins one.
+    Returns {'tracks': output files, 'stages': measurements of the stages that ran,
+    'audio_seconds': duration of the separated audio}.
+    """
+    options = options or {}
+    timings = {}
+    fft_engine.job_workers = threads
+    try:
+        with result_cache.lock(output_key):
+            # An identical upload may have been processed while this job was queued
+            output_files = result_cache.load(output_key)
+            if output_files is not None:
+                logger.info(f"Result {output_key} was produced by another job, reusing it")
+                return {'tracks': output_files, 'stages': {}, 'audio_seconds': None}
+            
+            logger.info(f"Processing file with professional AI: {output_key}")
+            
+            container = options.get('container', 'wav')
+            subtype = options.get('subtype', 'PCM_16')
+            output_files = result_cache.output_files(output_key, options.get('stems', TRACK_NAMES), container)
+            output_paths = {
+                track_name: os.path.join(OUTPUT_FOLDER, output_filename)
+                for track_name, output_filename in output_files.items()
+            }
+            chroma = []
+            mode = options.get('mode', 'full')
+            
+            if mode != 'windowed':
+                try:
+                    # Perform professional separation
+                    separated_audio, sr = professional_source_separation(
+                        filepath, sr=options.get('processing_rate'), stems=tuple(output_paths), timings=timings,
+                        preset=options.get('preset', DEFAULT_PRESET), chroma=chroma,
+                        output_rate=options.get('output_rate', 'processing')
+                    )
+                except MemoryError:
+                    if mode != 'full':
+                        raise
+                    # The plan underestimated this file; windows need a fraction of the memory
+                    logger.warning(f"Full separation of {output_key} ran out of memory, retrying windowed")
+                    mode = 'windowed'
+                    timings.clear()
+                    chroma.clear()
+            
+            if mode == 'windowed':
+                # Stems are streamed straight to disk window by window
+                windowed_source_separation(
+                    filepath, output_paths,
+                    window_seconds=options['window_seconds'],
+                    overlap_seconds=options['overlap_seconds'],
+                    sr=options.get('processing_rate'),
+                    timings=timings,
+                    preset=options.get('preset', DEFAULT_PRESET),
+                    container=container,
+                    subtype=subtype,
+                    chroma=chroma,
+                    output_rate=options.get('output_rate', 'processing')
+                )
+                audio_seconds = sf.info(next(iter(output_paths.values()))).duration
+            else:
+                # Save separated tracks
+                write_stems(separated_audio, output_paths, sr, container, subtype, timings)
+                audio_seconds = (
+                    sf.info(next(iter(output_paths.values()))).duration if output_paths else probe_audio(filepath)[0]
+                )
+            
+            if chroma:
+                write_chords(output_key, chroma, audio_seconds, timings)
+            result_cache.store(output_key, output_files, options)
+            return {
+                'tracks': output_files,
+                'stages': stage_report(timings),
+                'audio_seconds': audio_seconds
+            }
+    finally:
+        # Clean up input file
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+class ResultCache:
+    """
+    Content-addressed store of separated stems in the output folder.
+    Entries are keyed by a hash of the uploaded bytes and the processing options. An entry is
+    its stem files plus a '<key>.json' manifest written last, so half-written entries are never
+    served; manifest mtimes order entries for LRU eviction once the budget is exceeded.
+    Per-key lock files keep concurrent workers from computing the same entry twice.
+    Transcoded downloads stored next to a stem belong to its entry and are evicted with it.
+    """
+
+    def __init__(self, folder, max_bytes, lock_timeout=3 * 3600):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock_timeout = lock_timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size_bytes = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for(content_digest, options):
+        """Cache key for an upload's sha256 digest and its processing options"""
+        material = f"{PIPELINE_VERSION}\n{content_digest}\n{json.dumps(options, sort_keys=True)}"
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()[:32]
+
+    @staticmethod
+    def output_files(key, stems=TRACK_NAMES, container='wav'):
+        extension = OUTPUT_CONTAINERS[container]['extension']
+        return {track_name: f"{key}_{track_name}{extension}" for track_name in stems}
+
+    @staticmethod
+    def entry_files(filenames):
+        """Stem files plus their peaks and every transcoded variant a download may have added"""
+        return [
+            os.path.splitext(filename)[0] + extension
+            for filename in filenames
+            for extension in [spec['extension'] for spec in DOWNLOAD_FORMATS.values()] + [PEAKS_EXTENSION]
+        ]
+
+    def _path(self, filename):
+        return os.path.join(self.folder, filename)
+
+    def load(self, key):
+        """Output files of a complete entry, or None"""
+        try:
+            with open(self._path(f"{key}.json")) as f:
+                output_files = json.load(f)['tracks']
+        except (OSError, ValueError, KeyError):
+            return None
+        if not all(os.path.exists(self._path(name)) for name in output_files.values()):
+            return None
+        return output_files
+
+    def lookup(self, key):
+        """Counted lookup that also marks the entry as recently used"""
+        output_files = self.load(key)
+        with self._lock:
+            if output_files is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        try:
+            os.utime(self._path(f"{key}.json"))
+        except OSError:
+            pass
+        return output_files
+
+    def store(self, key, output_files, options):
+        """Publish a finished entry by atomically writing its manifest"""
+        manifest_path = self._path(f"{key}.json")
+        tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'tracks': output_files, 'options': options, 'created_at': time.time()}, f)
+        os.replace(tmp_path, manifest_path)
+
+    @contextmanager
+    def lock(self, key):
+        """Inter-process lock for one key, broken if its holder has been gone for lock_timeout"""
+        lock_path = self._path(f"{key}.lock")
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_path) > self.lock_timeout:
+                        logger.warning(f"Breaking stale result cache lock {lock_path}")
+                        os.remove(lock_path)
+                        continue
+                except OSError:
+                    continue
+                time.sleep(0.5)
+        os.close(fd)
+        try:
+            yield
+        finally:
+            os.remove(lock_path)
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits in max_bytes"""
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.folder):
+                if not name.endswith('.json'):
+                    continue
+                key = name[:-len('.json')]
+                manifest_path = self._path(name)
+                try:
+                    with open(manifest_path) as f:
+                        filenames = self.entry_files(json.load(f)['tracks'].values()) + [key + CHORDS_EXTENSION]
+                    mtime = os.path.getmtime(manifest_path)
+                except (OSError, ValueError, KeyError):
+                    continue
+                size = os.path.getsize(manifest_path) + sum(
+                    os.path.getsize(self._path(filename))
+                    for filename in filenames if os.path.exists(self._path(filename))
+                )
+                entries.append((mtime, key, size, filenames))
+            
+            total = sum(entry[2] for entry in entries)
+            for mtime, key, size, filenames in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    # Manifest first, so the entry stops being served before its stems disappear
+                    os.remove(self._path(f"{key}.json"))
+                    for filename in filenames:
+                        if os.path.exists(self._path(filename)):
+                            os.remove(self._path(filename))
+                except OSError as e:
+                    logger.warning(f"Could not evict cached result {key}: {e}")
+                    continue
+                total -= size
+                self.evictions += 1
+                logger.info(f"Evicted cached result {key} ({size / 1e6:.1f} MB)")
+            self.size_bytes = total
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'evictions': self.evictions,
+                'size_bytes': self.size_bytes,
+                'max_bytes': self.max_bytes
+            }
+
+result_cache = ResultCache(OUTPUT_FOLDER, app.config['RESULT_CACHE_MAX_BYTES'])
+
+def prometheus_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}' if pairs else ''
+
+class Counter:
+    """Prometheus counter, one series per combination of label values"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{prometheus_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Histogram:
+    """Prometheus histogram with cumulative buckets, one series per combination of label values"""
+
+    def __init__(self, name, documentation, buckets, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._series.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def summary(self, **labels):
+        """(count, mean) over every series matching the given subset of label values"""
+        wanted = [(self.labelnames.index(name), str(value)) for name, value in labels.items()]
+        count, total = 0, 0.0
+        with self._lock:
+            for key, series in self._series.items():
+                if all(key[i] == value for i, value in wanted):
+                    count += series['count']
+                    total += series['sum']
+        return count, (total / count if count else None)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series['buckets']):
+                    labels = prometheus_labels(self.labelnames, key, [('le', bound)])
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = prometheus_labels(self.labelnames, key, [('le', '+Inf')])
+                lines.append(f"{self.name}_bucket{labels} {series['count']}")
+                lines.append(f"{self.name}_sum{prometheus_labels(self.labelnames, key)} {series['sum']}")
+                lines.append(f"{self.name}_count{prometheus_labels(self.labelnames, key)} {series['count']}")
+        return lines
+
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+MEMORY_BUCKETS = tuple(mb * 1024 * 1024 for mb in (16, 64, 128, 256, 512, 1024, 2048, 4096))
+REALTIME_FACTOR_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 5)
+
+stage_wall_seconds = Histogram(
+    'separation_stage_wall_seconds', 'Wall time per pipeline stage', SECONDS_BUCKETS, ('stage',)
+)
+stage_cpu_seconds = Histogram(
+    'separation_stage_cpu_seconds', 'CPU time per pipeline stage', SECONDS_BUCKETS, ('stage',)
+)
+stage_peak_memory_bytes = Histogram(
+    'separation_stage_peak_memory_bytes', 'Peak resident memory growth per pipeline stage',
+    MEMORY_BUCKETS, ('stage',)
+)
+job_queue_seconds = Histogram(
+    'separation_job_queue_seconds', 'Time jobs waited for a worker', SECONDS_BUCKETS, ('mode',)
+)
+job_processing_seconds = Histogram(
+    'separation_job_processing_seconds', 'Time from job start to finish', SECONDS_BUCKETS, ('mode', 'preset')
+)
+job_realtime_factor = Histogram(
+    'separation_realtime_factor', 'Processing seconds per second of audio', REALTIME_FACTOR_BUCKETS,
+    ('mode', 'preset')
+)
+jobs_finished = Counter('separation_jobs_total', 'Finished separation jobs by outcome', ('status',))
+
+def job_timing(job):
+    """Queue, processing and real-time-factor summary of a finished job"""
+    audio_seconds = (job['result'] or {}).get('audio_seconds')
+    processing_seconds = job['finished_at'] - job['started_at']
+    return {
+        'queued_seconds': round(job['started_at'] - job['submitted_at'], 3),
+        'processing_seconds': round(processing_seconds, 3),
+        'audio_seconds': round(audio_seconds, 3) if audio_seconds else None,
+        'realtime_factor': round(processing_seconds / audio_seconds, 4) if audio_seconds else None
+    }
+
+def record_job_metrics(job):
+    """Feed a finished job into the /metrics histograms and counters"""
+    if job['status'] != 'completed':
+        jobs_finished.inc(status=job['status'])
+        return
+    if job['cached']:
+        jobs_finished.inc(status='cached')
+        return
+    jobs_finished.inc(status='completed')
     
-    # Drums: Advanced percussive isolation
-    drums_stft = librosa.stft(y_percussive_ultra)
+    mode = job['options'].get('mode', 'full')
+    preset = job['options'].get('preset', DEFAULT_PRESET)
+    timing = job_timing(job)
+    job_queue_seconds.observe(timing['queued_seconds'], mode=mode)
+    job_processing_seconds.observe(timing['processing_seconds'], mode=mode, preset=preset)
+    if timing['realtime_factor'] is not None:
+        job_realtime_factor.observe(timing['realtime_factor'], mode=mode, preset=preset)
+    for stage, entry in job['result']['stages'].items():
+        stage_wall_seconds.observe(entry['wall_seconds'], stage=stage)
+        stage_cpu_seconds.observe(entry['cpu_seconds'], stage=stage)
+        if entry['peak_memory_mb'] is not None:
+            stage_peak_memory_bytes.observe(entry['peak_memory_mb'] * 1e6, stage=stage)
+
+class JobQueueFullError(Exception):
+    """Raised when the separation queue has no room for another job; retry_after is in seconds"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class JobTooLargeError(Exception):
+    """Raised for a job whose predicted peak memory alone exceeds the memory budget"""
+
+def physical_memory_bytes():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def probe_audio(filepath):
+    """(duration in seconds, channels, sample rate) of an audio file from its header; raises ValueError if unreadable"""
+    try:
+        info = sf.info(filepath)
+        return info.frames / info.samplerate, info.channels, info.samplerate
+    except Exception:
+        pass
+    # Formats libsndfile cannot read go through librosa's audioread fallback, as decode_audio does
+    try:
+        return librosa.get_duration(path=filepath), 2, librosa.get_samplerate(filepath)
+    except Exception as e:
+        raise ValueError(f"Unsupported or corrupt audio file ({str(e) or type(e).__name__})")
+
+def preset_realtime_factor(preset):
+    """Worker seconds per audio second: measured on this host once calibrated, else the preset's reference"""
+    measured = preset_calibration.status()['realtime_factors'].get(preset)
+    return measured if measured is not None else SEPARATION_PRESETS[preset]['realtime_factor']
+
+def predict_peak_memory(duration, channels, native_sr, options, mode=None):
+    """
+    Predicted peak memory in bytes of separating duration seconds of audio with options in mode
+    (default: the options' mode), from the preset's calibrated memory_per_second
+    """
+    mode = mode or options.get('mode', 'full')
+    preset = options.get('preset', DEFAULT_PRESET)
+    settings = SEPARATION_PRESETS[preset]
+    rate_scale = processing_rate(preset, native_sr, options.get('processing_rate')) / settings['sample_rate']
     
-    # High-pass filter for drums (remove sub-bass)
-    drums_bins_start = int(60 * freq_bins / (sr/2))
-    drums_mask = np.zeros_like(S)
-    drums_mask[drums_bins_start:, :] = 1.0
+    # Windowed jobs hold about two windows (the current one and the crossfade state) at a time
+    resident_seconds = duration
+    if mode == 'windowed':
+        window_seconds = options.get('window_seconds', app.config['WINDOW_SECONDS'])
+        overlap_seconds = options.get('overlap_seconds', app.config['WINDOW_OVERLAP_SECONDS'])
+        resident_seconds = min(duration, 2 * (window_seconds + overlap_seconds))
+    audio_bytes = resident_seconds * settings['memory_per_second'] * rate_scale
+    if mode == 'chords':
+        audio_bytes *= CHORDS_MEMORY_FACTOR
+    elif channels == 1:
+        audio_bytes *= MONO_MEMORY_FACTOR
+    return JOB_MEMORY_BASE + audio_bytes
+
+def estimate_job_cost(filepath, options):
+    """
+    Predicted worker time and peak memory of separating filepath with options, from its decoded
+    duration, channel count, sample rate, preset and mode. This is also the job's memory plan:
+    a full separation predicted to peak above job_manager.job_memory_ceiling is planned windowed,
+    and 'mode' in the result is the mode the job runs in. Raises ValueError for files that cannot be read.
+    """
+    duration, channels, native_sr = probe_audio(filepath)
+    preset = options.get('preset', DEFAULT_PRESET)
+    settings = SEPARATION_PRESETS[preset]
+    mode = options.get('mode', 'full')
     
-    drums_stft = drums_stft * drums_mask
-    drums = librosa.istft(drums_stft)
+    # Preset costs are per second at the preset's own rate and grow with the samples processed
+    rate_scale = processing_rate(preset, native_sr, options.get('processing_rate')) / settings['sample_rate']
+    cpu_seconds = duration * preset_realtime_factor(preset) * rate_scale
+    if mode == 'chords':
+        cpu_seconds *= CHORDS_CPU_FACTOR
+    elif channels == 1:
+        cpu_seconds *= MONO_CPU_FACTOR
     
-    # Apply dynamic range processing
-    drums = np.tanh(drums * 2) / 2  # Soft compression
+    memory_bytes = predict_peak_memory(duration, channels, native_sr, options, mode)
+    if mode == 'full' and memory_bytes > job_manager.job_memory_ceiling:
+        # Windowing bounds the peak by the window length instead of the song's
+        logger.info(
+            f"Predicted peak of {memory_bytes / 1e9:.1f} GB exceeds the "
+            f"{job_manager.job_memory_ceiling / 1e9:.1f} GB per-job ceiling, planning a windowed separation"
+        )
+        mode = 'windowed'
+        memory_bytes = predict_peak_memory(duration, channels, native_sr, options, mode)
     
-    # 4. Accompaniment: Advanced harmonic instrument separation
-    logger.info("Creating high-quality accompaniment...")
+    return {
+        'audio_seconds': round(duration, 3),
+        'channels': channels,
+        'mode': mode,
+        'cpu_seconds': round(cpu_seconds, 3),
+        'memory_bytes': int(memory_bytes)
+    }
+
+class SeparationJobManager:
+    """
+    Runs separation jobs on a pool of worker processes.
+    At most max_workers jobs run at once and at most max_queued wait behind them;
+    waiting jobs are held here rather than in the executor so they can be cancelled.
+    Admission is also bounded by each job's predicted cost: new jobs are rejected once the
+    predicted worker time still owed by queued and running jobs exceeds cpu_budget, and the
+    next job only starts when its predicted peak fits beside the running ones in memory_budget.
+    job_memory_ceiling (default: an even share of memory_budget per worker) is the largest peak
+    estimate_job_cost() plans a full separation for.
+    Finished job records are kept for retention_seconds so clients can poll them.
+    """
+
+    def __init__(self, max_workers, max_queued, retention_seconds, cpu_budget, memory_budget, job_memory_ceiling=None):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.retention_seconds = retention_seconds
+        self.cpu_budget = cpu_budget
+        self.memory_budget = memory_budget
+        self.job_memory_ceiling = job_memory_ceiling or memory_budget // max_workers
+        self._executor = None
+        self._jobs = {}
+        self._pending = deque()
+        self._running = 0
+        self._held = False
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Created lazily so worker processes importing this module never start their own pool.
+        # Forked workers inherit the warmed-up web process; any other start method warms each worker.
+        if self._executor is None:
+            initializer = None if multiprocessing.get_start_method() == 'fork' else warm_up_worker
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=initializer)
+        return self._executor
+
+    def hold(self):
+        """Queue jobs without starting them (or the worker pool) until release()"""
+        with self._lock:
+            self._held = True
+
+    def release(self):
+        with self._lock:
+            self._held = False
+            self._dispatch()
+
+    def _prune(self):
+        cutoff = time.time() - self.retention_seconds
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job['finished_at'] is not None and job['finished_at'] < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def submit(self, job_id, filepath, filename, output_key, options=None, on_done=None, cost=None):
+        """
+        Queue a separation job with its estimate_job_cost() prediction, in the mode that prediction
+        planned. Raises JobQueueFullError (with a retry estimate) when the queue or the CPU budget
+        is full and JobTooLargeError when the job could never fit the memory budget.
+        on_done(job_id) is called from a pool thread once the job completes, fails or is cancelled.
+        """
+        cost = cost or {'cpu_seconds': 0.0, 'memory_bytes': 0}
+        options = dict(options or {}, mode=cost['mode']) if 'mode' in cost else options
+        if cost['memory_bytes'] > self.memory_budget:
+            raise JobTooLargeError(
+                f"Job needs about {cost['memory_bytes'] / 1e9:.1f} GB, more than this server's "
+                f"{self.memory_budget / 1e9:.1f} GB budget; use mode=windowed or a faster preset"
+            )
+        with self._lock:
+            self._prune()
+            cpu_seconds, _ = self._admitted_load()
+            if (self._held or self._running >= self.max_workers) and len(self._pending) >= self.max_queued:
+                raise JobQueueFullError(
+                    f"Separation queue is full ({self._running} running, {len(self._pending)} queued)",
+                    retry_after=self._next_finish_seconds()
+                )
+            if cpu_seconds > 0 and cpu_seconds + cost['cpu_seconds'] > self.cpu_budget:
+                raise JobQueueFullError(
+                    f"Separation workers are busy ({cpu_seconds:.0f}s of predicted work admitted)",
+                    retry_after=math.ceil((cpu_seconds + cost['cpu_seconds'] - self.cpu_budget) / self.max_workers)
+                )
+            self._jobs[job_id] = {
+                'status': 'queued',
+                'filename': filename,
+                'filepath': filepath,
+                'output_key': output_key,
+                'options': options or {},
+                'cost': cost,
+                'cached': False,
+                'submitted_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+                'cancel_requested': False,
+                'result': None,
+                'error': None,
+                'done': threading.Event(),
+                'listeners': [on_done] if on_done is not None else []
+            }
+            self._pending.append(job_id)
+            self._dispatch()
+        return job_id
+
+    def add_completed(self, job_id, filename, output_files, output_key=None):
+        """Record a job answered straight from the result cache"""
+        now = time.time()
+        with self._lock:
+            self._prune()
+            self._jobs[job_id] = {
+                'status': 'completed',
+                'filename': filename,
+                'filepath': None,
+                'output_key': output_key,
+                'options': {},
+                'cost': {'cpu_seconds': 0.0, 'memory_bytes': 0},
+                'cached': True,
+                'submitted_at': now,
+                'started_at': now,
+                'finished_at': now,
+                'cancel_requested': False,
+                'result': {'tracks': output_files, 'stages': {}, 'audio_seconds': None},
+                'error': None,
+                'done': threading.Event(),
+                'listeners': []
+            }
+            self._jobs[job_id]['done'].set()
+        record_job_metrics(self._jobs[job_id])
+        return job_id
+
+    def _submit(self, *args):
+        # Caller holds the lock
+        try:
+            return self._get_executor().submit(*args)
+        except BrokenProcessPool:
+            logger.warning("Separation worker pool was broken, starting a new one")
+            self._executor = None
+            return self._get_executor().submit(*args)
+
+    def run_task(self, function, *args):
+        """
+        Run maintenance work (such as preset calibration) on the worker pool and return its future.
+        It holds a worker slot like a job, so jobs queue behind it instead of waiting inside a worker.
+        Not for use while the manager is held: the task would start the pool early.
+        """
+        with self._lock:
+            future = self._submit(function, *args)
+            self._running += 1
+        future.add_done_callback(self._on_task_done)
+        return future
+
+    def _on_task_done(self, future):
+        with self._lock:
+            self._running -= 1
+            self._dispatch()
+
+    def _admitted_load(self):
+        # Caller holds the lock. Predicted worker time still owed by queued and running jobs,
+        # and the predicted peak memory of the running ones
+        now = time.time()
+        cpu_seconds = sum(self._jobs[job_id]['cost']['cpu_seconds'] for job_id in self._pending)
+        memory_bytes = 0
+        for job in self._jobs.values():
+            if job['status'] == 'running':
+                cpu_seconds += max(0.0, job['cost']['cpu_seconds'] - (now - job['started_at']))
+                memory_bytes += job['cost']['memory_bytes']
+        return cpu_seconds, memory_bytes
+
+    def _next_finish_seconds(self):
+        # Caller holds the lock. Predicted seconds until a running job frees its worker
+        now = time.time()
+        remaining = [
+            job['cost']['cpu_seconds'] - (now - job['started_at'])
+            for job in self._jobs.values() if job['status'] == 'running'
+        ]
+        return max(1, math.ceil(min(remaining))) if remaining else 1
+
+    def _dispatch(self):
+        # Caller holds the lock. Jobs start in order; the head waits while its peak does not fit
+        while not self._held and self._pending and self._running < self.max_workers:
+            job = self._jobs[self._pending[0]]
+            _, memory_bytes = self._admitted_load()
+            if memory_bytes > 0 and memory_bytes + job['cost']['memory_bytes'] > self.memory_budget:
+                break
+            job_id = self._pending.popleft()
+            future = self._submit(
+                run_separation_job, job['filepath'], job['output_key'], job['options'], self._job_threads()
+            )
+            job['status'] = 'running'
+            job['started_at'] = time.time()
+            self._running += 1
+            future.add_done_callback(lambda f, job_id=job_id: self._on_done(job_id, f))
+
+    def _job_threads(self):
+        # Caller holds the lock. The cores are split between this job and the running and queued jobs
+        # that will hold a worker beside it, so a job on an idle server gets every core and a busy
+        # server runs one thread per job. A job keeps its threads when others start after it.
+        sharing = min(self.max_workers, self._running + 1 + len(self._pending))
+        return max(1, (os.cpu_count() or 1) // sharing)
+
+    def _on_done(self, job_id, future):
+        with self._lock:
+            self._running -= 1
+            job = self._jobs[job_id]
+            job['finished_at'] = time.time()
+            error = future.exception()
+            if job['cancel_requested']:
+                # The worker could not be interrupted, so its result is simply dropped
+                job['status'] = 'cancelled'
+            elif error is not None:
+                job['status'] = 'failed'
+                job['error'] = error
+            else:
+                job['status'] = 'completed'
+                job['result'] = future.result()
+            job['done'].set()
+            self._dispatch()
+        record_job_metrics(job)
+        if job['status'] == 'completed':
+            result_cache.evict()
+        self._notify(job_id, job)
+
+    def _notify(self, job_id, job):
+        # Called without the lock held so listeners may query the manager
+        for listener in job['listeners']:
+            try:
+                listener(job_id)
+            except Exception:
+                logger.exception(f"Job listener failed for {job_id}")
+
+    def status(self, job_id):
+        """Snapshot of a job as a JSON-serialisable dict, or None for unknown ids"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            info = {
+                'job_id': job_id,
+                'status': 'cancelling' if job['status'] == 'running' and job['cancel_requested'] else job['status'],
+                'filename': job['filename'],
+                'submitted_at': job['submitted_at'],
+                'started_at': job['started_at'],
+                'finished_at': job['finished_at']
+            }
+            if 'mode' in job['options']:
+                info['mode'] = job['options']['mode']  # As planned: a full request may run windowed
+            if job['status'] == 'queued':
+                info['queue_position'] = self._pending.index(job_id) + 1
+            elif job['status'] == 'completed':
+                info['tracks'] = job['result']['tracks']
+                info['result_key'] = job['output_key']
+                info['stages'] = job['result']['stages']
+                info['timing'] = job_timing(job)
+                info['cached'] = job['cached']
+            elif job['status'] == 'failed':
+                info['error'] = str(job['error']) or type(job['error']).__name__
+        return info
+
+    def cancel(self, job_id):
+        """Cancel a queued job, or flag a running one so its result is discarded"""
+        dropped = False
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job['status'] == 'queued':
+                dropped = True
+                self._pending.remove(job_id)
+                job['status'] = 'cancelled'
+                job['finished_at'] = time.time()
+                job['done'].set()
+                if os.path.exists(job['filepath']):
+                    os.remove(job['filepath'])
+                jobs_finished.inc(status='cancelled')
+            elif job['status'] == 'running':
+                job['cancel_requested'] = True
+        if dropped:
+            self._notify(job_id, job)
+        return self.status(job_id)
+
+    def result(self, job_id, timeout=None):
+        """Block until a job finishes and return its result dict (re-raises worker errors)"""
+        job = self._jobs[job_id]
+        if not job['done'].wait(timeout):
+            raise TimeoutError(f"Job {job_id} did not finish within {timeout}s")
+        if job['status'] == 'failed':
+            raise job['error']
+        if job['status'] == 'cancelled':
+            raise RuntimeError(f"Job {job_id} was cancelled")
+        return job['result']
+
+    def stats(self):
+        with self._lock:
+            cpu_seconds, memory_bytes = self._admitted_load()
+            return {
+                'workers': self.max_workers,
+                'max_queued': self.max_queued,
+                'held': self._held,
+                'queued': len(self._pending),
+                'running': self._running,
+                'admitted': {
+                    'cpu_seconds': round(cpu_seconds, 1),
+                    'cpu_budget_seconds': self.cpu_budget,
+                    'memory_bytes': memory_bytes,
+                    'memory_budget_bytes': self.memory_budget,
+                    'job_memory_ceiling_bytes': self.job_memory_ceiling
+                }
+            }
+
+job_manager = SeparationJobManager(
+    max_workers=app.config['SEPARATION_WORKERS'],
+    max_queued=app.config['MAX_QUEUED_JOBS'],
+    retention_seconds=app.config['JOB_RETENTION_SECONDS'],
+    cpu_budget=app.config['ADMISSION_CPU_SECONDS'],
+    memory_budget=int(app.config['ADMISSION_MEMORY_FRACTION'] * (physical_memory_bytes() or 4 * 1024 ** 3)),
+    job_memory_ceiling=app.config['JOB_MEMORY_CEILING']
+)
+
+def separation_response(info):
+    """Response body shared by the synchronous and job endpoints, from a completed job's status"""
+    return {
+        'success': True,
+        'message': 'Voice-preserving vocal isolation completed',
+        'tracks': info['tracks'],
+        'peaks': {track_name: f"/peaks/{track_name}/{filename}" for track_name, filename in info['tracks'].items()},
+        'bundle_url': f"/jobs/{info['job_id']}/bundle",
+        'chords_url': f"/jobs/{info['job_id']}/chords",
+        'cached': info['cached'],
+        'stages': info['stages'],
+        'timing': info['timing'],
+        'processing_info': {
+            'technology': 'Balanced ICA + Gentle Spectral Analysis + Voice-First Processing',
+            'quality': 'Complete vocal preservation with selective music removal',
+            'tracks': len(info['tracks']),
+            'vocal_enhancement': 'Voice-preserving isolation with balanced music suppression'
+        }
+    }
+
+def parse_separation_options(form):
+    """Per-request processing options from the upload form; raises ValueError for bad values"""
+    mode = form.get('mode', 'full')
+    if mode not in SEPARATION_MODES:
+        raise ValueError(f"Unknown mode '{mode}', expected one of: {', '.join(SEPARATION_MODES)}")
     
-    # Start with harmonic content
-    accompaniment = y_harmonic_coarse.copy()
+    # stems=vocals,accompaniment or repeated stems fields; kept in canonical order for the cache key
+    requested = {name.strip() for value in form.getlist('stems') for name in value.split(',') if name.strip()}
+    unknown = requested.difference(TRACK_NAMES)
+    if unknown:
+        raise ValueError(f"Unknown stems {', '.join(sorted(unknown))}, expected any of: {', '.join(TRACK_NAMES)}")
+    stems = [track_name for track_name in TRACK_NAMES if track_name in requested] if requested else list(TRACK_NAMES)
+    if mode == 'chords':
+        if requested:
+            raise ValueError("The chords mode doesn't produce stems")
+        stems = []
     
-    # Subtract vocal estimate from harmonic content
-    if is_stereo:
-        # Use sophisticated spectral subtraction
-        acc_stft = librosa.stft(accompaniment)
-        vocal_stft = librosa.stft(vocals)
-        
-        # Adaptive subtraction based on frequency content
-        vocal_magnitude = np.abs(vocal_stft)
-        acc_magnitude = np.abs(acc_stft)
-        
-        # Create inverse vocal mask
-        subtraction_mask = 1 - (vocal_magnitude / (acc_magnitude + vocal_magnitude + 1e-10)) * 0.6
-        subtraction_mask = np.clip(subtraction_mask, 0.2, 1.0)  # Prevent over-subtraction
-        
-        accompaniment_stft = acc_stft * subtraction_mask
-        accompaniment = librosa.istft(accompaniment_stft)
+    preset = form.get('preset', DEFAULT_PRESET)
+    if preset not in SEPARATION_PRESETS:
+        raise ValueError(f"Unknown preset '{preset}', expected one of: {', '.join(SEPARATION_PRESETS)}")
     
-    # 5. Other: Residual and ambient content
-    logger.info("Creating other/ambient track...")
+    container = form.get('container', 'wav').lower()
+    if container not in OUTPUT_CONTAINERS:
+        raise ValueError(f"Unknown container '{container}', expected one of: {', '.join(OUTPUT_CONTAINERS)}")
+    subtype = form.get('subtype', 'PCM_16').upper()
+    if subtype not in OUTPUT_SUBTYPES:
+        raise ValueError(f"Unknown subtype '{subtype}', expected one of: {', '.join(OUTPUT_SUBTYPES)}")
+    if not sf.check_format(OUTPUT_CONTAINERS[container]['format'], subtype):
+        raise ValueError(f"{container.upper()} can't store {subtype} samples")
     
-    # Ensure all tracks have the same length before calculating residual
-    target_length = len(y_mono)
+    # Internal rate: one of PROCESSING_RATES or 'native', defaulting to the preset's
+    rate = form.get('processing_rate', str(SEPARATION_PRESETS[preset]['sample_rate'])).lower()
+    rate_names = [str(rate) for rate in PROCESSING_RATES] + ['native']
+    if rate not in rate_names:
+        raise ValueError(f"Unknown processing_rate '{rate}', expected one of: {', '.join(rate_names)}")
+    output_rate = form.get('output_rate', 'processing').lower()
+    if output_rate not in OUTPUT_RATES:
+        raise ValueError(f"Unknown output_rate '{output_rate}', expected one of: {', '.join(OUTPUT_RATES)}")
     
-    # Trim or pad all tracks to target length
-    def ensure_length(audio, target_len):
-        if len(audio) < target_len:
-            return np.pad(audio, (0, target_len - len(audio)), mode='constant')
+    return {
+        'mode': mode,
+        'preset': preset,
+        'processing_rate': rate if rate == 'native' else int(rate),
+        'output_rate': output_rate,
+        'stems': stems,
+        'container': container,
+        'subtype': subtype,
+        'window_seconds': app.config['WINDOW_SECONDS'],
+        'overlap_seconds': app.config['WINDOW_OVERLAP_SECONDS']
+    }
+
+def synthetic_clip(seconds, sr=44100, seed=0):
+    """Deterministic stereo test mix: a centred vibrato voice over panned chords, bass and noise hits"""
+    t = np.arange(int(seconds * sr)) / sr
+    rng = np.random.default_rng(seed)
+    phase = 2 * np.pi * 220 * t + 3 * np.sin(2 * np.pi * 5 * t)  # 5 Hz vibrato around A3
+    voice = sum(np.sin(k * phase) / k for k in range(1, 6))
+    chords = sum(np.sin(2 * np.pi * f * t) for f in (261.63, 329.63, 392.0))
+    bass = np.sin(2 * np.pi * 55 * t)
+    hits = rng.standard_normal(len(t)) * np.exp(-30 * (t % 0.5))
+    left = 0.3 * voice + 0.3 * chords + 0.3 * bass + 0.2 * hits
+    right = 0.3 * voice + 0.1 * chords + 0.3 * bass + 0.2 * hits
+    return (0.25 * np.stack([left, right], axis=1)).astype(AUDIO_DTYPE)
+
+def warm_up_pipeline(seconds):
+    """
+    Separate a short synthetic clip with every preset so the DSP imports, librosa's lazily loaded
+    submodules and numba compilation are paid before the first real request. Returns seconds taken.
+    """
+    started = time.perf_counter()
+    fd, path = tempfile.mkstemp(suffix='.wav')
+    os.close(fd)
+    try:
+        sf.write(path, synthetic_clip(seconds), 44100)
+        for preset in SEPARATION_PRESETS:
+            chroma = []
+            professional_source_separation(path, preset=preset, chroma=chroma)
+            chord_timeline(chroma, seconds)
+    finally:
+        os.remove(path)
+    return time.perf_counter() - started
+
+def warm_up_worker():
+    """Pool initializer for workers that are not forked from the warmed-up web process"""
+    if app.config['WARM_UP_SECONDS'] > 0:
+        try:
+            warm_up_pipeline(app.config['WARM_UP_SECONDS'])
+        except Exception as e:
+            logger.warning(f"Worker warm-up failed: {e}")
+
+def measure_preset_speeds(seconds):
+    """
+    Worker entry point: real-time factor of every preset, from separating a synthetic clip
+    of the given length. An untimed warm-up first absorbs first-call costs.
+    """
+    warm_up_pipeline(1)
+    fd, path = tempfile.mkstemp(suffix='.wav')
+    os.close(fd)
+    try:
+        sf.write(path, synthetic_clip(seconds), 44100)
+        realtime_factors = {}
+        for preset in SEPARATION_PRESETS:
+            started = time.perf_counter()
+            chroma = []
+            professional_source_separation(path, preset=preset, chroma=chroma)
+            chord_timeline(chroma, seconds)
+            realtime_factors[preset] = round((time.perf_counter() - started) / seconds, 4)
+        return realtime_factors
+    finally:
+        os.remove(path)
+
+class PresetCalibration:
+    """
+    Real-time factor of every preset on this host, measured once on a separation worker
+    (never in the web process, which forks the workers) and reported by /models
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self._future = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Begin measuring unless a measurement has already been started or the warm-up is still running"""
+        with self._lock:
+            if self._future is None and pipeline_warm_up.ready:
+                self._future = job_manager.run_task(measure_preset_speeds, self.seconds)
+                self._future.add_done_callback(self._on_done)
+
+    def _on_done(self, future):
+        if future.exception() is not None:
+            logger.warning(f"Preset calibration failed: {future.exception()}")
+            return
+        for preset, realtime_factor in future.result().items():
+            logger.info(f"Preset '{preset}' runs at {realtime_factor}x real time on this host")
+
+    def status(self):
+        with self._lock:
+            future = self._future
+        realtime_factors = {}
+        if future is None:
+            state = 'pending'
+        elif not future.done():
+            state = 'running'
+        elif future.exception() is not None:
+            state = 'failed'
         else:
-            return audio[:target_len]
+            state = 'completed'
+            realtime_factors = future.result()
+        return {'status': state, 'clip_seconds': self.seconds, 'realtime_factors': realtime_factors}
+
+preset_calibration = PresetCalibration(app.config['PRESET_CALIBRATION_SECONDS'])
+
+class PipelineWarmUp:
+    """
+    Startup warm-up, run in the web process on a background thread so /health answers right away
+    and reports ready once it is done. The job manager is held meanwhile: the worker pool is forked
+    from this process afterwards (and again whenever it is replaced), so every worker starts warm.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.state = 'skipped'  # Until start(); skipped, running, ready or failed
+        self.elapsed = None
+        self.error = None
+
+    @property
+    def ready(self):
+        return self.state in ('skipped', 'ready')
+
+    def start(self, then=None):
+        """Warm up in the background, then call then() if it succeeded"""
+        if self.seconds <= 0:
+            return
+        self.state = 'running'
+        job_manager.hold()
+        threading.Thread(target=self._run, args=(then,), name='pipeline-warm-up', daemon=True).start()
+
+    def _run(self, then):
+        try:
+            self.elapsed = warm_up_pipeline(self.seconds)
+            self.state = 'ready'
+            logger.info(f"Pipeline warm-up finished in {self.elapsed:.2f}s")
+        except Exception as e:
+            self.error = str(e)
+            self.state = 'failed'
+            logger.error(f"Pipeline warm-up failed: {e}")
+        finally:
+            job_manager.release()
+        if self.state == 'ready' and then is not None:
+            then()
+
+    def status(self):
+        return {
+            'status': self.state,
+            'clip_seconds': self.seconds,
+            'seconds': round(self.elapsed, 3) if self.elapsed is not None else None,
+            'error': self.error
+        }
+
+pipeline_warm_up = PipelineWarmUp(app.config['WARM_UP_SECONDS'])
+
+class UploadSpoolFile:
+    """
+    Where the multipart parser streams an uploaded file: bytes go straight into the upload
+    folder and are hashed as they arrive, so an upload is written once and never re-read to
+    compute its cache key. Files no job claimed are removed when the request closes them.
+    """
+
+    def __init__(self, folder):
+        fd, self.path = tempfile.mkstemp(dir=folder, suffix='.part')
+        self.file = os.fdopen(fd, 'w+b')
+        self.digest = hashlib.sha256()
+        self.claimed = False
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def claim(self, filepath):
+        """Move the received upload to filepath and return the sha256 hex digest of its bytes"""
+        self.file.close()
+        os.replace(self.path, filepath)
+        self.claimed = True
+        return self.digest.hexdigest()
+
+    def close(self):
+        self.file.close()
+        if not self.claimed and os.path.exists(self.path):
+            os.remove(self.path)
+
+class UploadRequest(Request):
+    """Request whose file parts are spooled by UploadSpoolFile instead of an anonymous temp file"""
+
+    @property
+    def max_content_length(self):
+        # A playlist batch carries many tracks, so it gets its own body limit
+        if self.endpoint == 'submit_batch':
+            return app.config['BATCH_MAX_CONTENT_LENGTH']
+        return app.config['MAX_CONTENT_LENGTH']
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadSpoolFile(app.config['UPLOAD_FOLDER'])
+
+app.request_class = UploadRequest
+
+def save_upload(file, filepath, chunk_size=1024 * 1024):
+    """Write an uploaded file to disk and return the sha256 hex digest of its bytes"""
+    digest = hashlib.sha256()
+    with open(filepath, 'wb') as out:
+        for chunk in iter(lambda: file.stream.read(chunk_size), b''):
+            digest.update(chunk)
+            out.write(chunk)
+    return digest.hexdigest()
+
+def stem_format(filename):
+    """Download format a stored stem is already in"""
+    return os.path.splitext(filename)[1][1:].lower()
+
+def transcode_output(filepath, fmt):
+    """
+    Path of a stored stem in the requested download format. Compressed variants are encoded
+    once, next to the WAV, and reused by later downloads.
+    """
+    from scipy import signal
+    spec = DOWNLOAD_FORMATS[fmt]
+    target = os.path.splitext(filepath)[0] + spec['extension']
+    if target == filepath:
+        return filepath
     
-    vocals_aligned = ensure_length(vocals, target_length)
-    accompaniment_aligned = ensure_length(accompaniment, target_length)
-    bass_aligned = ensure_length(bass, target_length)
-    drums_aligned = ensure_length(drums, target_length)
+    def is_current():
+        return os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(filepath)
     
-    # Calculate residual
-    reconstructed = vocals_aligned + accompaniment_aligned + bass_aligned + drums_aligned
-    other = y_mono - reconstructed
+    if is_current():
+        return target
+    with result_cache.lock(os.path.basename(target)):
+        # Another request may have finished the same encode while this one waited
+        if is_current():
+            return target
+        
+        audio, sr = sf.read(filepath, dtype='float32')
+        if spec['subtype'] == 'OPUS' and sr not in OPUS_SAMPLE_RATES:
+            opus_sr = next((rate for rate in OPUS_SAMPLE_RATES if rate >= sr), OPUS_SAMPLE_RATES[-1])
+            common = math.gcd(sr, opus_sr)
+            audio = signal.resample_poly(audio, opus_sr // common, sr // common, axis=0).astype(np.float32)
+            sr = opus_sr
+        
+        with atomic_output(target) as tmp_path:
+            sf.write(tmp_path, audio, sr, format=spec['format'], subtype=spec['subtype'])
     
-    # Apply noise reduction
-    other = signal.wiener(other, 7)
+    logger.info(f"Encoded {os.path.basename(target)}")
+    return target
+
+class ZipStreamBuffer:
+    """Unseekable file object that collects zipfile output until a generator drains it"""
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_stem_bundle(paths, fmt, chunk_size=1024 * 1024):
+    """
+    Generate a zip of the stems in paths chunk by chunk. Nothing is assembled in memory or on
+    disk: zipfile writes local headers with data descriptors because the output can't seek.
+    Stems are stored uncompressed; fmt selects the per-stem encoding instead.
+    """
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for track_name, path in paths.items():
+            path = transcode_output(path, fmt)
+            entry = zipfile.ZipInfo.from_file(path, f"{track_name}{DOWNLOAD_FORMATS[fmt]['extension']}")
+            with open(path, 'rb') as src, archive.open(entry, 'w') as dst:
+                while True:
+                    block = src.read(chunk_size)
+                    if not block:
+                        break
+                    dst.write(block)
+                    yield buffer.drain()
+        # The central directory is written when the archive closes
+    yield buffer.drain()
+
+def store_upload(file, options):
+    """
+    Save one upload under a new job id and look its result up in the cache.
+    Returns (job_id, filename, filepath, output_key); filepath is None when the cache already
+    answered it and the job was recorded as completed.
+    """
+    # Save uploaded file under the job id so concurrent uploads never collide
+    job_id = uuid.uuid4().hex
+    filename = secure_filename(file.filename)
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{job_id}_{filename}")
+    if isinstance(file.stream, UploadSpoolFile):
+        content_digest = file.stream.claim(filepath)
+    else:
+        content_digest = save_upload(file, filepath)
     
-    # Ensure harmonic content matches other track length
-    harmonic_for_other = ensure_length(y_harmonic_ultra, len(other))
+    # Identical bytes with identical options are answered from the result cache
+    output_key = result_cache.key_for(content_digest, options)
+    output_files = result_cache.lookup(output_key)
+    if output_files is not None:
+        os.remove(filepath)
+        logger.info(f"Result cache hit for {filename} ({output_key})")
+        job_manager.add_completed(job_id, filename, output_files, output_key)
+        return job_id, filename, None, output_key
     
-    # Add some harmonic content for richness
-    other = other * 0.8 + harmonic_for_other * 0.2
+    return job_id, filename, filepath, output_key
+
+def submit_uploaded_file():
+    """Validate the 'audio' upload, save it and queue a job; returns (job_id, error_response)"""
+    logger.info(f"Request files: {list(request.files.keys())}")
+    logger.info(f"Request form: {list(request.form.keys())}")
     
-    # 6. Professional post-processing
-    logger.info("Applying professional post-processing...")
+    if 'audio' not in request.files:
+        logger.warning("No 'audio' field in request.files")
+        return None, (jsonify({'error': 'No audio file provided'}), 400)
     
-    def apply_professional_eq(audio, sr, track_type):
-        """Apply professional EQ curves for each track type"""
-        if track_type == 'vocals':
-            # Ultra-aggressive Vocal EQ: Maximum isolation and presence
-            nyquist = sr / 2
-            
-            # 1. Aggressive high-pass filter to remove all low-frequency music bleed
-            hp_freq = min(150, nyquist * 0.9)  # Higher cutoff to remove bass/drums
-            sos1 = signal.butter(6, hp_freq, btype='high', fs=sr, output='sos')  # Steeper filter
-            audio = signal.sosfilt(sos1, audio)
-            
-            # 2. Ultra-aggressive de-ess and harsh frequency removal
-            if nyquist > 6000:
-                # Remove harsh frequencies that are often instrumental
-                harsh_low = min(4000, nyquist * 0.6)
-                harsh_high = min(6000, nyquist * 0.8)
-                sos_harsh = signal.butter(4, [harsh_low, harsh_high], btype='band', fs=sr, output='sos')
-                harsh_content = signal.sosfilt(sos_harsh, audio)
-                audio = audio - harsh_content * 0.6  # Remove 60% of harsh content
-            
-            if nyquist > 8000:
-                # De-ess filter (reduce sibilants and cymbal bleed)
-                deess_low = min(6000, nyquist * 0.7)
-                deess_high = min(8000, nyquist * 0.85)
-                sos_deess = signal.butter(3, [deess_low, deess_high], btype='band', fs=sr, output='sos')
-                sibilants = signal.sosfilt(sos_deess, audio)
-                audio = audio - sibilants * 0.5  # Aggressive sibilant reduction
-            
-            # 3. Ultra-focused vocal presence boost (very narrow bands)
-            # Primary vocal clarity: 1.2-2.5kHz (speech intelligibility)
-            pres_low_start = min(1200, nyquist * 0.35)
-            pres_low_end = min(2500, nyquist * 0.55)
-            if pres_low_end > pres_low_start:
-                sos2 = signal.butter(3, [pres_low_start, pres_low_end], btype='band', fs=sr, output='sos')
-                presence_low = signal.sosfilt(sos2, audio)
-                audio = audio + presence_low * 0.4  # Strong boost
-            
-            # Secondary presence: 2.5-4kHz (vocal brightness)
-            if nyquist > 4000:
-                pres_high_start = min(2500, nyquist * 0.5)
-                pres_high_end = min(4000, nyquist * 0.7)
-                if pres_high_end > pres_high_start:
-                    sos3 = signal.butter(2, [pres_high_start, pres_high_end], btype='band', fs=sr, output='sos')
-                    presence_high = signal.sosfilt(sos3, audio)
-                    audio = audio + presence_high * 0.3
-            
-            # 4. Conservative warmth (avoid muddy instruments)
-            warmth_start = min(300, nyquist * 0.15)  # Higher than before
-            warmth_end = min(600, nyquist * 0.3)     # Narrower range
-            if warmth_end > warmth_start:
-                sos4 = signal.butter(1, [warmth_start, warmth_end], btype='band', fs=sr, output='sos')
-                warmth = signal.sosfilt(sos4, audio)
-                audio = audio + warmth * 0.15  # Moderate boost to avoid muddiness
-            
-            # 5. Minimal air (to avoid cymbal bleed)
-            if nyquist > 10000:
-                air_start = min(9000, nyquist * 0.75)   # Higher start frequency
-                air_end = min(12000, nyquist * 0.9)
-                if air_end > air_start:
-                    sos5 = signal.butter(1, [air_start, air_end], btype='band', fs=sr, output='sos')
-                    air = signal.sosfilt(sos5, audio)
-                    audio = audio + air * 0.05  # Very conservative air
-            
-            # 6. Conservative notch filters for only the most problematic frequencies
-            # Remove only major guitar/piano fundamentals that clearly interfere
-            problem_freqs = [220, 440, 880]  # Just the most common problematic frequencies
-            for freq in problem_freqs:
-                if freq < nyquist * 0.8 and freq > 200:  # Narrower range
-                    Q = 20  # Lower Q for gentler notching
-                    try:
-                        sos_notch = signal.iirnotch(freq, Q, fs=sr, output='sos')
-                        audio = signal.sosfilt(sos_notch, audio)
-                    except:
-                        pass
-            
-            # 7. Gentle low-mid adjustment (preserve vocal body)
-            low_mid_start = min(250, nyquist * 0.1)  # Higher start to preserve vocal body
-            low_mid_end = min(350, nyquist * 0.2)    # Narrower range
-            if low_mid_end > low_mid_start:
-                sos_low_mid = signal.butter(1, [low_mid_start, low_mid_end], btype='band', fs=sr, output='sos')
-                low_mid_content = signal.sosfilt(sos_low_mid, audio)
-                audio = audio - low_mid_content * 0.15  # Much gentler cut
-            
-            # 8. Gentle final high-pass to remove only very low frequencies
-            hp_final = min(100, nyquist * 0.8)  # Lower frequency to preserve vocal fundamentals
-            sos_final = signal.butter(2, hp_final, btype='high', fs=sr, output='sos')  # Gentler slope
-            audio = signal.sosfilt(sos_final, audio)
-            
-        elif track_type == 'bass':
-            # Professional Bass EQ: Deep, tight, and punchy (sample rate adaptive)
-            nyquist = sr / 2
-            
-            # 1. Remove sub-sonic rumble
-            hp_freq = min(25, nyquist * 0.05)
-            sos1 = signal.butter(4, hp_freq, btype='high', fs=sr, output='sos')
-            audio = signal.sosfilt(sos1, audio)
-            
-            # 2. Bass fundamental boost (40-120Hz)
-            bass_low = min(40, nyquist * 0.1)
-            bass_high = min(120, nyquist * 0.3)
-            if bass_high > bass_low:
-                sos2 = signal.butter(2, [bass_low, bass_high], btype='band', fs=sr, output='sos')
-                bass_fund = signal.sosfilt(sos2, audio)
-                audio = audio + bass_fund * 0.3
-            
-            # 3. Bass presence (120-300Hz)
-            if nyquist > 300:
-                pres_low = min(120, nyquist * 0.2)
-                pres_high = min(300, nyquist * 0.4)
-                sos3 = signal.butter(2, [pres_low, pres_high], btype='band', fs=sr, output='sos')
-                bass_pres = signal.sosfilt(sos3, audio)
-                audio = audio + bass_pres * 0.2
-            
-            # 4. Low-pass to remove high frequency bleed
-            lp_freq = min(400, nyquist * 0.6)
-            sos4 = signal.butter(6, lp_freq, btype='low', fs=sr, output='sos')
-            audio = signal.sosfilt(sos4, audio)
-            
-        elif track_type == 'drums':
-            # Professional Drum EQ: Punch, attack, and clarity (sample rate adaptive)
-            nyquist = sr / 2
-            
-            # 1. Clean up sub-bass
-            hp_freq = min(50, nyquist * 0.1)
-            sos1 = signal.butter(4, hp_freq, btype='high', fs=sr, output='sos')
-            audio = signal.sosfilt(sos1, audio)
-            
-            # 2. Kick drum punch (60-120Hz)
-            kick_low = min(60, nyquist * 0.15)
-            kick_high = min(120, nyquist * 0.25)
-            if kick_high > kick_low:
-                sos2 = signal.butter(2, [kick_low, kick_high], btype='band', fs=sr, output='sos')
-                kick_punch = signal.sosfilt(sos2, audio)
-                audio = audio + kick_punch * 0.25
-            
-            # 3. Snare body (150-400Hz)
-            if nyquist > 400:
-                snare_low = min(150, nyquist * 0.3)
-                snare_high = min(400, nyquist * 0.5)
-                sos3 = signal.butter(2, [snare_low, snare_high], btype='band', fs=sr, output='sos')
-                snare_body = signal.sosfilt(sos3, audio)
-                audio = audio + snare_body * 0.15
-            
-            # 4. Snare crack (2-6kHz)
-            if nyquist > 6000:
-                crack_low = min(2000, nyquist * 0.4)
-                crack_high = min(6000, nyquist * 0.7)
-                sos4 = signal.butter(2, [crack_low, crack_high], btype='band', fs=sr, output='sos')
-                snare_crack = signal.sosfilt(sos4, audio)
-                audio = audio + snare_crack * 0.2
-            
-            # 5. Cymbals and hi-hats (8kHz+)
-            if nyquist > 8000:
-                cymbal_freq = min(8000, nyquist * 0.8)
-                sos5 = signal.butter(2, cymbal_freq, btype='high', fs=sr, output='sos')
-                cymbals = signal.sosfilt(sos5, audio)
-                audio = audio + cymbals * 0.1
-            
-        elif track_type == 'accompaniment':
-            # Professional Accompaniment EQ: Balanced, warm, and clear (sample rate adaptive)
-            nyquist = sr / 2
-            
-            # 1. Clean low end
-            hp_freq = min(60, nyquist * 0.1)
-            sos1 = signal.butter(2, hp_freq, btype='high', fs=sr, output='sos')
-            audio = signal.sosfilt(sos1, audio)
-            
-            # 2. Warmth enhancement (200-600Hz)
-            if nyquist > 600:
-                warm_low = min(200, nyquist * 0.2)
-                warm_high = min(600, nyquist * 0.4)
-                sos2 = signal.butter(2, [warm_low, warm_high], btype='band', fs=sr, output='sos')
-                warmth = signal.sosfilt(sos2, audio)
-                audio = audio + warmth * 0.15
-            
-            # 3. Instrument clarity (1-4kHz)
-            if nyquist > 4000:
-                clarity_low = min(1000, nyquist * 0.3)
-                clarity_high = min(4000, nyquist * 0.6)
-                sos3 = signal.butter(2, [clarity_low, clarity_high], btype='band', fs=sr, output='sos')
-                clarity = signal.sosfilt(sos3, audio)
-                audio = audio + clarity * 0.12
-            
-            # 4. Sparkle (6-10kHz)
-            if nyquist > 10000:
-                sparkle_low = min(6000, nyquist * 0.6)
-                sparkle_high = min(10000, nyquist * 0.8)
-                sos4 = signal.butter(1, [sparkle_low, sparkle_high], btype='band', fs=sr, output='sos')
-                sparkle = signal.sosfilt(sos4, audio)
-                audio = audio + sparkle * 0.08
-                
-        elif track_type == 'other':
-            # Professional Other/Ambient EQ: Atmospheric and spacious
-            nyquist = sr / 2
-            
-            # 1. Gentle high-pass
-            hp_freq = min(40, nyquist * 0.08)
-            sos1 = signal.butter(2, hp_freq, btype='high', fs=sr, output='sos')
-            audio = signal.sosfilt(sos1, audio)
-            
-            # 2. Ambient enhancement (500Hz-2kHz)
-            if nyquist > 2000:
-                amb_low = min(500, nyquist * 0.3)
-                amb_high = min(2000, nyquist * 0.5)
-                sos2 = signal.butter(1, [amb_low, amb_high], btype='band', fs=sr, output='sos')
-                ambient = signal.sosfilt(sos2, audio)
-                audio = audio + ambient * 0.1
-            
-            # 3. High-frequency detail (4kHz+)
-            if nyquist > 4000:
-                detail_freq = min(4000, nyquist * 0.7)
-                sos3 = signal.butter(1, detail_freq, btype='high', fs=sr, output='sos')
-                detail = signal.sosfilt(sos3, audio)
-                audio = audio + detail * 0.06
-            
-        return audio
-    
-    def apply_dynamics(audio, track_type):
-        """Apply gentle dynamics processing"""
-        if track_type in ['vocals', 'drums']:
-            # Gentle compression
-            threshold = 0.7
-            ratio = 3.0
-            makeup = 1.1
-            
-            abs_audio = np.abs(audio)
-            compressed = np.where(
-                abs_audio > threshold,
-                threshold + (abs_audio - threshold) / ratio,
-                abs_audio
-            )
-            audio = np.sign(audio) * compressed * makeup
-            
-        return audio
+    file = request.files['audio']
+    if file.filename == '':
+        return None, (jsonify({'error': 'No file selected'}), 400)
     
-    # Apply processing to all tracks using aligned versions
-    vocals_aligned = apply_professional_eq(vocals_aligned, sr, 'vocals')
-    vocals_aligned = apply_dynamics(vocals_aligned, 'vocals')
+    try:
+        options = parse_separation_options(request.values)
+    except ValueError as e:
+        return None, (jsonify({'error': str(e)}), 400)
     
-    bass_aligned = apply_professional_eq(bass_aligned, sr, 'bass')
-    bass_aligned = apply_dynamics(bass_aligned, 'bass')
+    job_id, filename, filepath, output_key = store_upload(file, options)
+    if filepath is None:
+        return job_id, None
     
-    drums_aligned = apply_professional_eq(drums_aligned, sr, 'drums')
-    drums_aligned = apply_dynamics(drums_aligned, 'drums')
+    # Admission: the job's predicted cost is checked before any heavy processing starts
+    try:
+        cost = estimate_job_cost(filepath, options)
+        job_manager.submit(job_id, filepath, filename, output_key, options, cost=cost)
+    except ValueError as e:
+        os.remove(filepath)
+        return None, (jsonify({'error': str(e)}), 400)
+    except JobTooLargeError as e:
+        os.remove(filepath)
+        return None, (jsonify({'error': str(e)}), 413)
+    except JobQueueFullError as e:
+        os.remove(filepath)
+        logger.warning(str(e))
+        response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return None, (response, 503)
     
-    accompaniment_aligned = apply_professional_eq(accompaniment_aligned, sr, 'accompaniment')
+    return job_id, None
+
+def batch_item_event(item, info):
+    """NDJSON line for one finished batch item, from its job status (None when it never became a job)"""
+    event = {'event': 'item', 'index': item['index'], 'job_id': item['job_id']}
+    event.update({key: item[key] for key in ('filename', 'digest') if key in item})
+    if info is None:
+        event.update({'success': False, 'status': 'failed', 'error': item['error']})
+    elif info['status'] == 'completed':
+        event.update(separation_response(info))
+        event['status'] = 'completed'
+    else:
+        event.update({'success': False, 'status': info['status']})
+        if 'error' in info:
+            event['error'] = info['error']
+    return event
+
+def stream_batch(items, options):
+    """
+    Run a batch's items as ordinary jobs and yield one NDJSON line per item as it finishes.
+    Items the job queue cannot take yet wait here and are submitted as earlier ones complete,
+    so a whole album fills the worker pool without crowding out everyone else's queue slots.
+    Uploads that were never submitted are removed if the client goes away mid-stream.
+    """
+    finished = queue.Queue()
+    waiting = deque(item for item in items if item.get('filepath'))
+    outstanding = set()
+    counts = {'completed': 0, 'failed': 0, 'cancelled': 0}
     
-    other = apply_professional_eq(other, sr, 'other')
+    def emit(event):
+        if event['event'] == 'item':
+            counts[event['status']] += 1
+        return json.dumps(event) + '\n'
     
-    # Final normalization with proper headroom
-    def normalize_professional(audio, target_lufs=-18):
-        """Professional normalization with proper headroom"""
-        rms = np.sqrt(np.mean(audio**2))
-        if rms > 0:
-            # Target RMS for -18 LUFS (approximately)
-            target_rms = 0.1
-            gain = target_rms / rms
-            audio = audio * gain
-            
-        # Peak limiting to prevent clipping
-        peak = np.max(np.abs(audio))
-        if peak > 0.95:
-            audio = audio * (0.95 / peak)
+    try:
+        yield emit({
+            'event': 'accepted',
+            'items': [
+                {key: item[key] for key in ('index', 'job_id', 'filename', 'digest') if key in item}
+                for item in items
+            ]
+        })
+        
+        # Cache hits and bad references are settled before anything runs
+        for item in items:
+            if not item.get('filepath'):
+                info = job_manager.status(item['job_id']) if item['job_id'] else None
+                yield emit(batch_item_event(item, info))
+        
+        by_job = {item['job_id']: item for item in waiting}
+        while waiting or outstanding:
+            while waiting:
+                item = waiting[0]
+                try:
+                    job_manager.submit(
+                        item['job_id'], item['filepath'], item['filename'], item['output_key'], options,
+                        on_done=finished.put, cost=item['cost']
+                    )
+                except JobQueueFullError:
+                    break
+                except JobTooLargeError as e:
+                    waiting.popleft()
+                    os.remove(item['filepath'])
+                    item.update({'job_id': None, 'error': str(e)})
+                    yield emit(batch_item_event(item, None))
+                    continue
+                waiting.popleft()
+                outstanding.add(item['job_id'])
             
-        return audio
-    
-    tracks = {
-        'vocals': normalize_professional(vocals_aligned),
-        'accompaniment': normalize_professional(accompaniment_aligned), 
-        'bass': normalize_professional(bass_aligned),
-        'drums': normalize_professional(drums_aligned),
-        'other': normalize_professional(other)
-    }
-    
-    logger.info("Professional AI separation completed!")
-    return tracks, sr
+            try:
+                job_id = finished.get(timeout=app.config['BATCH_PROGRESS_SECONDS'])
+            except queue.Empty:
+                # Keeps proxies from timing out the stream while long tracks run
+                yield emit({'event': 'progress', 'waiting': len(waiting), 'running': len(outstanding)})
+                continue
+            outstanding.discard(job_id)
+            yield emit(batch_item_event(by_job[job_id], job_manager.status(job_id)))
+        
+        yield emit({'event': 'done', **counts})
+    finally:
+        for item in waiting:
+            if os.path.exists(item['filepath']):
+                os.remove(item['filepath'])
 
 @app.route('/health', methods=['GET'])
 def health_check():
+    # Not ready (503) until the startup warm-up has run, so load balancers hold traffic back
+    ready = pipeline_warm_up.ready
+    if ready:
+        status = 'healthy'
+    elif pipeline_warm_up.state == 'running':
+        status = 'warming_up'
+    else:
+        status = 'unhealthy'
     return jsonify({
-        'status': 'healthy',
+        'status': status,
+        'ready': ready,
+        'warm_up': pipeline_warm_up.status(),
         'service': 'Voice-Preserving Vocal Isolation Backend',
         'technology': 'Balanced ICA + Gentle Spectral Analysis + Voice-First Processing',
-        'version': '4.1.0',
-        'vocal_isolation': 'Complete vocal preservation with selective music removal'
-    })
+        'version': PIPELINE_VERSION,
+        'vocal_isolation': 'Complete vocal preservation with selective music removal',
+        'result_cache': result_cache.stats(),
+        'jobs': job_manager.stats()
+    }), 200 if ready else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text exposition of stage histograms, job outcomes, queue and cache state"""
+    jobs = job_manager.stats()
+    cache = result_cache.stats()
+    lines = [
+        '# HELP separation_queue_depth Jobs waiting for a free worker',
+        '# TYPE separation_queue_depth gauge',
+        f"separation_queue_depth {jobs['queued']}",
+        '# HELP separation_jobs_in_flight Jobs currently running on a worker',
+        '# TYPE separation_jobs_in_flight gauge',
+        f"separation_jobs_in_flight {jobs['running']}",
+        '# HELP separation_workers Size of the separation worker pool',
+        '# TYPE separation_workers gauge',
+        f"separation_workers {jobs['workers']}",
+        '# HELP separation_admitted_cpu_seconds Predicted worker time still owed by queued and running jobs',
+        '# TYPE separation_admitted_cpu_seconds gauge',
+        f"separation_admitted_cpu_seconds {jobs['admitted']['cpu_seconds']}",
+        '# HELP separation_admitted_memory_bytes Predicted peak memory of running jobs',
+        '# TYPE separation_admitted_memory_bytes gauge',
+        f"separation_admitted_memory_bytes {jobs['admitted']['memory_bytes']}",
+        '# HELP separation_ready Whether the startup warm-up has finished (1) or not (0)',
+        '# TYPE separation_ready gauge',
+        f"separation_ready {int(pipeline_warm_up.ready)}",
+        '# HELP result_cache_lookups_total Result cache lookups by outcome',
+        '# TYPE result_cache_lookups_total counter',
+        f'result_cache_lookups_total{{outcome="hit"}} {cache["hits"]}',
+        f'result_cache_lookups_total{{outcome="miss"}} {cache["misses"]}',
+        '# HELP result_cache_evictions_total Result cache entries evicted',
+        '# TYPE result_cache_evictions_total counter',
+        f"result_cache_evictions_total {cache['evictions']}"
+    ]
+    for metric in (jobs_finished, job_queue_seconds, job_processing_seconds, job_realtime_factor,
+                   stage_wall_seconds, stage_cpu_seconds, stage_peak_memory_bytes):
+        lines.extend(metric.render())
+    return Response('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/separate', methods=['POST'])
 def separate_audio():
     try:
         logger.info("Received professional AI separation request")
-        logger.info(f"Request files: {list(request.files.keys())}")
-        logger.info(f"Request form: {list(request.form.keys())}")
-        
-        if 'audio' not in request.files:
-            logger.warning("No 'audio' field in request.files")
-            return jsonify({'error': 'No audio file provided'}), 400
-        
-        file = request.files['audio']
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
-        
-        if file:
-            # Save uploaded file
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            
-            logger.info(f"Processing file with professional AI: {filename}")
-            
-            # Perform professional separation
-            separated_audio, sr = professional_source_separation(filepath)
-            
-            # Save separated tracks
-            output_files = {}
-            base_filename = os.path.splitext(filename)[0]
-            
-            for track_name, audio_data in separated_audio.items():
-                output_filename = f"{base_filename}_{track_name}.wav"
-                output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-                
-                sf.write(output_path, audio_data, sr)
-                output_files[track_name] = output_filename
-                logger.info(f"Saved professional {track_name} track: {output_filename}")
-            
-            # Clean up input file
-            os.remove(filepath)
-            
-            return jsonify({
-                'success': True,
-                'message': 'Voice-preserving vocal isolation completed',
-                'tracks': output_files,
-                'processing_info': {
-                    'technology': 'Balanced ICA + Gentle Spectral Analysis + Voice-First Processing',
-                    'quality': 'Complete vocal preservation with selective music removal',
-                    'tracks': 5,
-                    'vocal_enhancement': 'Voice-preserving isolation with balanced music suppression'
-                }
-            })
+        
+        # Synchronous wrapper around the job queue: submit, then wait for the worker
+        job_id, error_response = submit_uploaded_file()
+        if error_response is not None:
+            return error_response
+        
+        job_manager.result(job_id)
+        return jsonify(separation_response(job_manager.status(job_id)))
     
     except Exception as e:
         logger.error(f"Error during professional separation: {str(e)}")
         return jsonify({'error': f'Professional separation failed: {str(e)}'}), 500
 
+@app.route('/batches', methods=['POST'])
+def submit_batch():
+    """
+    Separate a whole playlist in one call: repeated 'audio' uploads and/or 'digests' (sha256 of
+    files sent before) share one set of options. Each item runs as its own job, so a corrupt
+    file fails only its own line of the NDJSON stream.
+    """
+    try:
+        options = parse_separation_options(request.values)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    files = [file for file in request.files.getlist('audio') if file.filename]
+    digests = [
+        digest.strip().lower()
+        for value in request.values.getlist('digests') for digest in value.split(',') if digest.strip()
+    ]
+    if not files and not digests:
+        return jsonify({'error': 'No audio files or digests provided'}), 400
+    if len(files) + len(digests) > app.config['BATCH_MAX_ITEMS']:
+        return jsonify({'error': f"A batch holds at most {app.config['BATCH_MAX_ITEMS']} items"}), 400
+    
+    logger.info(f"Received separation batch: {len(files)} uploads, {len(digests)} references")
+    items = []
+    for file in files:
+        job_id, filename, filepath, output_key = store_upload(file, options)
+        item = {
+            'index': len(items), 'job_id': job_id, 'filename': filename,
+            'filepath': filepath, 'output_key': output_key
+        }
+        items.append(item)
+        if filepath is not None:
+            try:
+                item['cost'] = estimate_job_cost(filepath, options)
+            except ValueError as e:
+                os.remove(filepath)
+                item.update({'filepath': None, 'job_id': None, 'error': str(e)})
+    
+    # References can only be answered from the cache: uploads are not kept once their job ends
+    for digest in digests:
+        item = {'index': len(items), 'job_id': None, 'digest': digest}
+        items.append(item)
+        if len(digest) != 64 or not all(c in '0123456789abcdef' for c in digest):
+            item['error'] = 'Not a sha256 hex digest'
+            continue
+        output_key = result_cache.key_for(digest, options)
+        output_files = result_cache.lookup(output_key)
+        if output_files is None:
+            item['error'] = 'No stored result for this file with these options; upload it instead'
+            continue
+        item['job_id'] = uuid.uuid4().hex
+        job_manager.add_completed(item['job_id'], digest, output_files, output_key)
+    
+    return Response(stream_batch(items, options), mimetype='application/x-ndjson')
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    try:
+        logger.info("Received professional AI separation job")
+        
+        job_id, error_response = submit_uploaded_file()
+        if error_response is not None:
+            return error_response
+        
+        return jsonify({
+            'job_id': job_id,
+            'status': job_manager.status(job_id)['status'],
+            'status_url': f"/jobs/{job_id}"
+        }), 202
+    
+    except Exception as e:
+        logger.error(f"Error submitting separation job: {str(e)}")
+        return jsonify({'error': f'Job submission failed: {str(e)}'}), 500
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    info = job_manager.status(job_id)
+    if info is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if info['status'] == 'completed':
+        info.update(separation_response(info))
+    return jsonify(info)
+
+@app.route('/jobs/<job_id>/bundle', methods=['GET'])
+def download_bundle(job_id):
+    info = job_manager.status(job_id)
+    if info is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if info['status'] != 'completed':
+        return jsonify({'error': f"Job is {info['status']}", 'status': info['status']}), 409
+    if not info['tracks']:
+        return jsonify({'error': 'Job produced no stems'}), 409
+    
+    # Stems come in the container they were stored in unless another format is asked for
+    fmt = request.args.get('format', stem_format(next(iter(info['tracks'].values())))).lower()
+    if fmt not in DOWNLOAD_FORMATS:
+        return jsonify({'error': f"Unsupported format '{fmt}'. Use one of: {', '.join(DOWNLOAD_FORMATS)}"}), 400
+    
+    output_folder = app.config['OUTPUT_FOLDER']
+    paths = {
+        track_name: os.path.join(output_folder, filename)
+        for track_name, filename in info['tracks'].items()
+    }
+    if not all(os.path.exists(path) for path in paths.values()):
+        return jsonify({'error': 'Separated tracks are no longer available'}), 410
+    
+    return Response(
+        stream_stem_bundle(paths, fmt),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{job_id}_stems.zip"'}
+    )
+
+@app.route('/jobs/<job_id>/chords', methods=['GET'])
+def get_chords(job_id):
+    """Chord timeline of a completed job: key, scale and time-stamped chords in milliseconds"""
+    info = job_manager.status(job_id)
+    if info is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if info['status'] != 'completed':
+        return jsonify({'error': f"Job is {info['status']}", 'status': info['status']}), 409
+    path = chords_path(info['result_key']) if info['result_key'] else None
+    if path is None or not os.path.exists(path):
+        if info['result_key'] and result_cache.load(info['result_key']) is not None:
+            # The entry is still cached, so its stems never needed the harmonic layer
+            return jsonify({'error': 'This job has no chord timeline; analyse it with mode=chords'}), 404
+        return jsonify({'error': 'Chord timeline is no longer available'}), 410
+    
+    return send_file(path, mimetype='application/json', max_age=app.config['DOWNLOAD_MAX_AGE'])
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    info = job_manager.cancel(job_id)
+    if info is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(info)
+
 @app.route('/download/<track_type>/<filename>', methods=['GET'])
 def download_track(track_type, filename):
     try:
+        filename = secure_filename(filename)
         filepath = os.path.join(app.config['OUTPUT_FOLDER'], filename)
-        if os.path.exists(filepath):
-            return send_file(filepath, as_attachment=True)
-        else:
+        stem, extension = os.path.splitext(filename)
+        if track_type not in TRACK_NAMES or not stem.endswith(f"_{track_type}") \
+                or extension not in [spec['extension'] for spec in OUTPUT_CONTAINERS.values()] \
+                or not os.path.exists(filepath):
             return jsonify({'error': 'File not found'}), 404
+        
+        fmt = request.args.get('format', stem_format(filename)).lower()
+        if fmt not in DOWNLOAD_FORMATS:
+            return jsonify({'error': f"Unsupported format '{fmt}'. Use one of: {', '.join(DOWNLOAD_FORMATS)}"}), 400
+        
+        filepath = transcode_output(filepath, fmt)
+        # conditional=True answers Range requests with 206 and If-None-Match/If-Modified-Since with 304
+        response = send_file(
+            filepath,
+            mimetype=DOWNLOAD_FORMATS[fmt]['mimetype'],
+            as_attachment=True,
+            download_name=os.path.basename(filepath),
+            conditional=True,
+            etag=True,
+            max_age=app.config['DOWNLOAD_MAX_AGE']
+        )
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response
     except Exception as e:
         logger.error(f"Error downloading file: {str(e)}")
         return jsonify({'error': f'Download failed: {str(e)}'}), 500
 
+@app.route('/peaks/<track_type>/<filename>', methods=['GET'])
+def get_peaks(track_type, filename):
+    """
+    Waveform peaks of a stem: ?zoom=0 (finest, the default) up to levels-1, optional start/end in
+    seconds. format=binary (default) returns the slice as a one-level peaks file, format=json as arrays.
+    """
+    try:
+        filename = secure_filename(filename)
+        filepath = os.path.join(app.config['OUTPUT_FOLDER'], filename)
+        stem, extension = os.path.splitext(filename)
+        if track_type not in TRACK_NAMES or not stem.endswith(f"_{track_type}") \
+                or extension not in [spec['extension'] for spec in OUTPUT_CONTAINERS.values()] \
+                or not os.path.exists(filepath):
+            return jsonify({'error': 'File not found'}), 404
+        
+        fmt = request.args.get('format', 'binary').lower()
+        if fmt not in ('binary', 'json'):
+            return jsonify({'error': f"Unsupported format '{fmt}'. Use binary or json"}), 400
+        try:
+            zoom = int(request.args.get('zoom', 0))
+            start = float(request.args.get('start', 0))
+            end = float(request.args['end']) if 'end' in request.args else None
+        except ValueError:
+            return jsonify({'error': 'zoom must be an integer, start and end numbers of seconds'}), 400
+        try:
+            header, triples = read_peaks(ensure_peaks(filepath), zoom, start, end)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        if fmt == 'json':
+            values = np.round(triples / 32767, 4)
+            response = jsonify({
+                'sample_rate': header['sample_rate'],
+                'duration': header['frames'] / header['sample_rate'],
+                'zoom': zoom,
+                'samples_per_peak': header['samples_per_peak'],
+                'start': header['first_peak'] * header['samples_per_peak'] / header['sample_rate'],
+                'min': values[:, 0].tolist(),
+                'max': values[:, 1].tolist(),
+                'rms': values[:, 2].tolist()
+            })
+        else:
+            body = PEAKS_HEADER.pack(
+                PEAKS_MAGIC, PEAKS_VERSION, 1, header['zoom_factor'], header['sample_rate'],
+                header['samples_per_peak'], header['frames'], header['first_peak']
+            ) + struct.pack('<I', len(triples)) + triples.tobytes()
+            response = Response(body, mimetype='application/octet-stream')
+        # Stem names are content hashes, so their peaks never change either
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['DOWNLOAD_MAX_AGE']
+        return response
+    except Exception as e:
+        logger.error(f"Error reading peaks: {str(e)}")
+        return jsonify({'error': f'Peaks failed: {str(e)}'}), 500
+
 @app.route('/models', methods=['GET'])
 def get_available_models():
+    # Measured once per process; the first call starts the measurement
+    preset_calibration.start()
+    calibration = preset_calibration.status()
+    presets = []
+    for name, settings in SEPARATION_PRESETS.items():
+        jobs, observed = job_realtime_factor.summary(preset=name)
+        presets.append({
+            'name': name,
+            'description': settings['description'],
+            'default': name == DEFAULT_PRESET,
+            'sample_rate': settings['sample_rate'],
+            'resampler': settings['resampler'],
+            'realtime_factor': calibration['realtime_factors'].get(name),
+            'observed_realtime_factor': round(observed, 4) if observed is not None else None,
+            'observed_jobs': jobs
+        })
+    
     return jsonify({
+        'presets': presets,
+        'calibration': {'status': calibration['status'], 'clip_seconds': calibration['clip_seconds']},
         'models': [
             {
                 'name': 'ultra-clean-vocal-isolation',
@@ -895,9 +3951,20 @@ if __name__ == '__main__':
     logger.info("  - Professional vocal-optimized EQ")
     logger.info("Specialization: Maximum vocal purity with minimal music bleed")
     logger.info("Available endpoints:")
-    logger.info("  GET  /health - Health check")
-    logger.info("  POST /separate - Ultra-clean vocal isolation")
-    logger.info("  GET  /download/<track_type>/<filename> - Download separated track")
-    logger.info("  GET  /models - Get available AI models")
+    logger.info("  GET  /health - Health check; 503 until the startup warm-up has finished")
+    logger.info("  GET  /metrics - Prometheus metrics")
+    logger.info("  POST /separate - Ultra-clean vocal isolation (optional stems=vocals,accompaniment,..., "
+                "preset=fast|balanced|max, container=wav|flac, subtype=PCM_16|PCM_24|FLOAT, "
+                "processing_rate=<Hz>|native and output_rate=processing|native)")
+    logger.info("  POST /jobs - Queue a separation job")
+    logger.info("  POST /batches - Separate many tracks (audio=..., digests=...) and stream each result as NDJSON")
+    logger.info("  GET  /jobs/<job_id> - Job status and result")
+    logger.info("  DELETE /jobs/<job_id> - Cancel a job")
+    logger.info("  GET  /jobs/<job_id>/bundle?format=wav|flac|opus - Download all stems as one zip")
+    logger.info("  GET  /jobs/<job_id>/chords - Chord timeline of a job (mode=chords analyses without separating)")
+    logger.info("  GET  /download/<track_type>/<filename>?format=wav|flac|opus - Download separated track")
+    logger.info("  GET  /peaks/<track_type>/<filename>?zoom=&start=&end=&format=binary|json - Waveform peaks of a stem")
+    logger.info("  GET  /models - Get available AI models and the measured speed of each preset")
     
+    pipeline_warm_up.start(then=preset_calibration.start)
     app.run(host='0.0.0.0', port=5000, debug=False)
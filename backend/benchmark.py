@@ -0,0 +1,541 @@
+"""
+Offline performance benchmark for the separation pipeline.
+
+Generates deterministic synthetic stereo mixes (a centered voice-like melody, a panned
+harmony voice, percussive noise bursts and a bass line), separates each one in a fresh
+process and records per-stage wall/CPU time and memory, real-time factor and peak RSS.
+Cold start (module import, warm-up) and first-request latency of a fresh process are
+measured too, with and without the startup warm-up, and the median/HPSS engine is
+timed against librosa (exact and approximate modes, with their SNR against librosa's output).
+
+Usage:
+    python benchmark.py run --output results.json
+    python benchmark.py run --durations 10,60 --rates 44100 --baseline baseline.json
+    python benchmark.py compare baseline.json results.json --threshold 0.15
+
+compare (and run --baseline) exits with status 1 when any case or stage regressed.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import soundfile as sf
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app-professional.py')
+
+DEFAULT_DURATIONS = (10, 60, 300, 1200)  # Seconds of audio per case, 10 s to 20 min
+DEFAULT_RATES = (22050, 44100, 48000)  # Native sample rates of the synthetic uploads
+AUTO_FULL_MAX_SECONDS = 300  # 'auto' mode runs longer mixes windowed so they fit in memory
+SYNTH_BLOCK_SECONDS = 10  # Mixes are synthesized and written block by block
+BEAT_SECONDS = 0.5  # 120 BPM
+STARTUP_CLIP_SECONDS = 10  # Mix separated as the first request of a fresh process
+STARTUP_RATE = 44100
+HPSS_CLIP_SECONDS = 60  # Mix whose spectrogram the HPSS comparison decomposes
+HPSS_RATE = 22050
+HPSS_KERNELS = ((31, 5), (17, 17), (7, 31))  # The three decompositions of separate_stems
+HPSS_DECIMATIONS = (1, 2, 3)  # 1 is the exact engine, higher factors the approximate mode
+
+MELODY = (220.0, 246.9, 261.6, 293.7, 329.6, 293.7, 261.6, 246.9)  # Voice-like lead, A3-E4
+BASS_LINE = (55.0, 55.0, 73.4, 82.4, 65.4, 65.4, 49.0, 61.7)
+
+def load_pipeline():
+    """Import app-professional.py (not importable by name because of the hyphen)"""
+    spec = importlib.util.spec_from_file_location('app_professional', APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['app_professional'] = module
+    spec.loader.exec_module(module)
+    return module
+
+def note_envelope(t, note_seconds, attack=0.02, release=0.05):
+    """Per-sample position within the current note and a click-free attack/release envelope"""
+    position = np.mod(t, note_seconds)
+    envelope = np.minimum(1.0, position / attack) * np.minimum(1.0, (note_seconds - position) / release)
+    return position, envelope
+
+def harmonic_voice(t, notes, note_seconds, n_harmonics=8, vibrato_hz=5.0, transpose=1.0):
+    """Sum of harmonics following a note sequence, with vibrato and a 1/k spectral tilt"""
+    note_index = np.floor(t / note_seconds).astype(np.int64) % len(notes)
+    f0 = np.asarray(notes)[note_index] * transpose
+    position, envelope = note_envelope(t, note_seconds)
+    phase = 2 * np.pi * f0 * position + 0.3 * np.sin(2 * np.pi * vibrato_hz * t)
+    voice = np.zeros_like(t)
+    for k in range(1, n_harmonics + 1):
+        voice += np.sin(k * phase) / k
+    return voice * envelope
+
+def percussion(t, rng):
+    """Kick on every beat, snare on the off-beats, hi-hat noise bursts every half beat"""
+    beat_position = np.mod(t, BEAT_SECONDS)
+    kick = np.sin(2 * np.pi * 55.0 * beat_position) * np.exp(-beat_position / 0.15)
+
+    on_snare = np.mod(np.floor(t / BEAT_SECONDS), 2) == 1
+    snare = rng.standard_normal(len(t)) * np.exp(-beat_position / 0.08) * on_snare
+
+    hat_position = np.mod(t, BEAT_SECONDS / 2)
+    hat_noise = np.diff(rng.standard_normal(len(t) + 1))  # First difference tilts the noise upwards
+    hats = hat_noise * np.exp(-hat_position / 0.02)
+    return kick, snare * 0.5, hats * 0.2
+
+def synthesize_block(start, n, sr, seed, block_index):
+    """One (n, 2) block of the synthetic mix starting at sample start"""
+    t = (start + np.arange(n)) / sr
+    rng = np.random.default_rng([seed, block_index])
+
+    lead = harmonic_voice(t, MELODY, BEAT_SECONDS)
+    harmony = harmonic_voice(t, MELODY, BEAT_SECONDS * 2, n_harmonics=6, transpose=2 / 3)
+    kick, snare, hats = percussion(t, rng)
+    bass = harmonic_voice(t, BASS_LINE, BEAT_SECONDS * 2, n_harmonics=4, vibrato_hz=0.0)
+
+    # Lead, kick, snare and bass in the center; harmony and hats panned
+    center = 0.3 * lead + 0.5 * kick + 0.3 * snare + 0.4 * bass
+    left = center + 0.24 * harmony + 0.8 * hats
+    right = center + 0.06 * harmony + 0.3 * hats
+    return (np.stack([left, right], axis=1) * 0.3).astype(np.float32)
+
+def write_synthetic_mix(path, duration, sr, seed=0):
+    """Write a deterministic stereo mix of duration seconds to a 16-bit WAV"""
+    total = int(round(duration * sr))
+    block = SYNTH_BLOCK_SECONDS * sr
+    with sf.SoundFile(path, 'w', samplerate=sr, channels=2, subtype='PCM_16') as out:
+        for block_index, start in enumerate(range(0, total, block)):
+            out.write(synthesize_block(start, min(block, total - start), sr, seed, block_index))
+
+def resolve_mode(mode, duration):
+    if mode == 'auto':
+        return 'full' if duration <= AUTO_FULL_MAX_SECONDS else 'windowed'
+    return mode
+
+def case_name(duration, sr, mode, preset, fft_workers=None):
+    name = f"{sr}Hz_{duration:g}s_{mode}_{preset}"
+    return f"{name}_fft{fft_workers}" if fft_workers else name
+
+def run_case(duration, sr, mode, seed, preset, fft_workers=None):
+    """Separate one synthetic mix in this process and return its measurements"""
+    import_start = time.perf_counter()
+    app = load_pipeline()
+    import_seconds = time.perf_counter() - import_start
+    app.logger.setLevel('WARNING')
+    if fft_workers:
+        app.app.config['FFT_WORKERS'] = fft_workers
+    # Like a worker, compile the median kernel and load librosa's submodules before the timed run;
+    # run_startup measures the cold path
+    warm_up_seconds = app.warm_up_pipeline(app.app.config['WARM_UP_SECONDS'])
+
+    workdir = os.getcwd()
+    mix_path = os.path.join(workdir, 'mix.wav')
+    write_synthetic_mix(mix_path, duration, sr, seed)
+    output_paths = {track_name: os.path.join(workdir, f"{track_name}.wav") for track_name in app.TRACK_NAMES}
+
+    timings = {}
+    start = time.perf_counter()
+    if mode == 'windowed':
+        app.windowed_source_separation(
+            mix_path, output_paths,
+            window_seconds=app.app.config['WINDOW_SECONDS'],
+            overlap_seconds=app.app.config['WINDOW_OVERLAP_SECONDS'],
+            timings=timings,
+            preset=preset
+        )
+    else:
+        tracks, out_sr = app.professional_source_separation(mix_path, timings=timings, preset=preset)
+        app.write_stems(tracks, output_paths, out_sr, timings=timings)
+    total_seconds = time.perf_counter() - start
+
+    peak_rss = app.process_peak_rss_bytes()
+    predicted_peak = app.predict_peak_memory(duration, 2, sr, {'preset': preset}, mode)
+    return {
+        'name': case_name(duration, sr, mode, preset, fft_workers),
+        'sample_rate': sr,
+        'duration_seconds': duration,
+        'mode': mode,
+        'preset': preset,
+        'fft_workers': app.fft_engine.workers,
+        'import_seconds': round(import_seconds, 3),
+        'warm_up_seconds': round(warm_up_seconds, 3),
+        'total_seconds': round(total_seconds, 3),
+        'realtime_factor': round(total_seconds / duration, 4),
+        'peak_rss_mb': round(peak_rss / 1e6, 1) if peak_rss else None,
+        'predicted_peak_mb': round(predicted_peak / 1e6, 1),  # The admission planner's estimate
+        'stages': app.stage_report(timings)
+    }
+
+def run_startup(warm_up, seed):
+    """Time a fresh process from import to the end of its first separation, optionally warmed up first"""
+    import_start = time.perf_counter()
+    app = load_pipeline()
+    import_seconds = time.perf_counter() - import_start
+    app.logger.setLevel('WARNING')
+
+    warm_up_seconds = app.warm_up_pipeline(app.app.config['WARM_UP_SECONDS']) if warm_up else 0.0
+
+    workdir = os.getcwd()
+    mix_path = os.path.join(workdir, 'mix.wav')
+    write_synthetic_mix(mix_path, STARTUP_CLIP_SECONDS, STARTUP_RATE, seed)
+    output_paths = {track_name: os.path.join(workdir, f"{track_name}.wav") for track_name in app.TRACK_NAMES}
+    start = time.perf_counter()
+    tracks, out_sr = app.professional_source_separation(mix_path)
+    app.write_stems(tracks, output_paths, out_sr)
+    first_request_seconds = time.perf_counter() - start
+
+    return {
+        'name': startup_name(warm_up),
+        'warm_up': warm_up,
+        'import_seconds': round(import_seconds, 3),
+        'warm_up_seconds': round(warm_up_seconds, 3),
+        'ready_seconds': round(import_seconds + warm_up_seconds, 3),
+        'first_request_seconds': round(first_request_seconds, 3)
+    }
+
+def startup_name(warm_up):
+    return f"startup_{'warm' if warm_up else 'cold'}_{STARTUP_CLIP_SECONDS:g}s"
+
+def snr_db(reference, estimate):
+    noise = np.sum(np.abs(reference - estimate) ** 2)
+    if noise == 0:
+        return None  # Identical
+    return round(float(10 * np.log10(np.sum(np.abs(reference) ** 2) / noise)), 1)
+
+def run_hpss(seed):
+    """Time librosa's HPSS against the median engine on one spectrogram, with the engine's accuracy"""
+    import librosa
+    app = load_pipeline()
+    app.logger.setLevel('WARNING')
+
+    mix_path = os.path.join(os.getcwd(), 'mix.wav')
+    write_synthetic_mix(mix_path, HPSS_CLIP_SECONDS, HPSS_RATE, seed)
+    y, _ = sf.read(mix_path, dtype='float32')
+    stft_matrix = app.fft_engine.stft(np.ascontiguousarray(y.mean(axis=1)), n_fft=2048, hop_length=512)
+    app.median_engine.hpss(stft_matrix[:, :64], (31, 5))  # Compile the kernel outside the timings
+
+    start = time.perf_counter()
+    reference = [librosa.decompose.hpss(stft_matrix, kernel_size=kernel) for kernel in HPSS_KERNELS]
+    librosa_seconds = time.perf_counter() - start
+
+    variants = []
+    for decimation in HPSS_DECIMATIONS:
+        start = time.perf_counter()
+        magnitude = np.abs(stft_matrix)
+        spectra = [
+            app.median_engine.hpss(stft_matrix, kernel, magnitude=magnitude, decimation=decimation)
+            for kernel in HPSS_KERNELS
+        ]
+        seconds = time.perf_counter() - start
+        snr = {
+            f"{kernel[0]}x{kernel[1]}": {
+                component: snr_db(ref, est) for component, ref, est in zip(('harmonic', 'percussive'), pair, parts)
+            }
+            for kernel, pair, parts in zip(HPSS_KERNELS, reference, spectra)
+        }
+        snrs = [value for entry in snr.values() for value in entry.values() if value is not None]
+        variants.append({
+            'name': f"hpss_{'exact' if decimation == 1 else f'approx{decimation}'}",
+            'decimation': decimation,
+            'seconds': round(seconds, 3),
+            'speedup': round(librosa_seconds / seconds, 2),
+            'snr_db': snr,
+            'worst_snr_db': min(snrs) if snrs else None  # None: identical to librosa
+        })
+    return {
+        'clip_seconds': HPSS_CLIP_SECONDS,
+        'sample_rate': HPSS_RATE,
+        'frames': stft_matrix.shape[1],
+        'median_workers': app.median_engine.workers,
+        'librosa_seconds': round(librosa_seconds, 3),
+        'variants': variants
+    }
+
+def run_fresh(arguments):
+    """Run a benchmark subcommand in a fresh interpreter; returns (result dict, None) or (None, error)"""
+    with tempfile.TemporaryDirectory(prefix='separation-bench-') as workdir:
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__)] + arguments,
+            cwd=workdir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        )
+    if completed.returncode != 0:
+        return None, completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'failed'
+    return json.loads(completed.stdout.strip().splitlines()[-1]), None
+
+def spawn_case(duration, sr, mode, seed, preset, fft_workers=None):
+    """Run one case in a fresh interpreter so imports, caches and peak RSS are not shared"""
+    result, error = run_fresh([
+        '_case', '--duration', str(duration), '--rate', str(sr), '--mode', mode, '--seed', str(seed),
+        '--preset', preset
+    ] + (['--fft-workers', str(fft_workers)] if fft_workers else []))
+    if error is not None:
+        return {
+            'name': case_name(duration, sr, mode, preset, fft_workers),
+            'sample_rate': sr,
+            'duration_seconds': duration,
+            'mode': mode,
+            'preset': preset,
+            'fft_workers': fft_workers,
+            'error': error
+        }
+    return result
+
+def spawn_startup(warm_up, seed):
+    result, error = run_fresh(['_startup', '--seed', str(seed)] + (['--warm-up'] if warm_up else []))
+    if error is not None:
+        return {'name': startup_name(warm_up), 'warm_up': warm_up, 'error': error}
+    return result
+
+def spawn_hpss(seed):
+    result, error = run_fresh(['_hpss', '--seed', str(seed)])
+    if error is not None:
+        return {'error': error}
+    return result
+
+def host_info():
+    import librosa
+    import scipy
+    return {
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'librosa': librosa.__version__
+    }
+
+def pipeline_version():
+    """PIPELINE_VERSION without importing the app (which would create its folders here)"""
+    with open(APP_PATH) as f:
+        for line in f:
+            if line.startswith('PIPELINE_VERSION'):
+                return line.split('=', 1)[1].split('#', 1)[0].strip().strip('\'"')
+    return None
+
+def print_cases(cases):
+    print(f"{'case':32s} {'seconds':>9s} {'RTF':>8s} {'peak MB':>9s} {'predicted':>10s}")
+    for case in cases:
+        if 'error' in case:
+            print(f"{case['name']:32s} failed: {case['error']}")
+            continue
+        print(
+            f"{case['name']:32s} {case['total_seconds']:9.2f} {case['realtime_factor']:8.3f} "
+            f"{case['peak_rss_mb'] if case['peak_rss_mb'] is not None else '-':>9} "
+            f"{case.get('predicted_peak_mb', '-'):>10}"
+        )
+
+def print_startup(startup):
+    print(f"{'startup':32s} {'import':>9s} {'ready':>9s} {'first req':>10s}")
+    for entry in startup:
+        if 'error' in entry:
+            print(f"{entry['name']:32s} failed: {entry['error']}")
+            continue
+        print(
+            f"{entry['name']:32s} {entry['import_seconds']:9.2f} {entry['ready_seconds']:9.2f} "
+            f"{entry['first_request_seconds']:10.2f}"
+        )
+
+def compare_results(baseline, current, threshold=0.10, min_seconds=0.05, min_mb=16):
+    """
+    Regressions of current against baseline, matched by case name. Times regress when they grow
+    by more than threshold (relative) and min_seconds (absolute); peak RSS likewise with min_mb.
+    """
+    baseline_cases = {case['name']: case for case in baseline['cases'] if 'error' not in case}
+    regressions = []
+
+    def check(case_name, metric, old, new, floor):
+        if old is None or new is None:
+            return
+        if new > old * (1 + threshold) and new - old > floor:
+            regressions.append({
+                'case': case_name, 'metric': metric, 'baseline': old, 'current': new,
+                'change': round(new / old - 1, 3) if old else None
+            })
+
+    for case in current['cases']:
+        old = baseline_cases.get(case['name'])
+        if old is None:
+            continue
+        if 'error' in case:
+            regressions.append({'case': case['name'], 'metric': 'error', 'baseline': None, 'current': case['error']})
+            continue
+        check(case['name'], 'total_seconds', old['total_seconds'], case['total_seconds'], min_seconds)
+        check(case['name'], 'peak_rss_mb', old['peak_rss_mb'], case['peak_rss_mb'], min_mb)
+        for stage, entry in case['stages'].items():
+            if stage in old['stages']:
+                check(
+                    case['name'], f"{stage}.wall_seconds",
+                    old['stages'][stage]['wall_seconds'], entry['wall_seconds'], min_seconds
+                )
+
+    baseline_startup = {entry['name']: entry for entry in baseline.get('startup', []) if 'error' not in entry}
+    for entry in current.get('startup', []):
+        old = baseline_startup.get(entry['name'])
+        if old is None:
+            continue
+        if 'error' in entry:
+            regressions.append({'case': entry['name'], 'metric': 'error', 'baseline': None, 'current': entry['error']})
+            continue
+        for metric in ('import_seconds', 'ready_seconds', 'first_request_seconds'):
+            check(entry['name'], metric, old[metric], entry[metric], min_seconds)
+
+    baseline_hpss = {variant['name']: variant for variant in (baseline.get('hpss') or {}).get('variants', [])}
+    for variant in (current.get('hpss') or {}).get('variants', []):
+        old = baseline_hpss.get(variant['name'])
+        if old is not None:
+            check(variant['name'], 'seconds', old['seconds'], variant['seconds'], min_seconds)
+    return regressions
+
+def report_regressions(regressions):
+    if not regressions:
+        print("No regressions against the baseline")
+        return 0
+    print(f"{len(regressions)} regression(s) against the baseline:")
+    for regression in regressions:
+        change = f" ({regression['change']:+.0%})" if regression.get('change') is not None else ''
+        print(f"  {regression['case']}: {regression['metric']} {regression['baseline']} -> {regression['current']}{change}")
+    return 1
+
+def print_hpss(hpss):
+    if 'error' in hpss:
+        print(f"{'HPSS engine':32s} failed: {hpss['error']}")
+        return
+    print(f"{'HPSS engine':32s} {'seconds':>9s} {'speed-up':>9s} {'worst SNR':>10s}")
+    print(f"{'librosa':32s} {hpss['librosa_seconds']:9.2f} {1:9.2f} {'-':>10s}")
+    for variant in hpss['variants']:
+        snr = f"{variant['worst_snr_db']:.1f} dB" if variant['worst_snr_db'] is not None else 'exact'
+        print(f"{variant['name']:32s} {variant['seconds']:9.2f} {variant['speedup']:9.2f} {snr:>10s}")
+
+def print_scaling(cases):
+    """Speed-up of each case over the same case with the fewest FFT workers"""
+    groups = {}
+    for case in cases:
+        if 'error' not in case:
+            groups.setdefault(case_name(case['duration_seconds'], case['sample_rate'], case['mode'], case['preset']), []).append(case)
+    groups = {name: group for name, group in groups.items() if len(group) > 1}
+    if not groups:
+        return
+    print(f"{'FFT scaling':32s} {'workers':>9s} {'seconds':>9s} {'speed-up':>9s}")
+    for name, group in groups.items():
+        group.sort(key=lambda case: case['fft_workers'])
+        for case in group:
+            print(
+                f"{name:32s} {case['fft_workers']:9d} {case['total_seconds']:9.2f} "
+                f"{group[0]['total_seconds'] / case['total_seconds']:9.2f}"
+            )
+
+def parse_list(value, cast):
+    return [cast(item) for item in value.split(',') if item.strip()]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Separation pipeline benchmark")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="Benchmark synthetic mixes and write JSON results")
+    run.add_argument('--durations', default=','.join(str(d) for d in DEFAULT_DURATIONS),
+                     help="Comma-separated mix durations in seconds")
+    run.add_argument('--rates', default=','.join(str(r) for r in DEFAULT_RATES),
+                     help="Comma-separated native sample rates")
+    run.add_argument('--mode', choices=('auto', 'full', 'windowed'), default='auto',
+                     help=f"Separation mode; auto runs mixes over {AUTO_FULL_MAX_SECONDS}s windowed")
+    run.add_argument('--presets', default='max', help="Comma-separated separation presets")
+    run.add_argument('--fft-workers', default='',
+                     help="Comma-separated FFT worker counts to compare (default: one, a job on a busy server)")
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--output', default='benchmark-results.json')
+    run.add_argument('--baseline', help="Compare against this results file after running")
+    run.add_argument('--threshold', type=float, default=0.10, help="Relative slowdown counted as a regression")
+    run.add_argument('--skip-startup', action='store_true', help="Do not measure cold start and first request")
+    run.add_argument('--skip-hpss', action='store_true', help="Do not compare the HPSS engine with librosa")
+
+    compare = commands.add_parser('compare', help="Compare two results files")
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=0.10)
+
+    case = commands.add_parser('_case')  # Internal: one case in a fresh process, JSON on stdout
+    case.add_argument('--duration', type=float, required=True)
+    case.add_argument('--rate', type=int, required=True)
+    case.add_argument('--mode', required=True)
+    case.add_argument('--seed', type=int, default=0)
+    case.add_argument('--preset', default='max')
+    case.add_argument('--fft-workers', type=int)
+
+    startup = commands.add_parser('_startup')  # Internal: cold start of a fresh process, JSON on stdout
+    startup.add_argument('--seed', type=int, default=0)
+    startup.add_argument('--warm-up', action='store_true')
+
+    hpss = commands.add_parser('_hpss')  # Internal: HPSS engine against librosa, JSON on stdout
+    hpss.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args(argv)
+
+    if args.command == '_case':
+        print(json.dumps(run_case(args.duration, args.rate, args.mode, args.seed, args.preset, args.fft_workers)))
+        return 0
+
+    if args.command == '_startup':
+        print(json.dumps(run_startup(args.warm_up, args.seed)))
+        return 0
+
+    if args.command == '_hpss':
+        print(json.dumps(run_hpss(args.seed)))
+        return 0
+
+    if args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        return report_regressions(compare_results(baseline, current, args.threshold))
+
+    startup = []
+    if not args.skip_startup:
+        for warm_up in (False, True):
+            print(f"Measuring startup {'with' if warm_up else 'without'} warm-up...", flush=True)
+            startup.append(spawn_startup(warm_up, args.seed))
+
+    hpss = None
+    if not args.skip_hpss:
+        print("Comparing the HPSS engine with librosa...", flush=True)
+        hpss = spawn_hpss(args.seed)
+
+    cases = []
+    for preset in parse_list(args.presets, str.strip):
+        for sr in parse_list(args.rates, int):
+            for duration in parse_list(args.durations, float):
+                mode = resolve_mode(args.mode, duration)
+                for fft_workers in parse_list(args.fft_workers, int) or [None]:
+                    workers = f", {fft_workers} FFT workers" if fft_workers else ''
+                    print(f"Running {sr} Hz, {duration:g}s, {mode}, {preset}{workers}...", flush=True)
+                    cases.append(spawn_case(duration, sr, mode, args.seed, preset, fft_workers))
+
+    results = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'pipeline_version': pipeline_version(),
+        'host': host_info(),
+        'config': {'mode': args.mode, 'presets': args.presets, 'fft_workers': args.fft_workers, 'seed': args.seed},
+        'startup': startup,
+        'hpss': hpss,
+        'cases': cases
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if startup:
+        print_startup(startup)
+    if hpss:
+        print_hpss(hpss)
+    print_cases(cases)
+    print_scaling(cases)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        return report_regressions(compare_results(baseline, results, args.threshold))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,24 @@
+"""Shared fixtures for the backend tests"""
+import importlib.util
+import os
+import sys
+
+import pytest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app-professional.py')
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """app-professional.py, imported as benchmark.py does (the hyphen rules out a plain import)"""
+    # Importing creates the upload and output folders in the working directory
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('app'))
+    try:
+        spec = importlib.util.spec_from_file_location('app_professional', APP_PATH)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['app_professional'] = module
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+    module.logger.setLevel('WARNING')
+    return module
@@ -0,0 +1,24 @@
+"""The chord analysis rides on the coarse HPSS and never pulls it into a stem subset that skips it"""
+import pytest
+
+SR = 22050
+
+@pytest.fixture(scope='module')
+def clip(app_module):
+    return app_module.synthetic_clip(2, sr=SR).T.copy()
+
+@pytest.mark.parametrize('stems, preset, expect_chroma', [
+    (('vocals',), 'fast', False),
+    (('vocals', 'drums'), 'max', False),
+    (('vocals', 'drums'), 'fast', True),  # Without multi-scale HPSS the drums reuse the coarse split
+    (('bass',), 'max', True),
+    ((), 'max', True),  # The chords mode
+])
+def test_chroma_only_when_hpss_coarse_runs(app_module, clip, stems, preset, expect_chroma):
+    timings, chroma = {}, []
+    separated = app_module.separate_stems(clip, SR, stems=stems, timings=timings, preset=preset, chroma=chroma)
+    
+    assert set(separated) == set(stems)
+    assert ('hpss_coarse' in timings) == expect_chroma
+    assert ('chroma' in timings) == expect_chroma
+    assert len(chroma) == int(expect_chroma)
@@ -0,0 +1,45 @@
+"""
+End-to-end check of the float32/complex64 policy: every stage of separate_stems and finish_track,
+for stereo and mono input under every preset, on a short synthetic clip.
+"""
+import numpy as np
+import pytest
+
+SR = 22050
+SECONDS = 2
+
+@pytest.fixture
+def strict_policy(app_module, monkeypatch):
+    """Replace the pipeline's logged dtype check with one that records every check and violation"""
+    checked, violations = [], []
+    def check(where, value):
+        checked.append(where)
+        violations.extend((where, dtype) for dtype in app_module.dtype_policy_violations(value))
+    monkeypatch.setattr(app_module, 'check_dtype_policy', check)
+    return checked, violations
+
+@pytest.fixture(scope='module')
+def clip(app_module):
+    return app_module.synthetic_clip(SECONDS, sr=SR).T.copy()
+
+@pytest.mark.parametrize('channels', ['stereo', 'mono'])
+@pytest.mark.parametrize('preset', ['fast', 'balanced', 'max'])
+def test_pipeline_stays_float32(app_module, strict_policy, clip, channels, preset):
+    checked, violations = strict_policy
+    y = clip if channels == 'stereo' else app_module.librosa.to_mono(clip)
+    
+    stems = app_module.separate_stems(y, SR, preset=preset, chroma=[])
+    for track_type, audio in stems.items():
+        assert audio.dtype == app_module.AUDIO_DTYPE, track_type
+        finished = app_module.finish_track(audio, SR, track_type)
+        assert finished.dtype == app_module.AUDIO_DTYPE, track_type
+    
+    assert any(where.startswith('Stage ') for where in checked)
+    assert any(where.startswith('Signal ') for where in checked)
+    assert sum(where.startswith('Post-processing ') for where in checked) == len(app_module.TRACK_NAMES)
+    assert violations == []
+
+def test_violations_are_logged(app_module, caplog):
+    app_module.check_dtype_policy('Test stage', (np.zeros(4, np.float32), np.zeros(4)))
+    assert app_module.dtype_policy_violations(np.zeros(4, np.complex128)) == [np.dtype(np.complex128)]
+    assert 'Test stage produced float64' in caplog.text
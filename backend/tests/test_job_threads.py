@@ -0,0 +1,34 @@
+"""Per-job FFT/median thread counts: all cores on an idle server, an even share on a busy one"""
+from collections import deque
+
+import pytest
+
+@pytest.fixture
+def manager(app_module, monkeypatch):
+    monkeypatch.setattr(app_module.os, 'cpu_count', lambda: 8)
+    return app_module.SeparationJobManager(
+        max_workers=4, max_queued=16, retention_seconds=3600, cpu_budget=1e9, memory_budget=1e12
+    )
+
+@pytest.mark.parametrize('running, queued, threads', [
+    (0, 0, 8),  # Alone on the server
+    (1, 0, 4),
+    (1, 1, 2),
+    (3, 0, 2),
+    (3, 10, 2),  # Queued jobs beyond the free workers don't share the cores yet
+])
+def test_job_threads_share_the_cores(manager, running, queued, threads):
+    manager._running = running
+    manager._pending = deque(range(queued))
+    assert manager._job_threads() == threads
+
+def test_engines_follow_the_job_threads(app_module, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'FFT_WORKERS', None)
+    monkeypatch.setitem(app_module.app.config, 'MEDIAN_WORKERS', None)
+    monkeypatch.setattr(app_module.fft_engine, 'job_workers', 3)
+    assert app_module.fft_engine.workers == 3
+    assert app_module.median_engine.workers == 3
+    
+    monkeypatch.setitem(app_module.app.config, 'FFT_WORKERS', 2)
+    assert app_module.fft_engine.workers == 2
+    assert app_module.median_engine.workers == 2
@@ -0,0 +1,146 @@
+"""
+The vectorized vocal masks against the per-bin loops they replaced, on seeded spectrograms.
+The reference functions below are the original loop code, lifted out of professional_source_separation.
+"""
+import numpy as np
+import pytest
+from scipy.ndimage import median_filter
+
+SR = 22050
+N_FFT = 4096
+FREQ_BINS = 1 + N_FFT // 2
+FRAMES = 96
+
+def reference_vocal_confidence_mask(center_mag, sides_mag, left_mag, right_mag, vocal_low_bin, vocal_high_bin):
+    freq_bins = center_mag.shape[0]
+    vocal_mask = np.zeros_like(center_mag)
+    for freq_bin in range(vocal_low_bin, min(vocal_high_bin, freq_bins)):
+        energy_center = center_mag[freq_bin, :]
+        energy_sides = sides_mag[freq_bin, :]
+        energy_left = left_mag[freq_bin, :]
+        energy_right = right_mag[freq_bin, :]
+        
+        center_dominance = energy_center / (energy_sides + 1e-8)
+        stereo_correlation = (energy_left * energy_right) / (energy_left + energy_right + 1e-8)
+        center_consistency = 1 - np.std(energy_center) / (np.mean(energy_center) + 1e-8)
+        center_consistency = np.clip(center_consistency, 0, 1)
+        if freq_bin > vocal_low_bin and freq_bin < freq_bins - 1:
+            spectral_smoothness = 1 - abs(
+                energy_center - (center_mag[freq_bin-1, :] + center_mag[freq_bin+1, :]) / 2
+            ) / (energy_center + 1e-8)
+            spectral_smoothness = np.clip(spectral_smoothness, 0, 1)
+        else:
+            spectral_smoothness = np.ones_like(energy_center)
+        
+        center_dominance = median_filter(center_dominance, size=7)
+        vocal_confidence = (
+            np.clip((center_dominance - 1.8) / 3.5, 0, 1) * 0.35 +
+            np.clip(stereo_correlation - 0.2, 0, 1) * 0.25 +
+            center_consistency * 0.25 +
+            spectral_smoothness * 0.15
+        )
+        vocal_mask[freq_bin, :] = np.clip(vocal_confidence - 0.3, 0, 1)
+    return vocal_mask
+
+def reference_formant_boost(vocal_mask, nyquist):
+    freq_bins = vocal_mask.shape[0]
+    for formant in [900, 1300, 2500]:
+        if formant < nyquist * 0.7:
+            formant_bin = int(formant * freq_bins / nyquist)
+            if formant_bin < freq_bins:
+                start_bin = max(0, formant_bin - 12)
+                end_bin = min(freq_bins, formant_bin + 12)
+                for b in range(start_bin, end_bin):
+                    if b < freq_bins:
+                        boost_factor = 1.0 + 0.3 * np.exp(-((b - formant_bin) / 6) ** 2)
+                        vocal_mask[b, :] = vocal_mask[b, :] * boost_factor
+    return vocal_mask
+
+def reference_pitch_harmonics(vocal_mask, f0, nyquist):
+    freq_bins = vocal_mask.shape[0]
+    for t, pitch in enumerate(f0):
+        if not np.isnan(pitch) and pitch > 0:
+            for harmonic in range(1, 4):
+                harm_freq = pitch * harmonic
+                if harm_freq < nyquist * 0.7:
+                    harm_bin = int(harm_freq * freq_bins / nyquist)
+                    if harm_bin < freq_bins and t < vocal_mask.shape[1]:
+                        vocal_mask[harm_bin, t] = max(vocal_mask[harm_bin, t], 0.5)
+    return vocal_mask
+
+def reference_spectral_subtraction(vocals_mag, instrumental_mag, nyquist):
+    freq_bins = vocals_mag.shape[0]
+    for freq_bin in range(freq_bins):
+        freq_hz = freq_bin * nyquist / freq_bins
+        if 120 <= freq_hz <= 6000:
+            vocal_energy = vocals_mag[freq_bin, :]
+            instrumental_energy = instrumental_mag[freq_bin, :]
+            subtraction_factor = np.minimum(
+                0.4,
+                instrumental_energy / (vocal_energy + instrumental_energy + 1e-8)
+            )
+            strong_instrumental = instrumental_energy > vocal_energy * 2
+            vocals_mag[freq_bin, :] *= (1 - subtraction_factor * 0.3 * strong_instrumental)
+        elif freq_hz < 120:
+            vocals_mag[freq_bin, :] *= 0.3
+        elif freq_hz > 6000:
+            vocals_mag[freq_bin, :] *= 0.6
+    return vocals_mag
+
+def reference_spike_suppression(vocals_mag, gate_mask):
+    for freq_bin in range(vocals_mag.shape[0]):
+        energy_profile = vocals_mag[freq_bin, :]
+        median_energy = median_filter(energy_profile, size=5)
+        spike_mask = energy_profile < median_energy * 4.0
+        gate_mask[freq_bin, :] = gate_mask[freq_bin, :] & spike_mask
+    return gate_mask
+
+def magnitudes(seed, count):
+    """Seeded float32 magnitude spectrograms with heavy-tailed, spiky content like real music"""
+    rng = np.random.default_rng(seed)
+    return [rng.lognormal(mean=-2.0, sigma=1.5, size=(FREQ_BINS, FRAMES)).astype(np.float32) for _ in range(count)]
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_vocal_confidence_mask_matches_loop(app_module, seed):
+    center, sides, left, right = magnitudes(seed, 4)
+    nyquist = SR / 2
+    low_bin = int(120 * FREQ_BINS / nyquist)
+    high_bin = int(min(6000, nyquist * 0.7) * FREQ_BINS / nyquist)
+    
+    expected = reference_vocal_confidence_mask(center, sides, left, right, low_bin, high_bin)
+    actual = app_module.compute_vocal_confidence_mask(center, sides, left, right, low_bin, high_bin)
+    np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+    
+    expected = reference_formant_boost(expected.copy(), nyquist)
+    actual = actual * app_module.formant_boost_gains(FREQ_BINS, nyquist)[:, np.newaxis]
+    np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_pitch_harmonics_match_loop(app_module, seed):
+    mask, = magnitudes(seed, 1)
+    mask = np.clip(mask, 0, 1)
+    rng = np.random.default_rng(seed)
+    # Voiced, unvoiced (NaN) and out-of-range pitches, and more f0 frames than mask frames
+    f0 = rng.uniform(100, 3000, FRAMES + 4)
+    f0[rng.random(f0.shape) < 0.3] = np.nan
+    
+    expected = reference_pitch_harmonics(mask.copy(), f0, SR / 2)
+    actual = app_module.apply_pitch_harmonics(mask.copy(), f0, SR / 2)
+    np.testing.assert_array_equal(actual, expected)
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_spectral_subtraction_matches_loop(app_module, seed):
+    vocals, instrumental = magnitudes(seed, 2)
+    
+    expected = reference_spectral_subtraction(vocals.copy(), instrumental, SR / 2)
+    actual = vocals * app_module.spectral_subtraction_gains(vocals, instrumental, SR / 2)
+    np.testing.assert_allclose(actual, expected, rtol=1e-6)
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_spike_suppression_matches_loop(app_module, seed):
+    vocals, = magnitudes(seed, 1)
+    gate = vocals > np.percentile(vocals, 25, axis=1, keepdims=True) * 3.0
+    
+    expected = reference_spike_suppression(vocals, gate.copy())
+    actual = gate & app_module.spike_suppression_mask(vocals)
+    np.testing.assert_array_equal(actual, expected)